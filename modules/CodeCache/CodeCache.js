@@ -0,0 +1,206 @@
+module.exports = (function() {
+  var crypto = require('crypto');
+  var fs = require('fs');
+  var os = require('os');
+  var path = require('path');
+  var vm = require('vm');
+
+  function defaultDirectory() {
+    var home = process.env.HOME || process.env.USERPROFILE || os.tmpdir();
+    if(process.platform === 'win32') {
+      return path.join(process.env.LOCALAPPDATA || home, 'Tint', 'CodeCache');
+    } else if(process.platform === 'darwin') {
+      return path.join(home, 'Library', 'Caches', 'Tint', 'CodeCache');
+    }
+    return path.join(process.env.XDG_CACHE_HOME || path.join(home, '.cache'), 'tint', 'code-cache');
+  }
+
+  function makeDirectory(directory) {
+    try {
+      fs.mkdirSync(directory);
+    } catch(e) {
+      if(e.code === 'ENOENT') {
+        makeDirectory(path.dirname(directory));
+        fs.mkdirSync(directory);
+      } else if(e.code !== 'EEXIST') {
+        throw e;
+      }
+    }
+  }
+
+  /**
+   * @class CodeCache
+   * @description Keeps the code V8 compiles for scripts on disk, so later
+   *              launches of an application can skip compiling them.  Caches
+   *              are keyed by the version of Tint, an id for the script and
+   *              the SHA-1 of its source, so a changed script is never given
+   *              a stale cache.  The least recently used caches are removed
+   *              once the directory grows beyond maxSize bytes or maxEntries
+   *              files.
+   * @param {Object} options An optional object with a directory, maxSize,
+   *                         maxEntries and version.
+   * @example
+   *  var CodeCache = require('CodeCache');
+   *  new CodeCache().install();
+   *  // Scripts required from here on are compiled with a code cache.
+   */
+  function CodeCache(options) {
+    options = options || {};
+    this.directory = options.directory || defaultDirectory();
+    this.maxSize = options.maxSize || 32 * 1024 * 1024;
+    this.maxEntries = options.maxEntries || 1024;
+    this.version = options.version || process.versions.tint || process.version;
+  }
+
+  /**
+   * @method hash
+   * @memberof CodeCache
+   * @description Returns the SHA-1 of a source as a hex string, the same hash
+   *              tint_js2c.py records for the built-in modules.
+   * @param {string} source The source of a script.
+   * @returns {string}
+   */
+  CodeCache.hash = function(source) {
+    return crypto.createHash('sha1').update(source, 'utf8').digest('hex');
+  };
+
+  CodeCache.prototype.file = function(id, hash) {
+    var key = crypto.createHash('sha1').update(this.version + '\n' + id + '\n' + hash, 'utf8').digest('hex');
+    return path.join(this.directory, key + '.cache');
+  };
+
+  /**
+   * @method compile
+   * @memberof CodeCache
+   * @description Compiles a script, using the cache for it when there is a
+   *              valid one and writing one otherwise.
+   * @param {string} id A name for the script, such as its path or module id.
+   * @param {string} hash The SHA-1 of the source, see CodeCache.hash.
+   * @param {string} source The source to compile.
+   * @param {Object} options The options for vm.Script, such as its filename.
+   * @returns {vm.Script}
+   */
+  CodeCache.prototype.compile = function(id, hash, source, options) {
+    var file = this.file(id, hash);
+    var scriptOptions = {};
+    for(var key in options) {
+      scriptOptions[key] = options[key];
+    }
+    try {
+      scriptOptions.cachedData = fs.readFileSync(file);
+    } catch(e) {
+    }
+    if(scriptOptions.cachedData) {
+      var script = new vm.Script(source, scriptOptions);
+      if(!script.cachedDataRejected) {
+        try {
+          var now = new Date();
+          fs.utimesSync(file, now, now);
+        } catch(e) {
+        }
+        return script;
+      }
+      // Made by another V8 or with other flags; replace it.
+      delete scriptOptions.cachedData;
+    }
+    scriptOptions.produceCachedData = true;
+    var produced = new vm.Script(source, scriptOptions);
+    if(produced.cachedDataProduced) {
+      this.write(file, produced.cachedData);
+    }
+    return produced;
+  };
+
+  CodeCache.prototype.write = function(file, data) {
+    // Written next to the cache and moved over it, so that another instance
+    // of the application never reads half of a cache.
+    var temp = file + '.' + process.pid + '.tmp';
+    try {
+      makeDirectory(this.directory);
+      fs.writeFileSync(temp, data);
+      fs.renameSync(temp, file);
+    } catch(e) {
+      try {
+        fs.unlinkSync(temp);
+      } catch(e) {
+      }
+      return;
+    }
+    this.prune();
+  };
+
+  /**
+   * @method prune
+   * @memberof CodeCache
+   * @description Removes the least recently used caches until the directory
+   *              is within maxSize and maxEntries.
+   */
+  CodeCache.prototype.prune = function() {
+    var directory = this.directory;
+    var names;
+    try {
+      names = fs.readdirSync(directory);
+    } catch(e) {
+      return;
+    }
+    var entries = [];
+    names.forEach(function(name) {
+      if(path.extname(name) !== '.cache') {
+        return;
+      }
+      try {
+        var stat = fs.statSync(path.join(directory, name));
+        entries.push({name:name, size:stat.size, used:stat.mtime.getTime()});
+      } catch(e) {
+      }
+    });
+    entries.sort(function(a, b) { return b.used - a.used; });
+    var size = 0;
+    entries.forEach(function(entry, index) {
+      size += entry.size;
+      if(index >= this.maxEntries || size > this.maxSize) {
+        try {
+          fs.unlinkSync(path.join(directory, entry.name));
+        } catch(e) {
+        }
+      }
+    }, this);
+  };
+
+  /**
+   * @method install
+   * @memberof CodeCache
+   * @description Compiles every script loaded with require from now on
+   *              through this cache, keyed by its filename.
+   */
+  CodeCache.prototype.install = function() {
+    var Module = require('module');
+    var cache = this;
+    var compile = Module.prototype._compile;
+    var runInThisContext = vm.runInThisContext;
+    var current = null;
+
+    Module.prototype._compile = function(content, filename) {
+      var previous = current;
+      current = filename;
+      try {
+        return compile.apply(this, arguments);
+      } finally {
+        current = previous;
+      }
+    };
+
+    // Module.prototype._compile runs the wrapped module through
+    // vm.runInThisContext with the filename of the module.
+    vm.runInThisContext = function(code, options) {
+      if(current === null || typeof(code) !== 'string' || options === null ||
+         typeof(options) !== 'object' || options.filename !== current) {
+        return runInThisContext.apply(vm, arguments);
+      }
+      current = null;
+      return cache.compile(options.filename, CodeCache.hash(code), code, options).runInThisContext(options);
+    };
+  };
+
+  return CodeCache;
+})();
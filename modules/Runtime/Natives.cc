@@ -0,0 +1,165 @@
+// Stands in for node's src/node_javascript.cc. The natives are read through
+// GetNativeSource() and GetNativeSourceLength() of the node_natives.h that
+// tools/tint_js2c.py generates, rather than from natives[] directly, so
+// that natives built with --dev or --compression are read from the checkout
+// or inflated when node asks for them. Natives built with --blob are
+// mapped from the blob next to the executable before the first is read.
+// process.binding('natives') gets an accessor for every native, so a native
+// is only read when NativeModule loads it, and the ASCII ones are handed to
+// V8 without a copy. process.binding('tint_natives')
+// hands the code caches embedded with --code-cache to NativeModule.
+#include "node.h"
+#include "node_buffer.h"
+#include "node_natives.h"
+#include "v8.h"
+#include "env.h"
+#include "env-inl.h"
+#if defined(TINT_NATIVES_CODE_CACHE)
+#include <string.h>
+#include "util.h"
+#endif
+#if defined(TINT_NATIVES_BLOB)
+#include <stdio.h>
+#include <stdlib.h>
+#include <string>
+#include "uv.h"
+#endif
+
+namespace node {
+
+using v8::Context;
+using v8::FunctionCallbackInfo;
+using v8::HandleScope;
+using v8::Integer;
+using v8::Isolate;
+using v8::Local;
+using v8::Name;
+using v8::NewStringType;
+using v8::Object;
+using v8::PropertyCallbackInfo;
+using v8::String;
+using v8::V8;
+using v8::Value;
+
+static const char* const main_native = "internal/bootstrap_node";
+
+// With --blob natives[] has no sources until the blob is mapped.
+static void MapNatives() {
+#if defined(TINT_NATIVES_BLOB)
+  static bool mapped = false;
+  if (mapped) return;
+  char exec_path[4096];
+  size_t exec_path_len = sizeof(exec_path);
+  std::string path;
+  if (uv_exepath(exec_path, &exec_path_len) == 0) {
+    path.assign(exec_path, exec_path_len);
+    size_t slash = path.find_last_of("/\\");
+    path.erase(slash == std::string::npos ? 0 : slash + 1);
+  }
+  path += TINT_NATIVES_BLOB;
+  if (!MapNativesBlob(path.c_str())) {
+    fprintf(stderr, "tint: can't map the natives from %s\n", path.c_str());
+    abort();
+  }
+  mapped = true;
+#endif
+}
+
+// The ASCII natives go to V8 as external strings over their sources, rather
+// than as copies. The sources stay where they are for the lifetime of the
+// process, so the resources are never disposed of.
+class NativeSourceResource : public String::ExternalOneByteStringResource {
+ public:
+  NativeSourceResource() : data_(NULL), length_(0) {}
+
+  void Set(const char* data, size_t length) {
+    data_ = data;
+    length_ = length;
+  }
+
+  const char* data() const override { return data_; }
+  size_t length() const override { return length_; }
+  void Dispose() override {}
+
+ private:
+  const char* data_;
+  size_t length_;
+};
+
+static NativeSourceResource native_resources[sizeof(natives) /
+                                             sizeof(natives[0])];
+
+static Local<String> NativeSource(Isolate* isolate, size_t index) {
+  const char* source = reinterpret_cast<const char*>(GetNativeSource(index));
+  size_t length = GetNativeSourceLength(index);
+  if (natives[index].encoding == NATIVE_ENCODING_ONE_BYTE) {
+    NativeSourceResource* resource = &native_resources[index];
+    if (resource->data() == NULL) resource->Set(source, length);
+    return String::NewExternalOneByte(isolate, resource).ToLocalChecked();
+  }
+  return String::NewFromUtf8(isolate, source, NewStringType::kNormal,
+                             static_cast<int>(length)).ToLocalChecked();
+}
+
+// The data of the accessor is the index of the native in natives[].
+static void NativeSourceGetter(Local<Name> property,
+                               const PropertyCallbackInfo<Value>& info) {
+  size_t index = static_cast<size_t>(info.Data().As<Integer>()->Value());
+  info.GetReturnValue().Set(NativeSource(info.GetIsolate(), index));
+}
+
+Local<String> MainSource(Environment* env) {
+  MapNatives();
+  return NativeSource(env->isolate(), GetNativeIndex(main_native));
+}
+
+void DefineJavaScript(Environment* env, Local<Object> target) {
+  HandleScope scope(env->isolate());
+  MapNatives();
+  int main = GetNativeIndex(main_native);
+
+  for (size_t i = 0; i < sizeof(natives) / sizeof(natives[0]); i++) {
+    if (static_cast<int>(i) == main) continue;
+    Local<String> name = String::NewFromUtf8(env->isolate(), natives[i].name);
+    target->SetAccessor(env->context(), name, NativeSourceGetter, nullptr,
+                        Integer::New(env->isolate(), static_cast<int>(i)))
+        .FromJust();
+  }
+}
+
+#if defined(TINT_NATIVES_CODE_CACHE)
+// The caches are embedded, so their buffers have nothing to free.
+static void KeepCodeCache(char* data, void* hint) {}
+
+// codeCache(id) returns a Buffer of the code cache of the native called id,
+// or undefined if it has none or the caches were made by another version of
+// V8. V8 itself rejects a cache made with other flags, which NativeModule
+// tells by cachedDataRejected.
+static void NativeCodeCache(const FunctionCallbackInfo<Value>& args) {
+  Environment* env = Environment::GetCurrent(args);
+  if (strcmp(V8::GetVersion(), native_code_caches_v8_version) != 0) return;
+  node::Utf8Value id(env->isolate(), args[0]);
+  const struct _native_code_cache* cache = GetNativeCodeCache(*id);
+  if (cache == NULL) return;
+  char* data = reinterpret_cast<char*>(const_cast<unsigned char*>(cache->data));
+  Local<Object> buffer;
+  if (Buffer::New(env->isolate(), data, cache->length, KeepCodeCache, nullptr)
+          .ToLocal(&buffer)) {
+    args.GetReturnValue().Set(buffer);
+  }
+}
+#endif
+
+// Without --code-cache the binding is empty, and NativeModule compiles the
+// natives without caches.
+static void InitializeNatives(Local<Object> target, Local<Value> unused,
+                              Local<Context> context) {
+#if defined(TINT_NATIVES_CODE_CACHE)
+  Environment* env = Environment::GetCurrent(context);
+  env->SetMethod(target, "codeCache", NativeCodeCache);
+#endif
+}
+
+}  // namespace node
+
+NODE_MODULE_CONTEXT_AWARE_BUILTIN(tint_natives, node::InitializeNatives)
@@ -0,0 +1,54 @@
+/**
+ * @unit-test-setup
+ * @ignore
+ */
+function setup() {
+}
+
+function baseline() {
+}
+
+/**
+ * @example
+ */
+function run($utils) {
+  var fs = require('fs');
+  var os = require('os');
+  var path = require('path');
+  var CodeCache = require('CodeCache');
+  var directory = path.join(os.tmpdir(), 'tint-codecache-test-' + process.pid);
+  var cache = new CodeCache({directory:directory, maxEntries:2});
+  var source = 'function double(x) { return x * 2; } double(21);';
+  var hash = CodeCache.hash(source);
+
+  var script = cache.compile('double.js', hash, source, {filename:'double.js'});
+  /* @hidden */ $utils.assert(script.runInThisContext() === 42);
+  /* @hidden */ $utils.assert(fs.existsSync(cache.file('double.js', hash)));
+  // A changed source is looked up under another hash.
+  /* @hidden */ $utils.assert(cache.file('double.js', CodeCache.hash(source + ' ')) !== cache.file('double.js', hash));
+
+  cache.compile('a.js', CodeCache.hash('1'), '1', {filename:'a.js'});
+  cache.compile('b.js', CodeCache.hash('2'), '2', {filename:'b.js'});
+  /* @hidden */ $utils.assert(fs.readdirSync(directory).length === 2);
+
+  fs.readdirSync(directory).forEach(function(name) {
+    fs.unlinkSync(path.join(directory, name));
+  });
+  fs.rmdirSync(directory);
+  /* @hidden */ $utils.ok();
+}
+
+/**
+ * @unit-test-shutdown
+ * @ignore
+ */
+function shutdown() {
+}
+
+module.exports = {
+  setup:setup, 
+  run:run, 
+  shutdown:shutdown, 
+  shell:false,
+  name:"CodeCache",
+};
@@ -22,6 +22,26 @@
     'openssl_fips':'false',
     'node_target_type':'executable',
     'node_v8_options': '',
+    # Output of tools/tint_code_cache.py to embed, for NativeModule to compile
+    # the natives with. It has to be made by a tint of the same V8 version.
+    'tint_code_cache%': '',
+    'tint_natives_budget%': '',          # budget file for tools/tint_natives_size.py.
+    'tint_natives_shards%': 'false',     # define the natives in the .cc files below.
+    'tint_natives_prune%': 'false',      # leave out natives nothing requires.
+    'tint_natives_load_order%': '',      # module ids in load order, to lay the natives out in.
+    'tint_natives_dev%': 'false',        # read the natives from the checkout at runtime.
+    'tint_natives_blob%': 'false',       # map the natives from node_natives.bin next to tint.
+    # tint_js2c.py --shards=8 names its shards after node_natives.h.
+    'tint_natives_shard_files': [
+      '<(SHARED_INTERMEDIATE_DIR)/node_natives_0.cc',
+      '<(SHARED_INTERMEDIATE_DIR)/node_natives_1.cc',
+      '<(SHARED_INTERMEDIATE_DIR)/node_natives_2.cc',
+      '<(SHARED_INTERMEDIATE_DIR)/node_natives_3.cc',
+      '<(SHARED_INTERMEDIATE_DIR)/node_natives_4.cc',
+      '<(SHARED_INTERMEDIATE_DIR)/node_natives_5.cc',
+      '<(SHARED_INTERMEDIATE_DIR)/node_natives_6.cc',
+      '<(SHARED_INTERMEDIATE_DIR)/node_natives_7.cc',
+    ],
     'node_prefix': '',
     'node_tag': '',
     'with_intl': 'true',
@@ -215,6 +235,7 @@
       # begin common tint files.
       'modules/AppSchema/AppSchema.js',
       'modules/Application/Common.js',
+      'modules/CodeCache/CodeCache.js',
       'modules/Bridge/ref.js',
       'modules/Bridge/struct.js',
       'modules/Bridge/_foreign_function.js',
@@ -277,7 +298,9 @@
         'libraries/node/src/node_contextify.cc',
         'libraries/node/src/node_file.cc',
         'libraries/node/src/node_http_parser.cc',
-        'libraries/node/src/node_javascript.cc',
+        # node_javascript.cc, reading the natives the way tint_js2c.py
+        # stored them.
+        'modules/Runtime/Natives.cc',
         #'libraries/node/src/node_main.cc',
         'libraries/node/src/node_os.cc',
         'libraries/node/src/node_revert.cc',
@@ -356,6 +379,9 @@
         'NODE_V8_OPTIONS="<(node_v8_options)"',
       ],
       'conditions': [
+        [ 'tint_natives_shards=="true"', {
+          'sources': [ '<@(tint_natives_shard_files)' ],
+        }],
         [ 'v8_enable_i18n_support==1', {
           'defines': [ 'NODE_HAVE_I18N_SUPPORT=1' ],
           'dependencies': [
@@ -848,13 +874,19 @@
       'actions': [
         {
           'action_name': 'tint_js2c',
+          # tint_js2c.py leaves itself and js2c_common.py out of the modules.
           'inputs': [
+            'tools/tint_js2c.py',
+            'tools/js2c_common.py',
             '<@(library_files)',
             'libraries/node/config.gypi'
           ],
           'outputs': [
             '<(SHARED_INTERMEDIATE_DIR)/node_natives.h',
           ],
+          # node_natives.h is only rewritten when it changes, and the depfile
+          # lists the files that were read into it.
+          'depfile': '<(SHARED_INTERMEDIATE_DIR)/node_natives.h.d',
           'conditions': [
             ['OS=="linux"',{
               'inputs': ['<@(linux_library_files)'],
@@ -874,15 +906,70 @@
             [ 'node_use_perfctr=="false"', {
               'inputs': [ 'libraries/node/src/perfctr_macros.py' ]
             }],
+            [ 'tint_code_cache!=""', {
+              'action': [ '--code-cache=<(tint_code_cache)' ]
+            }],
+            [ 'tint_natives_shards=="true"', {
+              'outputs': [ '<@(tint_natives_shard_files)' ],
+              'action': [ '--shards=8' ]
+            }],
+            [ 'tint_natives_dev=="true"', {
+              'action': [ '--dev' ]
+            }],
+            [ 'tint_natives_blob=="true"', {
+              'outputs': [ '<(PRODUCT_DIR)/node_natives.bin' ],
+              'action': [ '--blob=<(PRODUCT_DIR)/node_natives.bin' ]
+            }],
+            [ 'tint_natives_load_order!=""', {
+              'action': [ '--load-order=<(tint_natives_load_order)' ]
+            }],
+            # The keep file is no input, as inputs are embedded; the depfile
+            # lists it instead.
+            [ 'tint_natives_prune=="true"', {
+              'outputs': [ '<(SHARED_INTERMEDIATE_DIR)/node_natives_requires.json' ],
+              'action': [
+                '--prune-unreachable',
+                '--keep=tools/tint_natives_keep.txt',
+                '--require-report=<(SHARED_INTERMEDIATE_DIR)/node_natives_requires.json'
+              ]
+            }],
           ],
           'action': [
             '<(python)',
             'tools/tint_js2c.py',
-            '<@(_outputs)',
+            '--cache=<(SHARED_INTERMEDIATE_DIR)/tint_js2c_cache',
+            '--depfile=<(SHARED_INTERMEDIATE_DIR)/node_natives.h.d',
+            '<(SHARED_INTERMEDIATE_DIR)/node_natives.h',
             '<@(_inputs)',
           ],
         },
       ],
+      'conditions': [
+        [ 'tint_natives_budget!=""', {
+          'actions': [
+            {
+              'action_name': 'tint_natives_size',
+              'inputs': [
+                'tools/tint_natives_size.py',
+                '<(tint_natives_budget)',
+                '<@(library_files)',
+                '<@(<(OS)_library_files)',
+              ],
+              'outputs': [
+                '<(SHARED_INTERMEDIATE_DIR)/tint_natives_size.json',
+              ],
+              'action': [
+                '<(python)',
+                'tools/tint_natives_size.py',
+                '--quiet',
+                '--platform=<(OS)',
+                '--budget=<(tint_natives_budget)',
+                '--json=<@(_outputs)',
+              ],
+            },
+          ],
+        }],
+      ],
     }, # end tint_js2c
     {
       'target_name': 'ffi_bindings',
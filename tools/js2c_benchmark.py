@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+#
+# Benchmarks tint_js2c.py and v8_js2c_fix.py over synthetic corpora.
+#
+#   js2c_benchmark.py [options]
+#
+# Every corpus is a macros.py and a set of modules of about 32K each, with
+# constants and macro calls on the given fraction of lines. Each stage of
+# the generators (read, constants, macros, minify, ToCArray, write) is timed
+# on its own, the whole JS2C() run is timed in a fresh process whose peak
+# memory is reported as well. Runs are repeated and the fastest one kept.
+# v8_js2c_fix.py minifies in two stages, filter and jsmin, and filter is
+# timed next to the regular expressions V8's js2c.py used (filter_baseline).
+#
+#   js2c_benchmark.py --save=baseline.json
+#   js2c_benchmark.py --compare=baseline.json --threshold=0.1
+#
+# With --compare the script exits with 1 if any time or the peak memory got
+# worse than the baseline by more than the threshold.
+#
+#   js2c_benchmark.py --generators=tint --sizes=1M,10M --max-memory-growth=0.2
+#
+# With --max-memory-growth it also exits with 1 if the peak memory of a
+# generator that streams its output grows from the smallest corpus to the
+# largest by more than that fraction of the growth of the corpus.
+
+import json
+import optparse
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import js2c_common
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODULE_SIZE = 32 * 1024
+
+GENERATORS = ['tint', 'v8']
+
+# Generators that write the natives module by module, in memory that doesn't
+# grow with the corpus.
+STREAMING_GENERATORS = ['tint']
+
+# Differences below these are noise, whatever the threshold.
+MIN_TIME_DELTA = 0.01
+MIN_MEMORY_DELTA = 1024
+
+SIZE_SUFFIXES = { 'K': 1024, 'M': 1024 * 1024 }
+
+
+def ParseSize(size):
+  size = size.strip().upper()
+  if size[-1:] in SIZE_SUFFIXES:
+    return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+  return int(size)
+
+
+def FormatSize(size):
+  for suffix in ('M', 'K'):
+    if size >= SIZE_SUFFIXES[suffix] and size % SIZE_SUFFIXES[suffix] == 0:
+      return '%i%s' % (size / SIZE_SUFFIXES[suffix], suffix)
+  return str(size)
+
+
+def GenerateMacros(count):
+  lines = ['# Generated by js2c_benchmark.py.']
+  for i in xrange(count):
+    lines.append('const CONSTANT_%i = %i;' % (i, i * 7))
+    lines.append('macro MACRO_%i(a, b) = ((a) + (b) * %i);' % (i, i))
+  lines.append('macro IS_NULL(arg) = (arg === null);')
+  lines.append('macro IS_UNDEFINED(arg) = (arg === (void 0));')
+  return '\n'.join(lines) + '\n'
+
+
+def GenerateLine(rand, count, constant_density, macro_density):
+  value = 'value_%i' % rand.randint(0, 9)
+  if rand.random() < constant_density:
+    value = '%s + CONSTANT_%i' % (value, rand.randint(0, count - 1))
+  if rand.random() < macro_density:
+    value = 'MACRO_%i(%s, IS_NULL(other) ? 1 : 2)' % (
+        rand.randint(0, count - 1), value)
+  return '  result = result + %s;  // step %i' % (value, rand.randint(0, 99))
+
+
+def GenerateModule(rand, size, count, constant_density, macro_density):
+  lines = ['// Generated by js2c_benchmark.py.', "'use strict';", '']
+  length = 0
+  function = 0
+  while length < size:
+    body = ['/*', ' * Function %i.' % function, ' */',
+            'function function_%i(value_0, other) {' % function,
+            '  var result = "string " + %i;' % function]
+    for i in xrange(rand.randint(5, 30)):
+      body.append(GenerateLine(rand, count, constant_density, macro_density))
+    body.extend(['  if (IS_UNDEFINED(other)) return result;',
+                 '  return result / 2;', '}', ''])
+    lines.extend(body)
+    length = length + sum(len(line) + 1 for line in body)
+    function = function + 1
+  lines.append('exports.function_0 = function_0;')
+  return '\n'.join(lines) + '\n'
+
+
+def GenerateCorpus(directory, size, constant_density, macro_density,
+                   macro_count=100, seed=0):
+  """Write a corpus of about size bytes of modules and a macros.py.
+
+  Returns:
+    A list of the files of the corpus, macros.py first.
+  """
+  rand = random.Random(seed)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  files = [os.path.join(directory, 'macros.py')]
+  output = open(files[0], 'w')
+  output.write(GenerateMacros(macro_count))
+  output.close()
+  count = max(1, (size + MODULE_SIZE - 1) // MODULE_SIZE)
+  for i in xrange(count):
+    filename = os.path.join(directory, 'module_%04i.js' % i)
+    output = open(filename, 'w')
+    output.write(GenerateModule(rand, min(MODULE_SIZE, size), macro_count,
+                                constant_density, macro_density))
+    output.close()
+    files.append(filename)
+    size = size - MODULE_SIZE
+  return files
+
+
+class Stages:
+  """Times the stages of a run, in the order they ran."""
+  def __init__(self):
+    self.names = []
+    self.times = {}
+
+  def Run(self, name, function, values):
+    start = time.time()
+    result = map(function, values)
+    self.times[name] = time.time() - start
+    self.names.append(name)
+    return result
+
+
+def MeasureTintStages(files, minify, output):
+  import tint_js2c
+  stages = Stages()
+  macro_lines = tint_js2c.ReadLines(files[0])
+  (constants, macros) = tint_js2c.ReadMacros(macro_lines)
+  constants = tint_js2c.ConstantExpander(constants)
+  macros = tint_js2c.MacroExpander(macros)
+  sources = stages.Run('read', tint_js2c.ReadFile, files[1:])
+  sources = stages.Run('constants', constants.Expand, sources)
+  sources = stages.Run('macros', macros.Expand, sources)
+  sources = stages.Run('minify',
+                       lambda lines: tint_js2c.CompressScript(lines, False,
+                                                              minify)[0],
+                       sources)
+  data = stages.Run('ToCArray',
+                    lambda lines: tint_js2c.Serialize(lines, 'array'),
+                    sources)
+  stages.Run('write', WriteData(output), [data])
+  return stages
+
+
+# The regular expressions V8's js2c.py filtered scripts with, before
+# FilterScript() went over them in one pass.
+BASELINE_PATTERNS = [
+  (re.compile(r'//.*\n'), '\n'),
+  (re.compile(r'/\*.*?\*/', re.DOTALL), ''),
+  (re.compile(r'\s+\n+'), '\n'),
+]
+BASELINE_SEARCHES = [
+  re.compile(r'macro\s+([a-zA-Z0-9_]+)\s*\(([^)]*)\)\s*\n'),
+  re.compile(r'const\s+([a-zA-Z0-9_]+)\s*=\s*([^;\n]+)[;\n]'),
+  re.compile(r'\beval\s*\('),
+  re.compile(r'\bwith\s*\('),
+]
+
+
+def FilterBaseline(lines):
+  """Filter a script the way V8's js2c.py did, as a reference for 'filter'.
+
+  The generated modules have no inline macros or constants, so only the
+  searches for them are timed.
+  """
+  for (pattern, replacement) in BASELINE_PATTERNS:
+    lines = pattern.sub(replacement, lines)
+  for pattern in BASELINE_SEARCHES:
+    pattern.search(lines)
+  return lines
+
+
+def MeasureV8Stages(files, minify, output):
+  import v8_js2c_fix
+  import jsmin
+  stages = Stages()
+  (constants, macros) = v8_js2c_fix.ReadMacros(
+      v8_js2c_fix.ReadFile(files[0]))
+  constants = v8_js2c_fix.ConstantExpander(constants)
+  macros = v8_js2c_fix.MacroExpander(macros)
+  sources = stages.Run('read', v8_js2c_fix.ReadFile, files[1:])
+  sources = stages.Run('constants', constants.Expand, sources)
+  sources = stages.Run('macros', macros.Expand, sources)
+  stages.Run('filter_baseline', FilterBaseline, sources)
+  sources = stages.Run('filter', v8_js2c_fix.FilterScript, sources)
+  sources = stages.Run('jsmin',
+                       lambda lines: jsmin.JavaScriptMinifier().JSMinify(lines),
+                       sources)
+  data = stages.Run('ToCArray', v8_js2c_fix.ToCArray, [''.join(sources)])
+  stages.Run('write', WriteData(output), [data])
+  return stages
+
+
+def WriteData(filename):
+  def write(data):
+    output = open(filename, 'w')
+    output.write(',\n'.join(data))
+    output.close()
+  return write
+
+
+def RunTint(files, minify, output):
+  import tint_js2c
+  tint_js2c.JS2C(files, [output], format='array', minify=minify)
+
+
+def RunV8(files, minify, output):
+  import v8_js2c_fix
+  v8_js2c_fix.JS2C(list(files), output, 'CORE', 'off', None, None)
+
+
+def Child(generator, mode, corpus, minify):
+  """Take one measurement, in a process of its own."""
+  sys.path.insert(0, TOOLS_DIR)
+  files = sorted(os.path.join(corpus, name) for name in os.listdir(corpus)
+                 if name.endswith('.js'))
+  files.insert(0, os.path.join(corpus, 'macros.py'))
+  directory = tempfile.mkdtemp()
+  output = os.path.join(directory, 'natives.h')
+  try:
+    if mode == 'stages':
+      measure = { 'tint': MeasureTintStages, 'v8': MeasureV8Stages }
+      stages = measure[generator](files, minify, output)
+      return dict((name, stages.times[name]) for name in stages.names)
+    run = { 'tint': RunTint, 'v8': RunV8 }
+    start = time.time()
+    run[generator](files, minify, output)
+    peak = js2c_common.PeakMemory()
+    return { 'total': time.time() - start, 'peak_kb': peak and peak[0] }
+  finally:
+    shutil.rmtree(directory)
+
+
+def Measure(generator, corpus, minify, repeat):
+  """Measure a generator over a corpus.
+
+  Returns:
+    A dict of the time of every stage, the 'total' time and the 'peak_kb'
+    memory, each the lowest over all repetitions.
+  """
+  result = {}
+  for i in xrange(repeat):
+    for mode in ('stages', 'total'):
+      output = subprocess.check_output([
+          sys.executable, os.path.abspath(__file__), '--child', generator,
+          mode, corpus, '--minify', minify])
+      for (name, value) in json.loads(output).items():
+        if value is not None:
+          result[name] = min(result.get(name, value), value)
+  return result
+
+
+def Compare(baseline, results, threshold):
+  """List everything in results that got worse than in baseline."""
+  regressions = []
+  for key in sorted(results):
+    if key not in baseline:
+      continue
+    for (name, value) in sorted(results[key].items()):
+      old = baseline[key].get(name)
+      if old is None:
+        continue
+      floor = MIN_MEMORY_DELTA if name == 'peak_kb' else MIN_TIME_DELTA
+      if value > old * (1 + threshold) and value - old > floor:
+        regressions.append('%s %s: %.3f -> %.3f (+%.0f%%)' % (
+            key, name, old, value, (value / old - 1) * 100 if old else 100))
+  return regressions
+
+
+def MemoryGrowth(results, sizes, limit):
+  """List the streaming generators whose peak memory grew with the corpus."""
+  (small, large) = (min(sizes), max(sizes))
+  failures = []
+  for generator in STREAMING_GENERATORS:
+    peaks = [results.get('%s/%s' % (generator, FormatSize(size)), {}).get(
+        'peak_kb') for size in (small, large)]
+    if small == large or None in peaks:
+      continue
+    if (peaks[1] - peaks[0]) * 1024 > limit * (large - small):
+      failures.append('%s peak: %iK at %s -> %iK at %s' % (
+          generator, peaks[0], FormatSize(small), peaks[1], FormatSize(large)))
+  return failures
+
+
+def PrintResults(results):
+  for key in sorted(results):
+    result = results[key]
+    stages = ' '.join('%s=%.3fs' % (name, result[name])
+                      for name in ('read', 'constants', 'macros',
+                                   'filter_baseline', 'filter', 'jsmin',
+                                   'minify', 'ToCArray', 'write')
+                      if name in result)
+    peak = result.get('peak_kb')
+    print '%-10s total=%.3fs %s peak=%s' % (
+        key, result['total'], stages,
+        '%iK' % peak if peak is not None else 'n/a')
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.set_usage('js2c_benchmark.py [options]')
+  parser.add_option('--sizes', action='store', default='100K,1M,10M',
+                    help='comma separated corpus sizes, up to 50M.')
+  parser.add_option('--generators', action='store', default='tint,v8',
+                    help='comma separated generators: tint, v8.')
+  parser.add_option('--constant-density', action='store', type='float',
+                    default=0.2, dest='constant_density',
+                    help='fraction of lines that use a constant.')
+  parser.add_option('--macro-density', action='store', type='float',
+                    default=0.1, dest='macro_density',
+                    help='fraction of lines that call a macro.')
+  parser.add_option('--minify', action='store', default='whitespace',
+                    choices=['none', 'whitespace', 'full'],
+                    help='tint_js2c.py minify level to measure.')
+  parser.add_option('--repeat', action='store', type='int', default=3,
+                    help='number of runs to keep the fastest of.')
+  parser.add_option('--corpus-dir', action='store', dest='corpus_dir',
+                    help='directory to keep the corpora in between runs.')
+  parser.add_option('--save', action='store',
+                    help='file to write the results to, as a baseline.')
+  parser.add_option('--compare', action='store',
+                    help='baseline file to compare the results with.')
+  parser.add_option('--threshold', action='store', type='float', default=0.1,
+                    help='fraction a result may be worse than the baseline.')
+  parser.add_option('--max-memory-growth', action='store', type='float',
+                    dest='max_memory_growth',
+                    help='fraction of the growth of the corpus the peak '
+                         'memory of a streaming generator may grow by.')
+  parser.add_option('--child', action='store_true', help=optparse.SUPPRESS_HELP)
+  (options, args) = parser.parse_args()
+
+  if options.child:
+    print json.dumps(Child(args[0], args[1], args[2], options.minify))
+    return 0
+
+  generators = options.generators.split(',')
+  for generator in generators:
+    if generator not in GENERATORS:
+      parser.error('unknown generator %s' % generator)
+  sizes = map(ParseSize, options.sizes.split(','))
+  corpus_dir = options.corpus_dir or tempfile.mkdtemp()
+  results = {}
+  try:
+    for size in sizes:
+      corpus = os.path.join(corpus_dir, 'corpus_%s_%g_%g' % (
+          FormatSize(size), options.constant_density, options.macro_density))
+      if not os.path.isdir(corpus):
+        GenerateCorpus(corpus, size, options.constant_density,
+                       options.macro_density)
+      for generator in generators:
+        key = '%s/%s' % (generator, FormatSize(size))
+        results[key] = Measure(generator, corpus, options.minify,
+                               options.repeat)
+  finally:
+    if not options.corpus_dir:
+      shutil.rmtree(corpus_dir)
+  PrintResults(results)
+
+  if options.save:
+    output = open(options.save, 'w')
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.close()
+  status = 0
+  if options.compare:
+    baseline = open(options.compare)
+    regressions = Compare(json.load(baseline), results, options.threshold)
+    baseline.close()
+    if regressions:
+      print 'Regressions beyond %.0f%%:' % (options.threshold * 100)
+      for regression in regressions:
+        print '  ' + regression
+      status = 1
+  if options.max_memory_growth is not None:
+    failures = MemoryGrowth(results, sizes, options.max_memory_growth)
+    if failures:
+      print 'Peak memory grew by more than %.0f%% of the corpus:' % (
+          options.max_memory_growth * 100)
+      for failure in failures:
+        print '  ' + failure
+      status = 1
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+#
+# Code shared by tint_js2c.py and v8_js2c_fix.py, which turn JavaScript
+# sources into C headers in much the same way.
+
+import json
+import re
+import sys
+import time
+
+
+# The lookup templates are unindented, for the generators to Indent() to
+# wherever they declare them. The bodies of the lookups go in a function
+# that takes the id to look up as name.
+NATIVE_HASH_FUNCTION = """\
+static inline uint32_t NativeHash(uint32_t seed, const char* name) {
+  uint32_t hash = 2166136261u ^ seed;
+  for (; *name; name++)
+    hash = (hash ^ static_cast<unsigned char>(*name)) * 16777619u;
+  hash = (hash ^ (hash >> 16)) * 0x85ebca6bu;
+  hash = (hash ^ (hash >> 13)) * 0xc2b2ae35u;
+  return hash ^ (hash >> 16);
+}
+
+// Minimal perfect hash over the ids in %(table)s. The first hash picks a
+// displacement, which either is the slot (when negative) or seeds a second
+// hash that leads to it.
+static const int native_hash_displacements[] = { %(displacements)s };
+static const uint16_t native_hash_slots[] = { %(slots)s };
+"""
+
+NATIVE_HASH_LOOKUP = """\
+int displacement =
+    native_hash_displacements[NativeHash(0, name) %% %(count)i];
+uint32_t slot = displacement < 0 ? -displacement - 1 :
+    NativeHash(displacement, name) %% %(count)i;
+int index = native_hash_slots[slot];
+return strcmp(%(id)s, name) == 0 ? index : -1;
+"""
+
+NATIVE_SEARCH_TABLE = """\
+// Indices of %(table)s in the order of their ids.
+static const uint16_t native_sorted_indices[] = { %(indices)s };
+"""
+
+NATIVE_SEARCH_LOOKUP = """\
+int low = 0;
+int high = %(count)i - 1;
+while (low <= high) {
+  int middle = (low + high) / 2;
+  int index = native_sorted_indices[middle];
+  int order = strcmp(name, %(id)s);
+  if (order == 0) return index;
+  if (order < 0)
+    high = middle - 1;
+  else
+    low = middle + 1;
+}
+return -1;
+"""
+
+
+def Indent(text, prefix):
+  return ''.join(prefix + line if line.strip() else line
+                 for line in text.splitlines(True))
+
+
+def NativeHash(seed, name):
+  # 32 bit FNV-1a, with the seed folded into the offset basis, and the
+  # finalizer of MurmurHash3 so that the low bits depend on the seed too.
+  hash = 2166136261 ^ seed
+  for c in name:
+    hash = ((hash ^ ord(c)) * 16777619) & 0xffffffff
+  hash = ((hash ^ (hash >> 16)) * 0x85ebca6b) & 0xffffffff
+  hash = ((hash ^ (hash >> 13)) * 0xc2b2ae35) & 0xffffffff
+  return hash ^ (hash >> 16)
+
+
+def PerfectHash(names, max_displacement=1 << 16):
+  """Build a minimal perfect hash over distinct names.
+
+  Names are put in buckets by their unseeded hash. The biggest buckets go
+  first and get the smallest seed that moves all their names to free slots;
+  buckets of one name are then given a free slot outright.
+
+  Returns:
+    A tuple of the displacement of every bucket and the index in names of
+    the name in every slot, or None if no seed worked for some bucket.
+  """
+  count = len(names)
+  buckets = [[] for i in xrange(count)]
+  for (i, name) in enumerate(names):
+    buckets[NativeHash(0, name) % count].append(i)
+  displacements = [0] * count
+  slots = [None] * count
+  order = sorted(xrange(count), key=lambda b: -len(buckets[b]))
+  for b in order:
+    bucket = buckets[b]
+    if len(bucket) < 2:
+      break
+    for displacement in xrange(1, max_displacement):
+      taken = set()
+      for i in bucket:
+        slot = NativeHash(displacement, names[i]) % count
+        if slots[slot] is not None or slot in taken:
+          break
+        taken.add(slot)
+      else:
+        break
+    else:
+      return None
+    for i in bucket:
+      slots[NativeHash(displacement, names[i]) % count] = i
+    displacements[b] = displacement
+  free = [slot for slot in xrange(count) if slots[slot] is None]
+  for b in order:
+    if len(buckets[b]) == 1:
+      slot = free.pop()
+      slots[slot] = buckets[b][0]
+      displacements[b] = -slot - 1
+  return (displacements, slots)
+
+
+def IndexLookup(ids, table, id):
+  """Build a lookup of the index of a native by its id.
+
+  The lookup is a minimal perfect hash, or a binary search should no hash
+  be found. Ids that occur more than once resolve to the first of them, as
+  with a scan of the ids.
+
+  Args:
+    ids: The ids of the natives, in the order of their indices.
+    table: Name of the table of natives, for the comments.
+    id: C expression for the id of the native at index.
+
+  Returns:
+    A tuple of the tables to declare and the body of the lookup, unindented,
+    or None if there are no ids.
+  """
+  indices = {}
+  for (i, native_id) in enumerate(ids):
+    indices.setdefault(native_id, i)
+  names = sorted(indices)
+  if not names:
+    return None
+  d = { 'count': len(names), 'table': table, 'id': id }
+  perfect_hash = PerfectHash(names)
+  if perfect_hash:
+    (displacements, slots) = perfect_hash
+    d['displacements'] = ', '.join(map(str, displacements))
+    d['slots'] = ', '.join(str(indices[names[i]]) for i in slots)
+    return (NATIVE_HASH_FUNCTION % d, NATIVE_HASH_LOOKUP % d)
+  d['indices'] = ', '.join(str(indices[name]) for name in names)
+  return (NATIVE_SEARCH_TABLE % d, NATIVE_SEARCH_LOOKUP % d)
+
+
+def IsWordChar(c):
+  return c.isalnum() or c in '_$\\' or c >= '\x80'
+
+
+# Tokens of a script as far as the script filters go. A '/' that isn't a
+# comment and a '`' are only where regular expression literals and
+# templates may start, which depends on context, so ScanScript scans those
+# itself.
+SCRIPT_TOKEN_PATTERN = re.compile(r"""
+    (?P<space>[ \t\f\v\r]+)
+  | (?P<newline>\n)
+  | (?P<word>[A-Za-z0-9_$\\\x80-\xff]+)
+  | (?P<comment>//[^\n]*|/\*[\s\S]*?\*/)
+  | (?P<string>"(?:[^"\\\n]|\\[\s\S])*"|'(?:[^'\\\n]|\\[\s\S])*')
+  | (?P<slash>/)
+  | (?P<template>`)
+  | (?P<punctuator>\+\+|--|[\s\S])
+""", re.VERBOSE)
+
+REGEXP_PATTERN = re.compile(r'/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[A-Za-z]*')
+
+# Words after which a '/' starts a regular expression rather than a division.
+REGEXP_PRECEDING_WORDS = frozenset([
+  'case', 'delete', 'do', 'else', 'in', 'instanceof', 'new', 'of', 'return',
+  'throw', 'typeof', 'void', 'yield', 'await',
+])
+
+def RegExpAllowed(previous):
+  if previous is None:
+    return True
+  if previous in ('++', '--', ')', ']'):
+    return False
+  if IsWordChar(previous[0]):
+    return previous in REGEXP_PRECEDING_WORDS
+  return True
+
+
+def ScanTemplate(lines, pos):
+  # Returns the end of the template starting at pos; substitutions are
+  # scanned as scripts so that braces and backticks in them don't count.
+  end = len(lines)
+  pos = pos + 1
+  while pos < end:
+    c = lines[pos]
+    if c == '\\':
+      pos = pos + 2
+    elif c == '`':
+      return pos + 1
+    elif c == '$' and lines.startswith('${', pos):
+      pos = ScanScript(lines, pos + 2, True)[1]
+    else:
+      pos = pos + 1
+  return end
+
+
+def ScanScript(lines, pos=0, nested=False):
+  """Split a script into (kind, text) tokens.
+
+  The kinds are 'space', 'newline', 'comment', 'word', 'literal' for
+  strings, templates and regular expressions, and 'punctuator'.
+
+  Args:
+    lines: The script.
+    pos: Where to start scanning.
+    nested: Whether to stop after the '}' closing a template substitution.
+
+  Returns:
+    A tuple of the list of tokens and the position scanning stopped at.
+  """
+  tokens = []
+  append = tokens.append
+  previous = None
+  depth = 0
+  end = len(lines)
+  while pos < end:
+    # Most tokens come straight from the pattern; scanning starts over after
+    # every template and regular expression.
+    for match in SCRIPT_TOKEN_PATTERN.finditer(lines, pos):
+      kind = match.lastgroup
+      if kind == 'space' or kind == 'newline' or kind == 'comment':
+        append((kind, match.group()))
+        continue
+      if kind == 'template' or kind == 'slash' and RegExpAllowed(previous):
+        pos = match.start()
+        break
+      text = match.group()
+      if kind == 'string':
+        kind = 'literal'
+      elif kind == 'slash':
+        kind = 'punctuator'
+      elif kind == 'punctuator':
+        if text == '{':
+          depth = depth + 1
+        elif text == '}':
+          if nested and depth == 0:
+            return (tokens, match.end())
+          depth = depth - 1
+      append((kind, text))
+      previous = text
+    else:
+      break
+    if lines[pos] == '`':
+      stop = ScanTemplate(lines, pos)
+      kind = 'literal'
+    else:
+      match = (not lines.startswith('/*', pos) and
+               REGEXP_PATTERN.match(lines, pos))
+      if match:
+        stop = match.end()
+        kind = 'literal'
+      else:
+        stop = pos + 1
+        kind = 'punctuator'
+    text = lines[pos:stop]
+    append((kind, text))
+    previous = text
+    pos = stop
+  return (tokens, end)
+
+
+class StageStats:
+  """Records the wall time and sizes of the stages a module goes through."""
+  def __init__(self, stages=None):
+    self.stages = stages if stages is not None else []
+
+  def Add(self, name, start, input_bytes, output_bytes, **counts):
+    stage = {
+      'stage': name,
+      'time': time.time() - start,
+      'input_bytes': input_bytes,
+      'output_bytes': output_bytes,
+    }
+    stage.update(counts)
+    self.stages.append(stage)
+
+
+def PeakMemory():
+  """Peak resident memory of this process and of its finished children.
+
+  Returns:
+    A tuple of the two in kilobytes, or None where that isn't known.
+  """
+  try:
+    import resource
+  except ImportError:
+    return None
+  # Linux reports kilobytes, OS X bytes.
+  scale = 1024 if sys.platform == 'darwin' else 1
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+def WriteStats(filename, start, run, modules):
+  """Write the --stats report of a run.
+
+  Args:
+    filename: File to write the report to, as JSON.
+    start: Time the run started at.
+    run: List of StageStats stages of the run as a whole.
+    modules: List of dicts of the 'id' and the StageStats 'stages' of every
+        module, and whatever else the generator reports about it.
+  """
+  totals = {}
+  for module in modules:
+    for stage in module['stages']:
+      total = totals.setdefault(stage['stage'], {})
+      for (key, value) in stage.items():
+        if key != 'stage':
+          total[key] = total.get(key, 0) + value
+  peak = PeakMemory()
+  report = {
+    'total_time': time.time() - start,
+    'peak_memory_kb': peak and { 'self': peak[0], 'children': peak[1] },
+    'stages': totals,
+    'run': run,
+    'modules': modules,
+  }
+  output = open(filename, "w")
+  try:
+    json.dump(report, output, indent=2, sort_keys=True)
+  finally:
+    output.close()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Compares the native module lookup that tint_js2c.py generates against the
+# strcmp chain and the linear scan of natives[] it replaces. The lookups are
+# compiled with the host compiler and timed over every module id.
+#
+#   natives_lookup_benchmark.py [options] [node_natives.h]
+#
+# The ids are read from a generated node_natives.h, or made up with --count.
+
+import optparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from tint_js2c import NativeLookup
+
+CXX = os.environ.get('CXX', 'c++' if sys.platform == 'darwin' else 'g++')
+
+NATIVE_ID_PATTERN = re.compile(r'\{ "([^"]+)", \w+_native, ')
+
+BENCHMARK_TEMPLATE = """\
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <time.h>
+
+struct _native {
+  const char* name;
+};
+
+static const struct _native natives[] = { %(native_lines)s };
+static const int native_count = %(count)i;
+%(lookup)s
+static int GetChainIndex(const char* name) {
+%(chain_cases)s\
+  return -1;
+}
+
+static int GetScanIndex(const char* name) {
+  for (int i = 0; i < native_count; i++) {
+    if (strcmp(natives[i].name, name) == 0) return i;
+  }
+  return -1;
+}
+
+// Copies of the ids, so the compiler can't see the strings it looks up.
+static char* queries[%(count)i];
+static volatile int sink;
+
+static double Measure(int (*lookup)(const char*), long iterations) {
+  clock_t start = clock();
+  int sum = 0;
+  for (long i = 0; i < iterations; i++) {
+    for (int j = 0; j < native_count; j++) sum += lookup(queries[j]);
+  }
+  sink = sum;
+  double seconds = (double)(clock() - start) / CLOCKS_PER_SEC;
+  return seconds * 1e9 / ((double)iterations * native_count);
+}
+
+int main(int argc, char** argv) {
+  long iterations = atol(argv[1]);
+  for (int i = 0; i < native_count; i++) {
+    queries[i] = strdup(natives[i].name);
+    int expected = GetScanIndex(queries[i]);
+    if (GetChainIndex(queries[i]) != expected ||
+        GetNativeIndex(queries[i]) != expected) {
+      fprintf(stderr, "lookups disagree on %%s\\n", queries[i]);
+      return 1;
+    }
+  }
+  if (GetNativeIndex("") != -1 || GetNativeIndex("no such native") != -1) {
+    fprintf(stderr, "lookup found a native that doesn't exist\\n");
+    return 1;
+  }
+  printf("strcmp chain:  %%8.2f ns/lookup\\n", Measure(GetChainIndex, iterations));
+  printf("natives scan:  %%8.2f ns/lookup\\n", Measure(GetScanIndex, iterations));
+  printf("generated:     %%8.2f ns/lookup\\n", Measure(GetNativeIndex, iterations));
+  return 0;
+}
+"""
+
+CHAIN_CASE = """\
+  if (strcmp(name, "%(id)s") == 0) return %(i)i;
+"""
+
+
+def ReadNativeIds(filename):
+  header = open(filename)
+  ids = NATIVE_ID_PATTERN.findall(header.read())
+  header.close()
+  return ids
+
+
+def MakeNativeIds(count):
+  # Shaped like the real ones: shared prefixes make strcmp work for it.
+  return ['internal/module_%i' % i if i % 3 else 'module_%i' % i
+          for i in xrange(count)]
+
+
+def Benchmark(ids, iterations, cxx, flags):
+  source = BENCHMARK_TEMPLATE % {
+    'count': len(ids),
+    'native_lines': ''.join('{ "%s" }, ' % id for id in ids),
+    'lookup': NativeLookup(ids),
+    'chain_cases': ''.join(CHAIN_CASE % { 'id': id, 'i': i }
+                           for (i, id) in enumerate(ids)),
+  }
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, 'benchmark.cc')
+    program = os.path.join(directory, 'benchmark')
+    output = open(filename, 'w')
+    output.write(source)
+    output.close()
+    subprocess.check_call([cxx] + flags + [filename, '-o', program])
+    return subprocess.call([program, str(iterations)])
+  finally:
+    shutil.rmtree(directory)
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.set_usage('natives_lookup_benchmark.py [options] [node_natives.h]')
+  parser.add_option('--count', action='store', type='int', default=150,
+                    help='number of made up ids when no header is given.')
+  parser.add_option('--iterations', action='store', type='int',
+                    default=20000,
+                    help='number of times to look up every id.')
+  parser.add_option('--cxx', action='store', default=CXX,
+                    help='compiler to build the benchmark with.')
+  parser.add_option('--cflags', action='store', default='-O2',
+                    help='flags to build the benchmark with.')
+  (options, args) = parser.parse_args()
+  if args:
+    ids = ReadNativeIds(args[0])
+  else:
+    ids = MakeNativeIds(options.count)
+  if not ids:
+    parser.error('no native ids found')
+  print '%i natives, %i lookups each' % (len(ids), options.iterations)
+  sys.stdout.flush()
+  return Benchmark(ids, options.iterations, options.cxx,
+                   options.cflags.split())
+
+
+if __name__ == '__main__':
+  sys.exit(main())
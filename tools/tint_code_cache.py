@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Produces V8 code caches for the natives embedded in a tint binary, for
+# tint_js2c.py --code-cache to embed in the next build:
+#
+#   tint_code_cache.py build/xcode/Release/tint build/code_cache
+#   GYP_DEFINES=tint_code_cache=build/code_cache ./tools.sh config
+#   ./tools.sh build
+#
+# The binary compiles every native the way NativeModule does and writes the
+# cache V8 produces for it, along with a manifest.json keyed by module id.
+# Each cache is recorded with the SHA-1 of the source it was made for, so
+# tint_js2c.py embeds it only while the module stays the same.
+#
+# NativeModule, as patched by build/node.diff, compiles the natives with the
+# embedded caches as cachedData. The runtime leaves them out if its V8 isn't
+# the version in the manifest, and stops passing them once V8 rejects one,
+# as it does caches made with other flags.
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+PRODUCER = """\
+var crypto = require('crypto');
+var fs = require('fs');
+var path = require('path');
+var vm = require('vm');
+var Module = require('module');
+
+// Run as a plain script by node.cc rather than through NativeModule.
+var skip = { 'internal/bootstrap_node': true };
+
+var directory = process.argv[2];
+var natives = process.binding('natives');
+var caches = {};
+Object.keys(natives).sort().forEach(function(id) {
+  var source = natives[id];
+  if (skip[id] || typeof source !== 'string') return;
+  var script;
+  try {
+    script = new vm.Script(Module.wrap(source), {
+      filename: id + '.js',
+      produceCachedData: true
+    });
+  } catch (e) {
+    // Not a module NativeModule compiles; leave it without a cache.
+    return;
+  }
+  if (!script.cachedDataProduced) return;
+  var file = id.replace(/[\\/-]/g, '_') + '.cache';
+  fs.writeFileSync(path.join(directory, file), script.cachedData);
+  caches[id] = {
+    hash: crypto.createHash('sha1').update(source, 'utf8').digest('hex'),
+    file: file
+  };
+});
+fs.writeFileSync(path.join(directory, 'manifest.json'), JSON.stringify({
+  v8: process.versions.v8,
+  caches: caches
+}, null, 2));
+"""
+
+
+def ProduceCodeCaches(tint, directory):
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  temp = tempfile.mkdtemp()
+  try:
+    producer = os.path.join(temp, 'produce_code_cache.js')
+    output = open(producer, 'w')
+    output.write(PRODUCER)
+    output.close()
+    subprocess.check_call([tint, producer, os.path.abspath(directory)])
+  finally:
+    shutil.rmtree(temp)
+  manifest = open(os.path.join(directory, 'manifest.json'))
+  try:
+    return json.load(manifest)
+  finally:
+    manifest.close()
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.set_usage('tint_code_cache.py tint directory')
+  (options, args) = parser.parse_args()
+  if len(args) != 2:
+    parser.error('expected the tint binary and an output directory')
+  manifest = ProduceCodeCaches(args[0], args[1])
+  print 'Wrote code caches of %i natives for V8 %s to %s' % (
+      len(manifest['caches']), manifest['v8'], args[1])
+
+
+if __name__ == '__main__':
+  main()
@@ -36,30 +36,318 @@ from os.path import dirname
 import re
 import sys
 import string
+import hashlib
+import itertools
+import struct
+import zlib
+import filecmp
+import fnmatch
+import json
+import select
+import time
+import traceback
+import multiprocessing
+import optparse
+import cPickle as pickle
 
 sys.path.append(dirname(__file__) + "/../libraries/node/deps/v8/tools");
 import jsmin
+import js2c_common
 
 
 def ToCArray(filename, lines):
-  return ','.join(str(ord(c)) for c in lines)
+  return ','.join(map(str, bytearray(lines)))
 
 
-def CompressScript(lines, do_jsmin):
+# Longest piece of a string literal. MSVC rejects single literals of more
+# than 16K; gcc and clang don't care, but long lines make for slow diffs.
+C_STRING_CHUNK = 4096
+
+C_STRING_ESCAPES = dict((chr(c), '\\%03o' % c) for c in xrange(256))
+C_STRING_ESCAPES.update({
+  '\n': '\\n',
+  '\t': '\\t',
+  '"': '\\"',
+  '\\': '\\\\',
+  # Escaped so that no trigraph can ever be formed.
+  '?': '\\?',
+})
+C_STRING_SPECIAL = re.compile(r'[^\x20\x21\x23-\x3e\x40-\x5b\x5d-\x7e]')
+
+def EscapeCChar(match):
+  return C_STRING_ESCAPES[match.group()]
+
+
+def CStringPieces(lines):
+  # One literal per source line (and per C_STRING_CHUNK bytes of long
+  # lines); octal escapes are always three digits wide, so a piece never
+  # runs into the next one.
+  for line in lines.splitlines(True):
+    for start in xrange(0, len(line), C_STRING_CHUNK):
+      piece = line[start:start + C_STRING_CHUNK]
+      yield C_STRING_SPECIAL.sub(EscapeCChar, piece)
+
+
+def ToCString(lines):
+  return '"%s"' % '"\n    "'.join(CStringPieces(lines))
+
+
+def DefaultFormat():
+  # MSVC has no .incbin and caps string literals at 64K, which leaves it
+  # with arrays. Everyone else assembles the sources straight from disk.
+  if sys.platform in ('win32', 'cygwin'):
+    return 'array'
+  return 'incbin'
+
+
+def Serialize(lines, format):
+  if format == 'array':
+    return ToCArray(None, lines)
+  if format == 'string':
+    return ToCString(lines)
+  # incbin data is written out as is.
+  return None
+
+
+# Bytes of a source serialized at a time when streaming the header.
+SERIALIZE_CHUNK = 64 * 1024
+
+def SerializeChunks(lines, format):
+  """Serialize lines piece by piece.
+
+  Yields:
+    Pieces of text that together are Serialize(lines, format), each made
+    from at most SERIALIZE_CHUNK bytes of lines.
+  """
+  if format == 'array':
+    for start in xrange(0, len(lines), SERIALIZE_CHUNK):
+      if start > 0:
+        yield ','
+      yield ToCArray(None, lines[start:start + SERIALIZE_CHUNK])
+  elif format == 'string':
+    yield '"'
+    first = True
+    for piece in CStringPieces(lines):
+      if not first:
+        yield '"\n    "'
+      yield piece
+      first = False
+    yield '"'
+
+
+def CompressSource(lines, compression):
+  """Compress the source of a single module.
+
+  Returns:
+    A tuple of the codec the module is stored with and its bytes. Modules
+    that don't get any smaller are stored as they are.
+  """
+  if compression == 'deflate':
+    compressed = zlib.compress(lines, 9)
+    if len(compressed) < len(lines):
+      return ('NATIVE_CODEC_DEFLATE', compressed)
+  return ('NATIVE_CODEC_NONE', lines)
+
+
+def WriteIfChanged(filename, contents):
+  try:
+    if ReadFile(filename) == contents:
+      return
+  except IOError:
+    pass
+  # Write the new contents next to the file and move them over it, so that
+  # readers see either the old or the new file, never a part of it.
+  temp = "%s.%d.tmp" % (filename, os.getpid())
+  output = open(temp, "wb")
+  try:
+    output.write(contents)
+  finally:
+    output.close()
+  ReplaceFile(temp, filename)
+
+
+def ReplaceFile(temp, filename):
+  try:
+    os.rename(temp, filename)
+  except OSError:
+    # Windows won't rename over an existing file.
+    os.remove(filename)
+    os.rename(temp, filename)
+
+
+def ReplaceFileIfChanged(temp, filename):
+  # An unchanged file keeps its mtime, so that ninja's restat doesn't
+  # rebuild everything that includes it.
+  if os.path.exists(filename) and filecmp.cmp(temp, filename, shallow=False):
+    os.remove(temp)
+  else:
+    ReplaceFile(temp, filename)
+
+
+def EscapeDepfilePath(path):
+  path = path.replace('\\', '/').replace('$', '$$')
+  return path.replace(' ', '\\ ').replace('#', '\\#')
+
+
+def WriteDepfile(filename, target, dependencies):
+  """Write a Makefile style depfile of target for ninja or make."""
+  lines = [EscapeDepfilePath(target) + ':']
+  lines.extend(EscapeDepfilePath(dependency) for dependency in dependencies)
+  WriteIfChanged(filename, ' \\\n  '.join(lines) + '\n')
+
+
+def CompressScript(lines, do_jsmin, minify='none'):
+  """Compress a script.
+
+  Returns:
+    A tuple of the compressed script and a list of (generated line,
+    generated column, original line, original column) segments mapping it
+    back to the source, or None if every line stayed where it was.
+  """
   # If we're not expecting this code to be user visible, we can run it through
   # a more aggressive minifier.
   if do_jsmin:
-    minifier = JavaScriptMinifier()
-    return minifier.JSMinify(lines)
+    minifier = jsmin.JavaScriptMinifier()
+    return (minifier.JSMinify(lines), None)
 
   # Remove stuff from the source that we don't want to appear when
   # people print the source code using Function.prototype.toString().
   # Note that we could easily compress the scripts mode but don't
   # since we want it to remain readable.
-  #lines = re.sub('//.*\n', '\n', lines) # end-of-line comments
-  #lines = re.sub(re.compile(r'/\*.*?\*/', re.DOTALL), '', lines) # comments.
-  #lines = re.sub('\s+\n+', '\n', lines) # trailing whitespace
-  return lines
+  if minify != 'none':
+    return MinifyScript(lines, minify)
+  return (lines, None)
+
+
+def NeedsSpace(left, right):
+  # Whether dropping the space between two tokens would change them.
+  a = left[-1]
+  b = right[0]
+  if js2c_common.IsWordChar(a) and js2c_common.IsWordChar(b):
+    return True
+  if a == b and a in '+-/':
+    return True
+  if a.isdigit() and b == '.':
+    return True
+  return (a, b) in (('/', '*'), ('<', '!'), ('-', '>'))
+
+
+def MinifyScript(lines, level):
+  """Strip comments and whitespace from a script.
+
+  At the 'whitespace' level every line break is kept, so line numbers don't
+  change. At the 'full' level blank lines and spaces that separate nothing
+  are removed as well. Strings, templates and regular expressions are
+  copied verbatim.
+
+  Returns:
+    A tuple of the minified script and its source map segments.
+  """
+  tokens = js2c_common.ScanScript(lines)[0]
+  output = []
+  segments = []
+  def mark(generated_line, generated_column, line, column):
+    # Only start a segment where the offset to the original changes.
+    if segments:
+      (last_line, last_column, last_source_line, last_source_column) = (
+          segments[-1])
+      if (last_line == generated_line and last_source_line == line and
+          last_source_column - last_column == column - generated_column):
+        return
+    segments.append((generated_line, generated_column, line, column))
+
+  generated_line = generated_column = 0
+  line = column = 0
+  newlines = 0
+  space = False
+  previous = None
+  for (kind, text) in tokens:
+    if kind in ('space', 'newline', 'comment'):
+      count = text.count('\n')
+      if count:
+        newlines = newlines + count
+      else:
+        space = True
+    else:
+      if level == 'full' and newlines:
+        newlines = 1 if previous is not None else 0
+      if newlines:
+        output.append('\n' * newlines)
+        generated_line = generated_line + newlines
+        generated_column = 0
+      elif space and previous is not None:
+        if level == 'whitespace' or NeedsSpace(previous, text):
+          output.append(' ')
+          generated_column = generated_column + 1
+      newlines = 0
+      space = False
+      mark(generated_line, generated_column, line, column)
+      output.append(text)
+      count = text.count('\n')
+      if count:
+        # Multi-line literals are copied as they are, line by line.
+        for i in xrange(1, count + 1):
+          mark(generated_line + i, 0, line + i, 0)
+        generated_line = generated_line + count
+        generated_column = len(text) - text.rindex('\n') - 1
+      else:
+        generated_column = generated_column + len(text)
+      previous = text
+    count = text.count('\n')
+    if count:
+      line = line + count
+      column = len(text) - text.rindex('\n') - 1
+    else:
+      column = column + len(text)
+  if newlines:
+    output.append('\n' if level == 'full' else '\n' * newlines)
+  return (''.join(output), segments)
+
+
+BASE64_DIGITS = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                 '0123456789+/')
+
+def EncodeVLQ(value):
+  value = ((-value) << 1) | 1 if value < 0 else value << 1
+  result = []
+  while True:
+    digit = value & 31
+    value = value >> 5
+    if value:
+      digit = digit | 32
+    result.append(BASE64_DIGITS[digit])
+    if not value:
+      return ''.join(result)
+
+
+def SourceMap(filename, lines, segments):
+  """Build a version 3 source map from the segments of a module.
+
+  Modules that weren't minified map every line to itself.
+  """
+  if segments is None:
+    segments = [(i, 0, i, 0) for i in xrange(lines.count('\n') + 1)]
+  mappings = []
+  fields = []
+  generated_line = 0
+  last = (0, 0, 0)
+  for (line, column, source_line, source_column) in segments:
+    while generated_line < line:
+      mappings.append(','.join(fields))
+      fields = []
+      generated_line = generated_line + 1
+      last = (0, last[1], last[2])
+    fields.append(EncodeVLQ(column - last[0]) + 'A' +
+                  EncodeVLQ(source_line - last[1]) +
+                  EncodeVLQ(source_column - last[2]))
+    last = (column, source_line, source_column)
+  mappings.append(','.join(fields))
+  return {
+    'version': 3,
+    'sources': [filename.replace('\\', '/')],
+    'names': [],
+    'mappings': ';'.join(mappings),
+  }
 
 
 def ReadFile(filename):
@@ -97,55 +385,163 @@ def ParseValue(string):
     return string
 
 
+class ConstantExpander:
+  """Substitutes a set of constants in a single pass over a file.
+
+  All constant names are matched as whole words by one regular expression,
+  so a constant never replaces part of a longer identifier. Constants used
+  in the values of other constants are resolved up front.
+  """
+  def __init__(self, constants):
+    self.values = {}
+    self.pattern = None
+    self.expansions = 0
+    if constants:
+      names = '|'.join(re.escape(name) for name in sorted(constants))
+      self.pattern = re.compile(r'\b(%s)\b' % names)
+      for name in sorted(constants):
+        self.values[name] = self.Resolve(constants, name, ())
+
+  def Resolve(self, constants, name, active):
+    if name in self.values:
+      return self.values[name]
+    active = active + (name,)
+    def substitute(match):
+      other = match.group()
+      if other in active:
+        return other
+      return self.Resolve(constants, other, active)
+    return self.pattern.sub(substitute, str(constants[name]))
+
+  def Expand(self, lines):
+    if self.pattern is None:
+      return lines
+    (lines, count) = self.pattern.subn(
+        lambda match: self.values[match.group()], lines)
+    self.expansions = self.expansions + count
+    return lines
+
+
 def ExpandConstants(lines, constants):
-  for key, value in constants.items():
-    lines = lines.replace(key, str(value))
-  return lines
+  return ConstantExpander(constants).Expand(lines)
+
+
+# Characters that matter when scanning the arguments of a macro call.
+MACRO_ARGUMENT_PATTERN = re.compile(r'[,(){}\[\]]')
+
+def ParseMacroArguments(lines, start):
+  """Split the arguments of the macro call whose '(' ends at start.
+
+  Commas only separate arguments at the outermost nesting level.
+
+  Returns:
+    A tuple of the list of (unstripped) arguments and the position just past
+    the closing parenthesis.
+  """
+  height = 1
+  args = []
+  last = start
+  for match in MACRO_ARGUMENT_PATTERN.finditer(lines, start):
+    c = match.group()
+    if c == ',':
+      if height == 1:
+        args.append(lines[last:match.start()])
+        last = match.end()
+    elif c in '({[':
+      height = height + 1
+    else:
+      height = height - 1
+      if height == 0:
+        args.append(lines[last:match.start()])
+        return (args, match.end())
+  # An unterminated call swallows the rest of the file.
+  args.append(lines[last:len(lines) - 1])
+  return (args, len(lines))
+
+
+class MacroExpander:
+  """Expands the calls to a set of macros in a single scan over a file.
+
+  All macro names are matched by one regular expression. Arguments are
+  expanded before they are substituted, and the expansion of a call is
+  expanded again with all macros except the ones it came from.
+  """
+  def __init__(self, macros):
+    self.macros = macros
+    self.pattern = None
+    self.expansions = 0
+    if macros:
+      names = '|'.join(re.escape(name) for name in sorted(macros))
+      self.pattern = re.compile(r'\b(%s)\(' % names)
+
+  def Expand(self, lines, active=()):
+    if self.pattern is None:
+      return lines
+    result = []
+    last = 0
+    match = self.pattern.search(lines)
+    while match is not None:
+      name = match.group(1)
+      if name in active:
+        match = self.pattern.search(lines, match.end())
+        continue
+      macro = self.macros[name]
+      (args, end) = ParseMacroArguments(lines, match.end())
+      values = [self.Expand(arg.strip(), active) for arg in args]
+      expansion = macro.expand(dict(zip(macro.args, values)))
+      self.expansions = self.expansions + 1
+      result.append(lines[last:match.start()])
+      result.append(self.Expand(expansion, active + (name,)))
+      last = end
+      match = self.pattern.search(lines, end)
+    result.append(lines[last:])
+    return ''.join(result)
 
 
 def ExpandMacros(lines, macros):
-  for name, macro in macros.items():
-    start = lines.find(name + '(', 0)
-    while start != -1:
-      # Scan over the arguments
-      assert lines[start + len(name)] == '('
-      height = 1
-      end = start + len(name) + 1
-      last_match = end
-      arg_index = 0
-      mapping = { }
-      def add_arg(str):
-        # Remember to expand recursively in the arguments
-        replacement = ExpandMacros(str.strip(), macros)
-        mapping[macro.args[arg_index]] = replacement
-      while end < len(lines) and height > 0:
-        # We don't count commas at higher nesting levels.
-        if lines[end] == ',' and height == 1:
-          add_arg(lines[last_match:end])
-          last_match = end + 1
-        elif lines[end] in ['(', '{', '[']:
-          height = height + 1
-        elif lines[end] in [')', '}', ']']:
-          height = height - 1
-        end = end + 1
-      # Remember to add the last match.
-      add_arg(lines[last_match:end-1])
-      result = macro.expand(mapping)
-      # Replace the occurrence of the macro with the expansion
-      lines = lines[:start] + result + lines[end:]
-      start = lines.find(name + '(', start)
-  return lines
+  return MacroExpander(macros).Expand(lines)
+
+
+def ProcessSource(lines, constants, macros, minify='none', stats=None):
+  if stats is None:
+    stats = js2c_common.StageStats()
+  do_jsmin = lines.find('// jsminify this file, js2c: jsmin') != -1
+  start = time.time()
+  count = constants.expansions
+  expanded = constants.Expand(lines)
+  stats.Add('constants', start, len(lines), len(expanded),
+            expansions=constants.expansions - count)
+  lines = expanded
+  start = time.time()
+  count = macros.expansions
+  expanded = macros.Expand(lines)
+  stats.Add('macros', start, len(lines), len(expanded),
+            expansions=macros.expansions - count)
+  lines = expanded
+  start = time.time()
+  (minified, segments) = CompressScript(lines, do_jsmin, minify)
+  stats.Add('minify', start, len(lines), len(minified))
+  return (minified, segments)
 
 
 class TextMacro:
   def __init__(self, args, body):
     self.args = args
     self.body = body
+    # Split the body at every argument name up front; odd entries of the
+    # template are the argument slots.
+    names = sorted(set(arg for arg in args if arg),
+                   key=lambda name: (-len(name), name))
+    if names:
+      pattern = re.compile('(%s)' % '|'.join(map(re.escape, names)))
+      self.template = pattern.split(body)
+    else:
+      self.template = [body]
   def expand(self, mapping):
-    result = self.body
-    for key, value in mapping.items():
-        result = result.replace(key, value)
-    return result
+    result = list(self.template)
+    for i in xrange(1, len(result), 2):
+      result[i] = mapping.get(result[i], result[i])
+    return ''.join(result)
 
 class PythonMacro:
   def __init__(self, args, fun):
@@ -194,34 +590,822 @@ def ReadMacros(lines):
   return (constants, macros)
 
 
+# Macros, output options and module cache of the current process, set up by
+# InitWorker. Macros can't be pickled (python macros are lambdas), so every
+# worker parses them itself; with --watch they are parsed again only when the
+# macro files change.
+worker_macro_lines = None
+worker_macros = None
+worker_options = None
+worker_cache = None
+
+def InitWorker(macro_lines, options, cache=None):
+  global worker_macro_lines, worker_macros, worker_options, worker_cache
+  if macro_lines != worker_macro_lines:
+    (consts, macros) = ReadMacros(macro_lines)
+    worker_macros = (ConstantExpander(consts), MacroExpander(macros))
+    worker_macro_lines = macro_lines
+  worker_options = options
+  worker_cache = cache
+
+
+def ProcessModuleWorker(lines):
+  (constants, macros) = worker_macros
+  stats = js2c_common.StageStats()
+  (lines, segments) = ProcessSource(lines, constants, macros,
+                                    worker_options['minify'], stats)
+  start = time.time()
+  (codec, payload) = CompressSource(lines, worker_options['compression'])
+  stats.Add('compress', start, len(lines), len(payload))
+  return {
+    'lines': lines,
+    'segments': segments,
+    'codec': codec,
+    'payload': payload,
+    'stages': stats.stages,
+  }
+
+
+def ProcessModuleFileWorker(filename):
+  stats = js2c_common.StageStats()
+  start = time.time()
+  lines = ReadFile(filename)
+  stats.Add('read', start, len(lines), len(lines))
+  key = None
+  entry = None
+  if worker_cache:
+    key = worker_cache.Key(lines)
+    entry = worker_cache.Get(key)
+  cached = entry is not None
+  if not cached:
+    entry = ProcessModuleWorker(lines)
+    stats.stages.extend(entry['stages'])
+    if worker_cache:
+      # Cached modules keep their serialized source too, so that a run only
+      # serializes the modules that changed. That makes entries some four
+      # times the size of the payload in the array format.
+      format = worker_options['format']
+      if format != 'incbin':
+        start = time.time()
+        entry['serialized'] = (format,
+                               list(SerializeChunks(entry['payload'], format)))
+        stats.Add('serialize', start, len(entry['payload']),
+                  sum(map(len, entry['serialized'][1])))
+      worker_cache.Put(key, entry)
+  return {
+    'key': key,
+    'cached': cached,
+    'entry': entry,
+    'stages': stats.stages,
+  }
+
+
+def ProcessModules(filenames, macro_lines, options, jobs, cache=None):
+  """Read and expand modules, one after the other.
+
+  Args:
+    filenames: List of module files.
+    macro_lines: Lines of all *macros.py files.
+    options: Dict of the output 'format', 'minify' level and 'compression'.
+    jobs: Number of worker processes to use; 1 processes serially.
+    cache: ModuleCache to look modules up in and store them in, if any.
+
+  Yields:
+    A dict per module, in the order of filenames, with its cache 'key',
+    whether it was 'cached', the StageStats 'stages' it went through and
+    the 'entry' itself: the expanded 'lines', their source map 'segments',
+    the 'codec' and 'payload' stored in the binary and, when there is a
+    cache, the 'serialized' format and pieces of the payload.
+  """
+  if jobs > 1 and len(filenames) > 1:
+    pool = multiprocessing.Pool(min(jobs, len(filenames)), InitWorker,
+                                (macro_lines, options, cache))
+    try:
+      for result in pool.imap(ProcessModuleFileWorker, filenames, 1):
+        yield result
+    finally:
+      pool.close()
+      pool.join()
+    return
+  InitWorker(macro_lines, options, cache)
+  for filename in filenames:
+    yield ProcessModuleFileWorker(filename)
+
+
+# Names of the entries of a ModuleCache, SHA-1 hex digests.
+CACHE_ENTRY_PATTERN = re.compile(r'[0-9a-f]{40}$')
+
+class ModuleCache:
+  """Persistent cache of processed modules, one file per entry.
+
+  Entries are keyed by the SHA-1 of the module source, salted with the
+  contents of the macro files and of the scripts, so an entry is reused only
+  if expanding the module again would give the same result. Every salt gets
+  a directory of its own, so builds of other configurations that share the
+  cache keep their entries. With --watch the entries are also kept in
+  memory, which is all there is without --cache.
+  """
+  def __init__(self, directory, salt, memory=None):
+    if directory:
+      directory = os.path.join(directory, salt[:16])
+    self.directory = directory
+    self.salt = salt
+    self.memory = memory
+    self.used = set()
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def __getstate__(self):
+    # Workers only read and write the files; the parent keeps what they
+    # processed in memory with Remember().
+    state = dict(self.__dict__)
+    state['memory'] = None
+    return state
+
+  def Key(self, lines):
+    return hashlib.sha1(self.salt + lines).hexdigest()
+
+  def Get(self, key):
+    self.used.add(key)
+    if self.memory is not None and key in self.memory:
+      return self.memory[key]
+    if not self.directory:
+      return None
+    try:
+      file = open(os.path.join(self.directory, key), "rb")
+    except IOError:
+      return None
+    try:
+      value = pickle.load(file)
+    except Exception:
+      # A truncated or foreign entry is treated as a miss.
+      return None
+    finally:
+      file.close()
+    self.Remember(key, value)
+    return value
+
+  def Remember(self, key, value):
+    if self.memory is not None:
+      self.memory[key] = value
+
+  def Put(self, key, value):
+    self.Remember(key, value)
+    if not self.directory:
+      return
+    path = os.path.join(self.directory, key)
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    file = open(temp, "wb")
+    try:
+      pickle.dump(value, file, pickle.HIGHEST_PROTOCOL)
+    finally:
+      file.close()
+    try:
+      os.rename(temp, path)
+    except OSError:
+      # Windows won't rename over an existing file; the entry is already
+      # there with the same contents.
+      os.remove(temp)
+
+  def Prune(self):
+    # Drop entries for sources that are no longer part of the build so the
+    # cache doesn't grow with every edit. Only names of entries are looked
+    # at: the temporary files of a build writing to the same directory are
+    # left alone.
+    if self.memory is not None:
+      for key in list(self.memory):
+        if key not in self.used:
+          del self.memory[key]
+    if not self.directory:
+      return
+    for name in os.listdir(self.directory):
+      if CACHE_ENTRY_PATTERN.match(name) and name not in self.used:
+        try:
+          os.remove(os.path.join(self.directory, name))
+        except OSError:
+          # Another build pruned it first.
+          pass
+
+
+def GeneratorScript(module):
+  if module.endswith('.pyc'):
+    return module[:-1]
+  return module
+
+
+def CacheSalt(macro_lines, options):
+  salt = hashlib.sha1()
+  for module in (__file__, js2c_common.__file__):
+    salt.update(ReadFile(os.path.abspath(GeneratorScript(module))))
+  salt.update('\n'.join(macro_lines))
+  salt.update(repr(sorted(options.items())))
+  return salt.hexdigest()
+
+
 HEADER_TEMPLATE = """\
 #ifndef node_natives_h
 #define node_natives_h
-namespace node {
+%(includes)snamespace node {
 
+%(prelude)s\
 %(source_lines)s\
 
 struct _native {
   const char* name;
   const unsigned char* source;
   size_t source_len;
+  const char* hash;
+  int encoding;
+%(native_fields)s};
+
+static %(natives_qualifier)sstruct _native natives[] = { %(native_lines)s };
+%(native_lookup)s\
+%(native_helpers)s
+}
+#endif
+"""
+
+
+# hash is the SHA-1 of the source, for code caches to be keyed by.
+# encoding tells the ASCII sources, which the runtime can hand to V8 as
+# external one-byte strings as they are, from the UTF-8 ones, which V8 has
+# to be given transcoded.
+NATIVE_ENCODING_PRELUDE = """\
+enum {
+  NATIVE_ENCODING_ONE_BYTE = 0,
+  NATIVE_ENCODING_UTF8 = 1
 };
 
-static const struct _native natives[] = { %(native_lines)s };
+"""
+
+NATIVE_DECLARATION = """\
+  { "%(id)s", %(escaped_id)s_native, sizeof(%(escaped_id)s_native), "%(hash)s", %(encoding)s },
+"""
+
+# With --compression, source and source_len hold the bytes as stored and
+# GetNativeSource() returns the source itself.
+COMPRESSED_NATIVE_DECLARATION = """\
+  { "%(id)s", %(escaped_id)s_native, sizeof(%(escaped_id)s_native), "%(hash)s", %(encoding)s, %(raw_length)i, %(codec)s },
+"""
+
+# modules/Runtime/Natives.cc reads every native through GetNativeSource() and
+# GetNativeSourceLength(), which the helpers below define for each way the
+# natives can be stored.
+NATIVE_HELPERS = """
+static inline const unsigned char* GetNativeSource(size_t index) {
+  return natives[index].source;
+}
 
+static inline size_t GetNativeSourceLength(size_t index) {
+  return natives[index].source_len;
 }
+"""
+
+COMPRESSED_INCLUDES = """\
+#include <stdlib.h>
+#include "zlib.h"
+"""
+
+COMPRESSED_PRELUDE = """\
+enum {
+  NATIVE_CODEC_NONE = 0,
+  NATIVE_CODEC_DEFLATE = 1
+};
+
+"""
+
+COMPRESSED_NATIVE_FIELDS = """\
+  size_t raw_len;
+  int codec;
+"""
+
+COMPRESSED_NATIVE_HELPERS = """
+// Sources of the compressed natives, inflated when first asked for and kept
+// for the lifetime of the process. Natives are loaded on the main thread.
+static const unsigned char* native_sources[%(native_count)i];
+
+static inline const unsigned char* GetNativeSource(size_t index) {
+  const struct _native& native = natives[index];
+  if (native.codec == NATIVE_CODEC_NONE) return native.source;
+  if (native_sources[index] == NULL) {
+    unsigned char* source = new unsigned char[native.raw_len];
+    uLongf length = native.raw_len;
+    if (uncompress(source, &length, native.source, native.source_len) != Z_OK ||
+        length != native.raw_len) {
+      abort();
+    }
+    native_sources[index] = source;
+  }
+  return native_sources[index];
+}
+
+static inline size_t GetNativeSourceLength(size_t index) {
+  return natives[index].raw_len;
+}
+"""
+
+# natives[] entries without a source, which GetNativeSource() or
+# MapNativesBlob() fills in.
+EMPTY_NATIVE_DECLARATION = """\
+  { "%(id)s", NULL, 0, NULL, %(encoding)s },
+"""
+
+BLOB_INCLUDES = """\
+#include <stddef.h>
+#if defined(_WIN32)
+#include <windows.h>
+#else
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 #endif
 """
 
+BLOB_HELPERS = """
+// With --blob the sources are only in the blob, which the runtime maps with
+// MapNativesBlob() before any native is read. It is looked for under this
+// name next to the executable.
+#define TINT_NATIVES_BLOB "%(blob_name)s"
 
-NATIVE_DECLARATION = """\
-  { "%(id)s", %(escaped_id)s_native, sizeof(%(escaped_id)s_native) },
+// Layout of the blob written by tint_js2c.py --blob. Numbers are little
+// endian. The index of the blob is authoritative, so the blob can be
+// rebuilt with other sources for the same modules without a relink.
+static const char natives_blob_magic[8] = { %(magic)s };
+static const uint32_t natives_blob_version = %(version)i;
+
+struct _native_blob_header {
+  char magic[8];
+  uint32_t version;
+  uint32_t count;
+  uint32_t index_offset;
+  uint32_t data_offset;
+  uint32_t size;
+  uint32_t reserved;
+};
+
+struct _native_blob_entry {
+  uint32_t name_offset;
+  uint32_t name_length;
+  uint32_t source_offset;
+  uint32_t source_length;
+  uint32_t raw_length;
+  uint32_t codec;
+  uint32_t encoding;
+};
+
+static inline bool UnmapNativesBlob(const unsigned char* blob, size_t size) {
+#if defined(_WIN32)
+  UnmapViewOfFile(blob);
+#else
+  munmap(const_cast<unsigned char*>(blob), size);
+#endif
+  return false;
+}
+
+// Maps the blob at path read-only and points natives[] at the sources in
+// it. The mapping is kept for the lifetime of the process; replace the file
+// rather than rewriting it while tint runs. Returns false, leaving natives[]
+// without sources, if the blob can't be mapped, is of another version or
+// lacks any of the natives.
+static inline bool MapNativesBlob(const char* path) {
+  const unsigned char* blob;
+  size_t size;
+#if defined(_WIN32)
+  HANDLE file = CreateFileA(path, GENERIC_READ,
+                            FILE_SHARE_READ | FILE_SHARE_DELETE, NULL,
+                            OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, NULL);
+  if (file == INVALID_HANDLE_VALUE) return false;
+  size = GetFileSize(file, NULL);
+  HANDLE mapping = CreateFileMappingA(file, NULL, PAGE_READONLY, 0, 0, NULL);
+  CloseHandle(file);
+  if (mapping == NULL) return false;
+  blob = static_cast<const unsigned char*>(
+      MapViewOfFile(mapping, FILE_MAP_READ, 0, 0, 0));
+  CloseHandle(mapping);
+  if (blob == NULL) return false;
+#else
+  int fd = open(path, O_RDONLY);
+  if (fd < 0) return false;
+  struct stat info;
+  if (fstat(fd, &info) != 0 || info.st_size == 0) {
+    close(fd);
+    return false;
+  }
+  size = info.st_size;
+  void* mapping = mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
+  close(fd);
+  if (mapping == MAP_FAILED) return false;
+  blob = static_cast<const unsigned char*>(mapping);
+#endif
+  const struct _native_blob_header* header =
+      reinterpret_cast<const struct _native_blob_header*>(blob);
+  if (size < sizeof(*header) ||
+      memcmp(header->magic, natives_blob_magic, sizeof(header->magic)) != 0 ||
+      header->version != natives_blob_version || header->size != size ||
+      header->index_offset > size ||
+      header->count > (size - header->index_offset) /
+          sizeof(struct _native_blob_entry)) {
+    return UnmapNativesBlob(blob, size);
+  }
+  const struct _native_blob_entry* entries =
+      reinterpret_cast<const struct _native_blob_entry*>(
+          blob + header->index_offset);
+  // natives[] is only pointed at the blob once all of it checks out.
+  const size_t count = sizeof(natives) / sizeof(natives[0]);
+  const struct _native_blob_entry* matches[count];
+  for (size_t index = 0; index < count; index++) matches[index] = NULL;
+  int found = 0;
+  for (uint32_t i = 0; i < header->count; i++) {
+    const struct _native_blob_entry& entry = entries[i];
+    if (entry.name_offset >= size ||
+        entry.name_length >= size - entry.name_offset ||
+        entry.name_length + 42 > size - entry.name_offset ||
+        blob[entry.name_offset + entry.name_length] != '\\0' ||
+        blob[entry.name_offset + entry.name_length + 41] != '\\0' ||
+        entry.source_offset > size ||
+        entry.source_length > size - entry.source_offset) {
+      return UnmapNativesBlob(blob, size);
+    }
+    int index = GetNativeIndex(
+        reinterpret_cast<const char*>(blob + entry.name_offset));
+    if (index < 0 || matches[index] != NULL) continue;
+%(codec_check)s\
+    matches[index] = &entry;
+    found++;
+  }
+  if (found != %(count)i) return UnmapNativesBlob(blob, size);
+  for (size_t index = 0; index < count; index++) {
+    if (matches[index] == NULL) continue;
+    const struct _native_blob_entry& entry = *matches[index];
+    natives[index].source = blob + entry.source_offset;
+    natives[index].source_len = entry.source_length;
+    natives[index].hash = reinterpret_cast<const char*>(
+        blob + entry.name_offset + entry.name_length + 1);
+    natives[index].encoding = entry.encoding;
+%(codec_fields)s\
+  }
+  return true;
+}
+"""
+
+BLOB_CODEC_CHECK = """\
+    if (entry.codec != 0) return UnmapNativesBlob(blob, size);
+"""
+
+BLOB_CODEC_FIELDS = """\
+    natives[index].raw_len = entry.raw_length;
+    natives[index].codec = entry.codec;
+"""
+
+# With --dev the modules that need no expanding are left out of the header
+# and read from the checkout by GetNativeSource(), so editing them takes no
+# more than a relaunch. Their natives[] entries start out empty.
+DEV_INCLUDES = """\
+#include <stdio.h>
+#include <stdlib.h>
+"""
+
+DEV_NATIVE_HELPERS = """
+// The files the natives not in the header are read from, NULL for the rest.
+static const char* const native_paths[%(native_count)i] = {
+%(native_paths)s};
+
+// Reads the source of natives[index] from its file when first asked for and
+// keeps it for the lifetime of the process, or with reload reads it again,
+// freeing the source read before. Natives are loaded on the main thread.
+static inline const unsigned char* GetNativeSource(size_t index,
+                                                   bool reload = false) {
+  struct _native& native = natives[index];
+  const char* path = native_paths[index];
+  if (path == NULL || (native.source != NULL && !reload)) return native.source;
+  FILE* file = fopen(path, "rb");
+  if (file == NULL) {
+    fprintf(stderr, "tint: can't read native %%s from %%s\\n", native.name,
+            path);
+    abort();
+  }
+  unsigned char* source = NULL;
+  size_t length = 0;
+  size_t capacity = 0;
+  size_t count;
+  do {
+    if (length == capacity) {
+      capacity = capacity ? capacity * 2 : 64 * 1024;
+      source = static_cast<unsigned char*>(realloc(source, capacity));
+      if (source == NULL) abort();
+    }
+    count = fread(source + length, 1, capacity - length, file);
+    length += count;
+  } while (count > 0);
+  bool failed = ferror(file) != 0;
+  fclose(file);
+  if (failed) {
+    fprintf(stderr, "tint: can't read native %%s from %%s\\n", native.name,
+            path);
+    abort();
+  }
+  free(const_cast<unsigned char*>(native.source));
+  native.source = source;
+  native.source_len = length;
+  return source;
+}
+
+// The length of the source GetNativeSource() returned last for index.
+static inline size_t GetNativeSourceLength(size_t index) {
+  return natives[index].source_len;
+}
+"""
+
+DEV_NATIVE_PATH = """\
+  "%(path)s",
 """
 
+DEV_NATIVE_NO_PATH = """\
+  NULL,
+"""
+
+NATIVES_BLOB_MAGIC = 'TINTNATV'
+NATIVES_BLOB_VERSION = 3
+NATIVES_BLOB_PAGE_SIZE = 16384
+NATIVES_BLOB_ALIGNMENT = 16
+
+# Codecs in the order of their NATIVE_CODEC_* values.
+NATIVE_CODECS = ['NATIVE_CODEC_NONE', 'NATIVE_CODEC_DEFLATE']
+
+# Encodings in the order of their NATIVE_ENCODING_* values.
+NATIVE_ENCODINGS = ['NATIVE_ENCODING_ONE_BYTE', 'NATIVE_ENCODING_UTF8']
+
+
+def Align(offset, alignment):
+  return (offset + alignment - 1) // alignment * alignment
+
+
+def NativesBlob(natives):
+  """Lay out the blob that MapNativesBlob() maps.
+
+  The blob starts with a header and an index of all modules, followed by
+  the NUL terminated ids, each followed by the NUL terminated hash of the
+  source. The sources start on a page boundary, so they don't share pages
+  with the index, and every source is 16-byte aligned.
+
+  Args:
+    natives: List of (id, payload, raw length, codec, hash, encoding)
+        tuples.
+
+  Returns:
+    The contents of the blob.
+  """
+  index_offset = 32
+  names_offset = index_offset + 28 * len(natives)
+  names = []
+  index = []
+  data = []
+  name_offset = names_offset
+  for (id, payload, raw_length, codec, hash, encoding) in natives:
+    names.append(id + '\0' + hash + '\0')
+    index.append([name_offset, len(id), 0, len(payload), raw_length,
+                  NATIVE_CODECS.index(codec), NATIVE_ENCODINGS.index(encoding)])
+    name_offset = name_offset + len(id) + len(hash) + 2
+  data_offset = Align(name_offset, NATIVES_BLOB_PAGE_SIZE)
+  offset = data_offset
+  for (entry, (id, payload, raw_length, codec, hash, encoding)) in zip(index,
+                                                                       natives):
+    offset = Align(offset, NATIVES_BLOB_ALIGNMENT)
+    entry[2] = offset
+    data.append(payload)
+    offset = offset + len(payload)
+  size = offset
+
+  pieces = [struct.pack('<8s6I', NATIVES_BLOB_MAGIC, NATIVES_BLOB_VERSION,
+                        len(natives), index_offset, data_offset, size, 0)]
+  for entry in index:
+    pieces.append(struct.pack('<7I', *entry))
+  pieces.extend(names)
+  position = name_offset
+  for (entry, payload) in zip(index, data):
+    pieces.append('\0' * (entry[2] - position))
+    pieces.append(payload)
+    position = entry[2] + len(payload)
+  return ''.join(pieces)
+
+
+# With --code-cache, V8 code caches made by tools/tint_code_cache.py are
+# embedded next to the sources. The table follows the order of natives[].
+# modules/Runtime/Natives.cc hands them to NativeModule, which build/node.diff
+# has compile the natives with them as cachedData.
+NATIVE_CODE_CACHES = """
+// The caches were made by this version of V8; other versions reject them.
+#define TINT_NATIVES_CODE_CACHE 1
+static const char native_code_caches_v8_version[] = "%(v8_version)s";
+
+// hash is the SHA-1 of the source a cache was made for; natives without a
+// cache have a NULL hash.
+struct _native_code_cache {
+  const char* hash;
+  const unsigned char* data;
+  size_t length;
+};
+
+static const struct _native_code_cache native_code_caches[] = { %(code_cache_lines)s };
+
+// Returns the code cache of the native called name, or NULL.
+static inline const struct _native_code_cache* GetNativeCodeCache(
+    const char* name) {
+  int index = GetNativeIndex(name);
+  if (index < 0 || native_code_caches[index].hash == NULL) return NULL;
+  return &native_code_caches[index];
+}
+"""
+
+NATIVE_CODE_CACHE_DECLARATION = """\
+  { "%(hash)s", %(name)s, sizeof(%(name)s) },
+"""
+
+NATIVE_NO_CODE_CACHE_DECLARATION = """\
+  { NULL, NULL, 0 },
+"""
+
+
+def ReadCodeCaches(directory):
+  """Read the manifest of the code caches in directory.
+
+  Returns:
+    A tuple of the version of V8 the caches were made by and a dict from
+    module id to the SHA-1 of the source its cache was made for and the name
+    of the cache file.
+  """
+  file = open(os.path.join(directory, 'manifest.json'))
+  try:
+    manifest = json.load(file)
+  finally:
+    file.close()
+  return (str(manifest['v8']),
+          dict((str(id), (str(cache['hash']),
+                          os.path.join(directory, cache['file'])))
+               for (id, cache) in manifest['caches'].items()))
+
+
 SOURCE_DECLARATION = """\
-  const unsigned char %(escaped_id)s_native[] = { %(data)s };
+  %(placement)sconst unsigned char %(name)s[] = { %(data)s };
+"""
+
+# The string and incbin formats bind X_native as a reference to an array of
+# the exact source length, so sizeof(X_native) stays the length of the
+# source (rather than including the terminating NUL of a string literal).
+STRING_SOURCE_DECLARATION = """\
+  %(placement)sstatic const char %(name)s_data[] =
+    %(data)s;
+  static const unsigned char (&%(name)s)[%(length)i] =
+      *reinterpret_cast<const unsigned char (*)[%(length)i]>(
+          %(name)s_data);
+"""
+
+INCBIN_PRELUDE = """\
+#if !defined(__GNUC__)
+#error "incbin natives need gcc or clang; generate them with --format=array."
+#endif
+#define TINT_NATIVES_STR2(x) #x
+#define TINT_NATIVES_STR(x) TINT_NATIVES_STR2(x)
+#define TINT_NATIVES_SYMBOL(name) TINT_NATIVES_STR(__USER_LABEL_PREFIX__) #name
+#if defined(__APPLE__)
+#define TINT_NATIVES_SECTION "__TEXT,__const"
+#else
+#define TINT_NATIVES_SECTION ".rodata"
+#endif
+#define TINT_NATIVES_INCBIN(name, file)                                      \\
+  __asm__(".pushsection " TINT_NATIVES_SECTION "\\n"                          \\
+          ".balign 16\\n"                                                     \\
+          TINT_NATIVES_SYMBOL(name) ":\\n"                                    \\
+          ".incbin \\"" file "\\"\\n"                                           \\
+          ".popsection\\n")
+
+"""
+
+# The content hash makes the header change whenever a module does, since
+# compilers don't report .incbin files as dependencies.
+INCBIN_SOURCE_DECLARATION = """\
+  TINT_NATIVES_INCBIN%(placement)s(%(symbol)s, "%(path)s");  // %(hash)s
+  extern "C" const unsigned char %(symbol)s[%(length)i];
+  static const unsigned char (&%(name)s)[%(length)i] =
+      %(symbol)s;
 """
 
+# With --load-order the sources are defined in a section of their own, in
+# the order the modules are loaded in at startup. The first source, and the
+# first of the modules never loaded, start a page, so the pages read at
+# startup hold nothing else.
+LAYOUT_PRELUDE = """\
+#if defined(_MSC_VER)
+#pragma section(".tntnat", read)
+#define TINT_NATIVES_ORDERED __declspec(allocate(".tntnat"))
+#define TINT_NATIVES_PAGE TINT_NATIVES_ORDERED __declspec(align(4096))
+#else
+#if defined(__APPLE__)
+#define TINT_NATIVES_LAYOUT_SECTION "__TEXT,__tint_natives"
+#else
+#define TINT_NATIVES_LAYOUT_SECTION ".rodata.tint_natives"
+#endif
+#if defined(__has_attribute)
+#if __has_attribute(no_reorder)
+#define TINT_NATIVES_NO_REORDER __attribute__((no_reorder))
+#endif
+#endif
+#if !defined(TINT_NATIVES_NO_REORDER)
+#define TINT_NATIVES_NO_REORDER
+#endif
+#define TINT_NATIVES_ORDERED \\
+  __attribute__((section(TINT_NATIVES_LAYOUT_SECTION))) TINT_NATIVES_NO_REORDER
+#define TINT_NATIVES_PAGE TINT_NATIVES_ORDERED __attribute__((aligned(4096)))
+#endif
+
+"""
+LAYOUT_INCBIN_PRELUDE = """\
+#define TINT_NATIVES_INCBIN_ALIGNED(name, file, alignment)                   \\
+  __asm__(".pushsection " TINT_NATIVES_LAYOUT_SECTION "\\n"                   \\
+          ".balign " #alignment "\\n"                                         \\
+          TINT_NATIVES_SYMBOL(name) ":\\n"                                    \\
+          ".incbin \\"" file "\\"\\n"                                           \\
+          ".popsection\\n")
+#define TINT_NATIVES_INCBIN_ORDERED(name, file)                              \\
+  TINT_NATIVES_INCBIN_ALIGNED(name, file, 16)
+#define TINT_NATIVES_INCBIN_PAGE(name, file)                                 \\
+  TINT_NATIVES_INCBIN_ALIGNED(name, file, 4096)
+
+"""
+# The placement of an ordered source, and of one starting a page.
+LAYOUT_PLACEMENTS = {
+  'array': ('TINT_NATIVES_ORDERED ', 'TINT_NATIVES_PAGE '),
+  'string': ('TINT_NATIVES_ORDERED ', 'TINT_NATIVES_PAGE '),
+  'incbin': ('_ORDERED', '_PAGE'),
+}
+
+SOURCE_DECLARATIONS = {
+  'array': SOURCE_DECLARATION,
+  'string': STRING_SOURCE_DECLARATION,
+  'incbin': INCBIN_SOURCE_DECLARATION,
+}
+
+# With --shards the sources are defined in .cc files of their own, which
+# compile in parallel, and the header only declares them. String sources
+# keep their terminating NUL, which C++ doesn't let an initializer drop.
+SHARD_TEMPLATE = """\
+// Shard %(shard)i of %(count)i of %(header)s, generated by tint_js2c.py.
+
+namespace node {
+%(source_lines)s\
+}
+"""
+
+SHARD_SOURCE_DECLARATION = """
+  extern "C" const unsigned char %(symbol)s[%(length)i] = { %(data)s };
+"""
+
+SHARD_STRING_SOURCE_DECLARATION = """
+  extern "C" const unsigned char %(symbol)s[%(length)i + 1] =
+    %(data)s;
+"""
+
+SHARD_SOURCE_DECLARATIONS = {
+  'array': SHARD_SOURCE_DECLARATION,
+  'string': SHARD_STRING_SOURCE_DECLARATION,
+}
+
+SHARD_EXTERN_DECLARATION = """\
+  extern "C" const unsigned char %(symbol)s[%(storage)s];
+  static const unsigned char (&%(name)s)[%(length)i] =
+      *reinterpret_cast<const unsigned char (*)[%(length)i]>(%(symbol)s);
+"""
+
+# Module sizes are rounded up to this before they're spread over the shards,
+# so that an edit rarely moves a module to another shard.
+SHARD_SIZE_GRANULARITY = 4096
+
+
+def AssignShards(sizes, count):
+  """Spread modules of the given sizes over count shards.
+
+  The biggest modules go first, each to the shard with the fewest bytes so
+  far; ties go by position, so the assignment only changes when a module
+  crosses a multiple of SHARD_SIZE_GRANULARITY.
+
+  Returns:
+    A list of the shard of every module.
+  """
+  quantized = [-(-size // SHARD_SIZE_GRANULARITY) for size in sizes]
+  loads = [0] * count
+  shards = [0] * len(sizes)
+  for i in sorted(xrange(len(sizes)), key=lambda i: (-quantized[i], i)):
+    shard = loads.index(min(loads))
+    shards[i] = shard
+    loads[shard] = loads[shard] + quantized[i]
+  return shards
+
+
+def ShardFiles(target, count):
+  base = os.path.splitext(target)[0]
+  return ['%s_%i.cc' % (base, i) for i in xrange(count)]
+
 
 GET_DELAY_INDEX_CASE = """\
     if (strcmp(name, "%(id)s") == 0) return %(i)i;
@@ -237,7 +1421,250 @@ GET_DELAY_SCRIPT_NAME_CASE = """\
     if (index == %(i)i) return Vector<const char>("%(name)s", %(length)i);
 """
 
-def JS2C(source, target):
+NATIVE_LOOKUP_INCLUDES = """\
+#include <stdint.h>
+#include <string.h>
+"""
+
+NATIVE_LOOKUP = """
+%(tables)s
+// Returns the index of the native called name in natives[], or -1.
+static inline int GetNativeIndex(const char* name) {
+%(body)s}
+"""
+
+NATIVE_EMPTY_LOOKUP = """
+static inline int GetNativeIndex(const char* name) {
+  return -1;
+}
+"""
+
+
+def NativeLookup(ids):
+  """Generate GetNativeIndex() for the natives with the given ids."""
+  lookup = js2c_common.IndexLookup(ids, 'natives[]', 'natives[index].name')
+  if not lookup:
+    return NATIVE_EMPTY_LOOKUP
+  (tables, body) = lookup
+  return NATIVE_LOOKUP % {
+    'tables': tables,
+    'body': js2c_common.Indent(body, '  ')
+  }
+
+
+NON_ASCII_PATTERN = re.compile(r'[\x80-\xff]')
+
+def NativeEncoding(filename, lines):
+  """Tell whether a source is ASCII, and so a one-byte string for V8, or
+  UTF-8. Only the rare sources that aren't ASCII are decoded."""
+  if not NON_ASCII_PATTERN.search(lines):
+    return 'NATIVE_ENCODING_ONE_BYTE'
+  try:
+    lines.decode('utf-8')
+  except UnicodeDecodeError, e:
+    raise Exception("%s is neither ASCII nor UTF-8: %s" % (filename, e))
+  return 'NATIVE_ENCODING_UTF8'
+
+
+def NativeId(s):
+  """Return the id the module in file s is embedded under."""
+  delay = str(s).endswith('-delay.js')
+  if 'node/' in s or 'node\\' in s or 'modules\\' in s or 'modules/' in s:
+    s = s.replace('node/lib/','').replace('node/src/','').replace('node/','').replace('node\\lib\\','').replace('node\\src\\','').replace('node\\','').replace('libraries\\','').replace('libraries/','').replace('../','').replace('../','').replace('..\\','').replace('..\\','')
+
+  if 'modules\\' in s:
+    s = s.split('\\')[len(s.split('\\'))-1]
+
+  # On Windows, "./foo.bar" in the .gyp file is passed as "foo.bar"
+  # so don't assume there is always a slash in the file path.
+  if '/' in s or '\\' in s:
+    id = '/'.join(re.split('/|\\\\', s)[0:])
+  else:
+    id = s
+
+  if '.' in id:
+    id = id.split('.', 1)[0]
+  if '_mac' in s or '_win' in s or '_gtk' in s or 'Bridge' in s or '_base' in s or 'AppSchema' in s or 'Application' in s or 'modules/' in s:
+    id = os.path.basename(str(s)).split('.')[0].replace('_mac','').replace('_win','').replace('_linux','').replace('_posix','').replace('_gtk','')
+
+  if delay: id = id[:-6]
+  return id
+
+
+# Modules node and tint run without them being required: the bootstrap
+# script node.cc runs, the module loading all the widgets of an application
+# and the one the bridge to native code is made with.
+DEFAULT_ENTRY_POINTS = ['internal/bootstrap_node', 'Common', 'Bridge']
+
+
+def FindRequires(lines):
+  """Find the modules a script requires.
+
+  Only require(), or any x.require(), with a single string literal counts;
+  every other call of require is dynamic and has to be covered by --keep.
+
+  Returns:
+    A tuple of the list of required names and the number of dynamic
+    requires.
+  """
+  tokens = [token for token in js2c_common.ScanScript(lines)[0]
+            if token[0] not in ('space', 'newline', 'comment')]
+  names = []
+  dynamic = 0
+  for (i, (kind, text)) in enumerate(tokens):
+    if kind != 'word' or text != 'require':
+      continue
+    if i > 0 and tokens[i - 1][1] == 'function':
+      continue
+    call = tokens[i + 1:i + 4]
+    if not call or call[0][1] != '(':
+      continue
+    if (len(call) == 3 and call[1][0] == 'literal' and call[2][1] == ')' and
+        call[1][1][0] in '\'"`' and '${' not in call[1][1]):
+      names.append(call[1][1][1:-1])
+    else:
+      dynamic = dynamic + 1
+  return (names, dynamic)
+
+
+def ResolveRequire(name, ids):
+  """Return the id of the module require(name) loads, or None."""
+  if name in ids:
+    return name
+  name = re.sub(r'\.js$', '', name)
+  if name.startswith('./') or name.startswith('../'):
+    name = name.split('/')[-1]
+  if name in ids:
+    return name
+  return None
+
+
+def ReadListFile(filename):
+  """Read the ids, or fnmatch patterns, of a --keep or --load-order file."""
+  patterns = []
+  for line in ReadLines(filename):
+    line = line.split('#', 1)[0].strip()
+    if line:
+      patterns.append(line)
+  return patterns
+
+
+def RequireGraph(modules, entries, keep):
+  """Find the modules reachable through require() from the entry points.
+
+  Args:
+    modules: The module files.
+    entries: The ids of the modules loaded without a require().
+    keep: Ids, or fnmatch patterns, of modules only required dynamically.
+
+  Returns:
+    A dict with the 'entries', the 'reachable' and 'unreachable' ids, the
+    'edges' from every id to the ids it requires, the number of 'dynamic'
+    requires of every id with any and the names required by every id that
+    aren't among the modules, as 'unresolved'.
+  """
+  ids = {}
+  for s in modules:
+    ids.setdefault(NativeId(str(s)), []).append(str(s))
+  edges = {}
+  dynamic = {}
+  unresolved = {}
+  for (id, files) in ids.items():
+    required = []
+    for filename in files:
+      (names, count) = FindRequires(ReadFile(filename))
+      for name in names:
+        resolved = ResolveRequire(name, ids)
+        if resolved is None:
+          unresolved.setdefault(id, [])
+          if name not in unresolved[id]:
+            unresolved[id].append(name)
+        elif resolved not in required:
+          required.append(resolved)
+      if count:
+        dynamic[id] = dynamic.get(id, 0) + count
+    edges[id] = sorted(required)
+
+  roots = [id for id in ids if id in entries or
+           any(fnmatch.fnmatchcase(id, pattern) for pattern in keep)]
+  reachable = set()
+  pending = sorted(roots)
+  while pending:
+    id = pending.pop()
+    if id in reachable:
+      continue
+    reachable.add(id)
+    pending.extend(edges[id])
+  return {
+    'entries': sorted(id for id in entries if id in ids),
+    'reachable': sorted(reachable),
+    'unreachable': sorted(id for id in ids if id not in reachable),
+    'edges': edges,
+    'dynamic': dynamic,
+    'unresolved': unresolved,
+  }
+
+
+def WriteSourceDeclarations(outputs, index, format, values, payload,
+                            shard=None, pieces=None):
+  """Write the declaration of a source to the headers being generated.
+
+  The first header gets the source serialized in chunks, or with a shard
+  given, an extern declaration of the source serialized in the shard. The
+  second header, if any, gets an empty declaration.
+
+  Args:
+    outputs: List of the open headers.
+    index: Number of declarations written so far.
+    format: Format to serialize the source in.
+    values: Dict of the 'name', 'symbol', 'length', 'path', 'hash' and
+        'placement' of the source, for the declaration templates.
+    payload: The bytes of the source.
+    shard: The open shard to define the source in, if any.
+    pieces: The source already serialized in format, if it is.
+
+  Returns:
+    The number of characters written for the source itself.
+  """
+  separator = "\n" if index > 0 else ""
+  if len(outputs) > 1:
+    outputs[1].write(separator + SOURCE_DECLARATION % {
+      'name': values['name'],
+      'placement': '',
+      'data': 0
+    })
+  template = SOURCE_DECLARATIONS[format]
+  output = outputs[0]
+  if shard:
+    outputs[0].write(separator + SHARD_EXTERN_DECLARATION % dict(values,
+        storage=values['length'] + (format == 'string')))
+    (template, output, separator) = (SHARD_SOURCE_DECLARATIONS[format],
+                                     shard, '')
+  if '%(data)s' not in template:
+    text = separator + template % values
+    output.write(text)
+    return len(text)
+  (head, tail) = template.split('%(data)s')
+  head = separator + head % values
+  tail = tail % values
+  output.write(head)
+  written = len(head) + len(tail)
+  if pieces is None:
+    pieces = SerializeChunks(payload, format)
+  for piece in pieces:
+    output.write(piece)
+    written = written + len(piece)
+  output.write(tail)
+  return written
+
+
+def JS2C(source, target, cache_dir=None, jobs=1, format='array',
+         minify='none', source_map=None, compression='off', blob=None,
+         code_cache=None, stats=None, depfile=None, shards=0, entries=None,
+         keep=None, prune=False, require_report=None, load_order=None,
+         dev=False, memory=None):
+  start = time.time()
+  run_stats = js2c_common.StageStats()
   ids = []
   delay_ids = []
   modules = []
@@ -245,137 +1672,605 @@ def JS2C(source, target):
   consts = {}
   macros = {}
   macro_lines = []
+  # Every file read, for the depfile.
+  dependencies = []
 
   for s in source:
     if (os.path.split(str(s))[1]).endswith('macros.py'):
       macro_lines.extend(ReadLines(str(s)))
+      dependencies.append(str(s))
     else:
       modules.append(s)
+  dependencies.extend(map(str, modules))
+
+  # The require() graph is only built when asked for, as it means scanning
+  # every module.
+  if prune or require_report:
+    patterns = []
+    for filename in keep or []:
+      patterns.extend(ReadListFile(filename))
+      dependencies.append(filename)
+    graph = RequireGraph(modules, entries or DEFAULT_ENTRY_POINTS, patterns)
+    if require_report:
+      WriteIfChanged(require_report,
+                     json.dumps(graph, indent=2, sort_keys=True) + '\n')
+    if prune:
+      unreachable = set(graph['unreachable'])
+      modules = [s for s in modules if NativeId(str(s)) not in unreachable]
+
+  # Lay the modules out in the order they are loaded in, the ones never
+  # loaded last, each in the order they were given in.
+  page_starts = set()
+  if load_order:
+    rank = {}
+    for id in ReadListFile(load_order):
+      rank.setdefault(id, len(rank))
+    dependencies.append(load_order)
+    keys = [rank.get(NativeId(str(s)), len(rank)) for s in modules]
+    order = sorted(range(len(modules)), key=lambda i: (keys[i], i))
+    modules = [modules[i] for i in order]
+    keys = [keys[i] for i in order]
+    page_starts.add(0)
+    if len(rank) in keys:
+      page_starts.add(keys.index(len(rank)))
 
-  # Process input from all *macro.py files
-  (consts, macros) = ReadMacros(macro_lines)
+  options = { 'format': format, 'minify': minify, 'compression': compression }
+  cache = None
+  if cache_dir or memory is not None:
+    cache = ModuleCache(cache_dir, CacheSalt(macro_lines, options), memory)
 
-  # Build source code lines
-  source_lines = [ ]
-  source_lines_empty = []
+  # Code caches are embedded like the sources.
+  code_caches = None
+  code_cache_format = format
+  if code_cache:
+    (code_cache_version, code_caches) = ReadCodeCaches(code_cache)
+    dependencies.append(os.path.join(code_cache, 'manifest.json'))
+
+  # incbin assembles the module sources from files next to the header.
+  data_dir = os.path.splitext(str(target[0]))[0] + '_data'
+  if 'incbin' in (format, code_cache_format) and not os.path.isdir(data_dir):
+    os.makedirs(data_dir)
+
+  # With --shards the sources are defined in .cc files next to the header,
+  # balanced by the size of the modules.
+  shard_files = []
+  shard_of = None
+  if shards:
+    shard_files = ShardFiles(str(target[0]), shards)
+    shard_of = AssignShards([os.path.getsize(str(s)) for s in modules], shards)
 
   native_lines = []
+  native_ids = []
+  code_cache_lines = []
+  source_maps = {}
+  module_stats = []
 
-  for s in modules:
-    delay = str(s).endswith('-delay.js')
-    lines = ReadFile(str(s))
-    do_jsmin = lines.find('// jsminify this file, js2c: jsmin') != -1
-
-    lines = ExpandConstants(lines, consts)
-    lines = ExpandMacros(lines, macros)
-    lines = CompressScript(lines, do_jsmin)
-    data = ToCArray(s, lines)
-    
-    if 'node/' in s or 'node\\' in s or 'modules\\' in s or 'modules/' in s:
-      s = s.replace('node/lib/','').replace('node/src/','').replace('node/','').replace('node\\lib\\','').replace('node\\src\\','').replace('node\\','').replace('libraries\\','').replace('libraries/','').replace('../','').replace('../','').replace('..\\','').replace('..\\','')
-
-    if 'modules\\' in s:
-      s = s.split('\\')[len(s.split('\\'))-1]
-
-    # On Windows, "./foo.bar" in the .gyp file is passed as "foo.bar"
-    # so don't assume there is always a slash in the file path.
-    if '/' in s or '\\' in s:
-      id = '/'.join(re.split('/|\\\\', s)[0:])
-    else:
-      id = s
+  blob_natives = []
 
-    if '.' in id:
-      id = id.split('.', 1)[0]
-    if '_mac' in s or '_win' in s or '_gtk' in s or 'Bridge' in s or '_base' in s or 'AppSchema' in s or 'Application' in s:
-      id = os.path.basename(str(s)).split('.')[0].replace('_mac','').replace('_win','').replace('_linux','').replace('_posix','').replace('_gtk','')
+  native_declaration = NATIVE_DECLARATION
+  includes = NATIVE_LOOKUP_INCLUDES
+  prelude = NATIVE_ENCODING_PRELUDE
+  native_fields = ''
+  native_helpers = ''
+  if compression == 'off' and not dev:
+    native_helpers = NATIVE_HELPERS
+  if compression != 'off':
+    native_declaration = COMPRESSED_NATIVE_DECLARATION
+    includes = includes + COMPRESSED_INCLUDES
+    prelude = prelude + COMPRESSED_PRELUDE
+    native_fields = COMPRESSED_NATIVE_FIELDS
+    native_helpers = COMPRESSED_NATIVE_HELPERS % {
+      'native_count': len(modules)
+    }
+  if blob:
+    includes = includes + BLOB_INCLUDES
+  if dev:
+    includes = includes + DEV_INCLUDES
+  native_paths = []
 
-    if delay: id = id[:-6]
-    if delay:
-      delay_ids.append((id, len(lines)))
-    else:
-      ids.append((id, len(lines)))
+  incbin_prelude = ''
+  if 'incbin' in (format, code_cache_format):
+    incbin_prelude = INCBIN_PRELUDE
+  if load_order:
+    incbin_prelude = incbin_prelude + LAYOUT_PRELUDE
+    if format == 'incbin':
+      incbin_prelude = incbin_prelude + LAYOUT_INCBIN_PRELUDE
 
-    escaped_id = id.replace('-', '_').replace('/', '_')
-    source_lines.append(SOURCE_DECLARATION % {
-      'id': id,
-      'escaped_id': escaped_id,
-      'data': data
-    })
-    source_lines_empty.append(SOURCE_DECLARATION % {
-      'id': id,
-      'escaped_id': escaped_id,
-      'data': 0
-    })
-    native_lines.append(NATIVE_DECLARATION % {
-      'id': id,
-      'escaped_id': escaped_id
+  # The headers are written while the modules are processed, so only the
+  # module at hand is kept in memory; the natives table after the sources
+  # is filled in once all modules are done. Both headers are written next
+  # to the targets and moved over them at the end.
+  (header_head, header_tail) = HEADER_TEMPLATE.split('%(source_lines)s')
+  (shard_head, shard_tail) = SHARD_TEMPLATE.split('%(source_lines)s')
+  files = [str(t) for t in target[:2]] + shard_files
+  temps = ["%s.%d.tmp" % (file, os.getpid()) for file in files]
+  outputs = []
+  try:
+    for temp in temps:
+      outputs.append(open(temp, "w"))
+    headers = outputs[:len(files) - len(shard_files)]
+    shard_outputs = outputs[len(headers):]
+    headers[0].write(header_head % {
+      'includes': includes,
+      'prelude': prelude + incbin_prelude
     })
+    if len(headers) > 1:
+      headers[1].write(header_head % {
+        'includes': includes,
+        'prelude': prelude
+      })
+    for (i, shard) in enumerate(shard_outputs):
+      shard.write(shard_head % {
+        'shard': i + 1,
+        'count': shards,
+        'header': os.path.basename(str(target[0]))
+      })
+    declarations = 0
 
-  # Build delay support functions
-  get_index_cases = [ ]
-  get_script_source_cases = [ ]
-  get_script_name_cases = [ ]
-
-  i = 0
-  for (id, length) in delay_ids:
-    native_name = "native %s.js" % id
-    get_index_cases.append(GET_DELAY_INDEX_CASE % { 'id': id, 'i': i })
-    get_script_source_cases.append(GET_DELAY_SCRIPT_SOURCE_CASE % {
-      'id': id,
-      'length': length,
-      'i': i
-    })
-    get_script_name_cases.append(GET_DELAY_SCRIPT_NAME_CASE % {
-      'name': native_name,
-      'length': len(native_name),
-      'i': i
-    });
-    i = i + 1
-
-  for (id, length) in ids:
-    native_name = "native %s.js" % id
-    get_index_cases.append(GET_DELAY_INDEX_CASE % { 'id': id, 'i': i })
-    get_script_source_cases.append(GET_DELAY_SCRIPT_SOURCE_CASE % {
-      'id': id,
-      'length': length,
-      'i': i
-    })
-    get_script_name_cases.append(GET_DELAY_SCRIPT_NAME_CASE % {
-      'name': native_name,
-      'length': len(native_name),
-      'i': i
-    });
-    i = i + 1
-
-  # Emit result
-  output = open(str(target[0]), "w")
-  output.write(HEADER_TEMPLATE % {
-    'builtin_count': len(ids) + len(delay_ids),
-    'delay_count': len(delay_ids),
-    'source_lines': "\n".join(source_lines),
-    'native_lines': "\n".join(native_lines),
-    'get_index_cases': "".join(get_index_cases),
-    'get_script_source_cases': "".join(get_script_source_cases),
-    'get_script_name_cases': "".join(get_script_name_cases)
-  })
-  output.close()
-
-  if len(target) > 1:
-    output = open(str(target[1]), "w")
-    output.write(HEADER_TEMPLATE % {
+    process_start = time.time()
+    raw_bytes = 0
+    written_bytes = 0
+    processed = ProcessModules(map(str, modules), macro_lines, options, jobs,
+                               cache)
+    # izip, as zip would process every module before the first is written.
+    for (index, (s, result)) in enumerate(itertools.izip(modules, processed)):
+      filename = str(s)
+      shard = None
+      if shards:
+        shard = shard_outputs[shard_of[index]]
+      entry = result['entry']
+      lines = entry['lines']
+      payload = entry['payload']
+      delay = str(s).endswith('-delay.js')
+      if cache:
+        cache.used.add(result['key'])
+        cache.Remember(result['key'], entry)
+      module = {
+        'file': filename,
+        'cached': result['cached'],
+        'stages': result['stages']
+      }
+      module_stats.append(module)
+      raw_bytes = raw_bytes + result['stages'][0]['input_bytes']
+
+      id = NativeId(s)
+      if delay:
+        delay_ids.append((id, len(lines)))
+      else:
+        ids.append((id, len(lines)))
+
+      module['id'] = id
+      escaped_id = id.replace('-', '_').replace('/', '_')
+      source_hash = hashlib.sha1(lines).hexdigest()
+      encoding = NativeEncoding(filename, lines)
+      module['encoding'] = encoding
+      # Only the modules that need no expanding can be read as they are.
+      dev_path = None
+      if dev and not delay and ReadFile(filename) == lines:
+        dev_path = os.path.abspath(filename).replace('\\', '/')
+        native_paths.append(DEV_NATIVE_PATH % {
+          'path': dev_path.replace('"', '\\"')
+        })
+      elif dev:
+        native_paths.append(DEV_NATIVE_NO_PATH)
+      path = None
+      if format == 'incbin' and not dev_path and not blob:
+        path = os.path.join(data_dir, escaped_id + '.js')
+        if entry['codec'] != 'NATIVE_CODEC_NONE':
+          path = path + '.z'
+        WriteIfChanged(path, payload)
+        path = os.path.abspath(path).replace('\\', '/').replace('"', '\\"')
+      # With --blob the header only gets an empty natives[] entry for the
+      # source, which MapNativesBlob() points at the blob.
+      if blob:
+        blob_natives.append((id, payload, len(lines), entry['codec'],
+                             source_hash, encoding))
+      elif not dev_path:
+        placement = ''
+        if load_order:
+          placement = LAYOUT_PLACEMENTS[format][index in page_starts]
+        serialize_start = time.time()
+        # Modules from the cache come with their serialized source.
+        pieces = None
+        if entry.get('serialized', (None,))[0] == format:
+          pieces = entry['serialized'][1]
+        written = WriteSourceDeclarations(headers, declarations, format, {
+          'name': escaped_id + '_native',
+          'symbol': 'tint_native_' + escaped_id,
+          'length': len(payload),
+          'path': path,
+          'hash': hashlib.sha1(payload).hexdigest(),
+          'placement': placement
+        }, payload, shard, pieces)
+        declarations = declarations + 1
+        written_bytes = written_bytes + written
+        js2c_common.StageStats(module['stages']).Add(
+            'serialize', serialize_start, len(payload), written)
+      native_ids.append(id)
+      native_lines.append(((dev_path or blob) and EMPTY_NATIVE_DECLARATION or
+                           native_declaration) % {
+        'id': id,
+        'escaped_id': escaped_id,
+        'hash': source_hash,
+        'encoding': encoding,
+        'raw_length': len(lines),
+        'codec': entry['codec']
+      })
+      if code_caches is not None:
+        (cache_hash, cache_file) = code_caches.get(id, (None, None))
+        if cache_hash == source_hash:
+          code = ReadFile(cache_file)
+          dependencies.append(cache_file)
+          name = escaped_id + '_code_cache'
+          path = None
+          if code_cache_format == 'incbin':
+            path = os.path.join(data_dir, escaped_id + '.cache')
+            WriteIfChanged(path, code)
+            path = os.path.abspath(path).replace('\\', '/').replace('"', '\\"')
+          written_bytes = written_bytes + WriteSourceDeclarations(
+              headers, declarations, code_cache_format, {
+            'name': name,
+            'symbol': 'tint_code_cache_' + escaped_id,
+            'length': len(code),
+            'path': path,
+            'hash': hashlib.sha1(code).hexdigest(),
+            'placement': ''
+          }, code, shard)
+          declarations = declarations + 1
+          code_cache_lines.append(NATIVE_CODE_CACHE_DECLARATION % {
+            'hash': source_hash,
+            'name': name
+          })
+        else:
+          code_cache_lines.append(NATIVE_NO_CODE_CACHE_DECLARATION)
+      if source_map:
+        source_maps[id] = SourceMap(filename, lines, entry['segments'])
+        source_maps[id]['file'] = 'native %s.js' % id
+    run_stats.Add('process', process_start, raw_bytes, written_bytes,
+                  modules=len(modules), jobs=jobs)
+
+    native_lookup = NativeLookup(native_ids)
+
+    natives_qualifier = 'const '
+    if dev:
+      natives_qualifier = ''
+      native_helpers = native_helpers + DEV_NATIVE_HELPERS % {
+        'native_count': len(native_paths),
+        'native_paths': ''.join(native_paths)
+      }
+    if blob:
+      natives_qualifier = ''
+      native_helpers = native_helpers + BLOB_HELPERS % {
+        'blob_name': os.path.basename(blob),
+        'magic': ', '.join("'%s'" % c for c in NATIVES_BLOB_MAGIC),
+        'version': NATIVES_BLOB_VERSION,
+        'count': len(set(native_ids)),
+        'codec_check': BLOB_CODEC_CHECK if compression == 'off' else '',
+        'codec_fields': BLOB_CODEC_FIELDS if compression != 'off' else ''
+      }
+      WriteIfChanged(blob, NativesBlob(blob_natives))
+    if code_caches is not None:
+      native_helpers = native_helpers + NATIVE_CODE_CACHES % {
+        'v8_version': code_cache_version.replace('"', '\\"'),
+        'code_cache_lines': "\n".join(code_cache_lines)
+      }
+
+    # Build delay support functions
+    get_index_cases = [ ]
+    get_script_source_cases = [ ]
+    get_script_name_cases = [ ]
+
+    i = 0
+    for (id, length) in delay_ids:
+      native_name = "native %s.js" % id
+      get_index_cases.append(GET_DELAY_INDEX_CASE % { 'id': id, 'i': i })
+      get_script_source_cases.append(GET_DELAY_SCRIPT_SOURCE_CASE % {
+        'id': id,
+        'length': length,
+        'i': i
+      })
+      get_script_name_cases.append(GET_DELAY_SCRIPT_NAME_CASE % {
+        'name': native_name,
+        'length': len(native_name),
+        'i': i
+      });
+      i = i + 1
+
+    for (id, length) in ids:
+      native_name = "native %s.js" % id
+      get_index_cases.append(GET_DELAY_INDEX_CASE % { 'id': id, 'i': i })
+      get_script_source_cases.append(GET_DELAY_SCRIPT_SOURCE_CASE % {
+        'id': id,
+        'length': length,
+        'i': i
+      })
+      get_script_name_cases.append(GET_DELAY_SCRIPT_NAME_CASE % {
+        'name': native_name,
+        'length': len(native_name),
+        'i': i
+      });
+      i = i + 1
+
+    # Emit result
+    write_start = time.time()
+    tail = header_tail % {
       'builtin_count': len(ids) + len(delay_ids),
       'delay_count': len(delay_ids),
-      'source_lines': "\n".join(source_lines_empty),
+      'natives_qualifier': natives_qualifier,
+      'native_lines': "\n".join(native_lines),
+      'native_fields': native_fields,
+      'native_helpers': native_helpers,
+      'native_lookup': native_lookup,
       'get_index_cases': "".join(get_index_cases),
       'get_script_source_cases': "".join(get_script_source_cases),
       'get_script_name_cases': "".join(get_script_name_cases)
-    })
-    output.close()
+    }
+    for output in headers:
+      output.write(tail)
+    for output in shard_outputs:
+      output.write(shard_tail)
+    for output in outputs:
+      output.close()
+    for (temp, file) in zip(temps, files):
+      ReplaceFileIfChanged(temp, file)
+    run_stats.Add('write', write_start, sum(map(len, native_lines)),
+                  len(tail))
+  except:
+    for output in outputs:
+      output.close()
+    for temp in temps:
+      if os.path.exists(temp):
+        os.remove(temp)
+    raise
+
+  if source_map:
+    WriteIfChanged(source_map, json.dumps(source_maps, sort_keys=True))
+
+  if depfile:
+    WriteDepfile(depfile, str(target[0]), dependencies)
+
+  if cache:
+    cache.Prune()
+
+  if stats:
+    js2c_common.WriteStats(stats, start, run_stats.stages, module_stats)
+
+  return dependencies
+
+# inotify events that can change a watched file: written, replaced by a
+# rename, created, removed or touched.
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+INOTIFY_EVENTS = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE)
+
+
+def OpenInotify():
+  """Return an inotify instance and the inotify_add_watch function, or None
+  where there is no inotify."""
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init()
+  except (OSError, AttributeError):
+    return None
+  if fd < 0:
+    return None
+  return (fd, libc.inotify_add_watch)
+
+
+class FileWatcher:
+  """Waits for any of a set of files to change.
+
+  Files are compared by their mtime and size. On Linux inotify wakes the
+  watcher as soon as a directory of the files changes; elsewhere, or if
+  inotify can't be had, the files are polled every interval seconds.
+  """
+  def __init__(self, interval):
+    self.interval = interval
+    self.files = {}
+    self.inotify = OpenInotify()
+    self.directories = set()
+
+  def Stat(self, filename):
+    try:
+      info = os.stat(filename)
+    except OSError:
+      return None
+    return (info.st_mtime, info.st_size)
+
+  def Watch(self, filenames):
+    """Watch filenames from their current state on."""
+    self.files = dict((filename, self.Stat(filename))
+                      for filename in filenames)
+    if self.inotify:
+      (fd, add_watch) = self.inotify
+      for filename in filenames:
+        # Editors often save by renaming a new file over the old one, so the
+        # directory is watched rather than the file.
+        directory = os.path.dirname(os.path.abspath(filename))
+        if directory not in self.directories:
+          add_watch(fd, directory, INOTIFY_EVENTS)
+          self.directories.add(directory)
+
+  def Changed(self):
+    return sorted(filename for (filename, state) in self.files.items()
+                  if self.Stat(filename) != state)
+
+  def Wait(self):
+    """Block until a file changes; returns the changed files."""
+    while True:
+      if self.inotify:
+        fd = self.inotify[0]
+        if select.select([fd], [], [], self.interval)[0]:
+          # A save can take more than one event; let them all arrive.
+          time.sleep(0.01)
+          while select.select([fd], [], [], 0)[0]:
+            os.read(fd, 65536)
+      else:
+        time.sleep(self.interval)
+      changed = self.Changed()
+      if changed:
+        return changed
+
+
+def Watch(run, interval):
+  """Call run() again whenever a file it returned the name of changes.
+
+  run is called with the dict to keep the processed modules in and whether
+  it is the first run.
+  """
+  memory = {}
+  watcher = FileWatcher(interval)
+  watcher.Watch(run(memory, True))
+  print "tint_js2c.py: watching %i files." % len(watcher.files)
+  sys.stdout.flush()
+  while True:
+    changed = watcher.Wait()
+    start = time.time()
+    try:
+      dependencies = run(memory, False)
+    except Exception:
+      traceback.print_exc()
+      # Wait for the next change of the same files.
+      watcher.Watch(watcher.files)
+      continue
+    watcher.Watch(dependencies)
+    print "tint_js2c.py: %s changed, regenerated in %i ms." % (
+        ', '.join(changed), (time.time() - start) * 1000)
+    sys.stdout.flush()
+
 
 def main():
-  natives = sys.argv[1]
-  source_files = sys.argv[2:]
-  JS2C(source_files, [natives])
+  parser = optparse.OptionParser()
+  parser.add_option("--cache", action="store", dest="cache_dir",
+                    help="directory to keep processed modules in between runs.")
+  parser.add_option("-j", "--jobs", action="store", type="int", default=1,
+                    help="number of processes to expand modules with.")
+  parser.add_option("--format", action="store", default="auto",
+                    choices=["auto", "array", "string", "incbin"],
+                    help="how to embed the sources: array, string or incbin. "
+                         "auto picks the fastest one for the host compiler.")
+  parser.add_option("--minify", action="store", default="none",
+                    choices=["none", "whitespace", "full"],
+                    help="strip comments and whitespace from the sources: "
+                         "whitespace keeps line numbers, full doesn't.")
+  parser.add_option("--source-map", action="store", dest="source_map",
+                    help="file to write a source map per module to.")
+  parser.add_option("--compression", action="store", default="off",
+                    choices=["off", "deflate"],
+                    help="compress every module on its own, to be inflated "
+                         "by GetNativeSource() when first loaded.")
+  parser.add_option("--blob", action="store",
+                    help="file to write the sources to in place of the "
+                         "header, for MapNativesBlob() to map at startup; "
+                         "the runtime looks for it next to the executable.")
+  parser.add_option("--code-cache", action="store", dest="code_cache",
+                    help="directory of V8 code caches made by "
+                         "tint_code_cache.py to embed with the sources, for "
+                         "NativeModule to compile the natives with.")
+  parser.add_option("--stats", action="store",
+                    help="file to write the time, sizes and expansion counts "
+                         "of every stage of every module to, as JSON.")
+  parser.add_option("--shards", action="store", type="int", default=0,
+                    help="number of .cc files next to the header to define "
+                         "the sources in, for them to compile in parallel.")
+  parser.add_option("--depfile", action="store",
+                    help="file to write the files read to, as a depfile "
+                         "for ninja or make.")
+  parser.add_option("--entry", action="append", dest="entries",
+                    help="id of a module loaded without a require(), for the "
+                         "require() graph to start from; may be repeated. "
+                         "Defaults to %s." % ', '.join(DEFAULT_ENTRY_POINTS))
+  parser.add_option("--keep", action="append",
+                    help="file listing the ids, or patterns, of modules that "
+                         "are only required dynamically; may be repeated.")
+  parser.add_option("--prune-unreachable", action="store_true",
+                    dest="prune",
+                    help="leave out the modules no entry point or kept module "
+                         "requires, directly or not.")
+  parser.add_option("--require-report", action="store", dest="require_report",
+                    help="file to write the require() graph and the "
+                         "unreachable modules to, as JSON.")
+  parser.add_option("--load-order", action="store", dest="load_order",
+                    help="file listing the ids of the modules in the order "
+                         "they are first required in at startup, to lay the "
+                         "sources out in, in a section of their own.")
+  parser.add_option("--dev", action="store_true",
+                    help="leave the modules that need no expanding out of "
+                         "the header, for GetNativeSource() to read them "
+                         "from the checkout when they are loaded.")
+  parser.add_option("--watch", action="store_true",
+                    help="keep running, and regenerate the header whenever "
+                         "a module or macro file changes, expanding only the "
+                         "modules that changed.")
+  parser.add_option("--watch-interval", action="store", type="float",
+                    dest="watch_interval", default=0.5,
+                    help="seconds between looks at the files with --watch, "
+                         "where inotify isn't there to tell of changes.")
+  parser.set_usage("""tint_js2c.py [options] natives.h sources.js ...
+      natives.h: header to be generated.
+      sources.js: JS sources or *macros.py files.""")
+  (options, args) = parser.parse_args()
+  natives = args[0]
+  # The gyp action lists the generator among its inputs, so that editing it
+  # runs the action again; it is no module.
+  scripts = [os.path.abspath(GeneratorScript(module))
+             for module in (__file__, js2c_common.__file__)]
+  source_files = [filename for filename in args[1:]
+                  if os.path.abspath(filename) not in scripts]
+  format = options.format
+  if format == 'auto':
+    format = DefaultFormat()
+    # incbin leaves the compiler nothing to do, so there is nothing to shard.
+    if options.shards and format == 'incbin':
+      format = 'string'
+  if options.shards and (options.blob or format == 'incbin'):
+    parser.error("--shards needs --format=array or string and no --blob.")
+  if options.dev and (options.blob or options.code_cache or
+                      options.compression != 'off' or options.minify != 'none'):
+    parser.error("--dev reads the sources as they are, so it takes no --blob, "
+                 "--code-cache, --compression or --minify.")
+  if options.shards and options.load_order:
+    parser.error("--load-order lays out the sources of one header, not of "
+                 "--shards.")
+  def Run(memory=None, first=True):
+    # Only the first run of --watch has enough modules to expand for
+    # worker processes to pay off.
+    jobs = options.jobs if first else 1
+    return JS2C(source_files, [natives],
+                cache_dir=options.cache_dir,
+                jobs=jobs,
+                format=format,
+                minify=options.minify,
+                source_map=options.source_map,
+                compression=options.compression,
+                blob=options.blob,
+                code_cache=options.code_cache,
+                stats=options.stats,
+                depfile=options.depfile,
+                shards=options.shards,
+                entries=options.entries,
+                keep=options.keep,
+                prune=options.prune,
+                require_report=options.require_report,
+                load_order=options.load_order,
+                dev=options.dev,
+                memory=memory)
+  if options.watch:
+    try:
+      Watch(Run, options.watch_interval)
+    except KeyboardInterrupt:
+      pass
+  else:
+    Run()
 
 if __name__ == "__main__":
   main()
\ No newline at end of file
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+#
+# Tests of tint_js2c.py. Like the generator they need the jsmin of the node
+# checkout. The tests of the generated headers compile them with $CXX, or
+# g++, and are skipped without it.
+#
+#   python tools/tint_js2c_test.py
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from distutils.spawn import find_executable
+
+import js2c_common
+import tint_js2c
+
+MACROS = """\
+const FOO = 1;
+const FOO_BAR = FOO + 1;
+const LOOP = LOOP + 1;
+macro TWICE(x) = (x + x);
+macro ADD(a, b) = (a + b);
+macro QUAD(x) = TWICE(TWICE(x));
+macro SELF(x) = SELF(x) + 1;
+python macro CHAR_CODE(s) = ord(s[1]);
+"""
+
+
+def Expand(lines):
+  (constants, macros) = tint_js2c.ReadMacros(MACROS.splitlines())
+  constants = tint_js2c.ConstantExpander(constants)
+  macros = tint_js2c.MacroExpander(macros)
+  return tint_js2c.ProcessSource(lines, constants, macros)[0]
+
+
+class MacroTest(unittest.TestCase):
+  def testArgumentsByPosition(self):
+    self.assertEqual(Expand("ADD(1, 2);"), "(1 + 2);")
+
+  def testNestedCalls(self):
+    self.assertEqual(Expand("ADD(TWICE(f(1, 2)), [3, 4]);"),
+                     "((f(1, 2) + f(1, 2)) + [3, 4]);")
+
+  def testMacroInBody(self):
+    self.assertEqual(Expand("QUAD(y);"), "((y + y) + (y + y));")
+
+  def testNoSelfExpansion(self):
+    self.assertEqual(Expand("SELF(y);"), "SELF(y) + 1;")
+
+  def testWholeNames(self):
+    self.assertEqual(Expand("XADD(1, 2); ADDS(1, 2);"),
+                     "XADD(1, 2); ADDS(1, 2);")
+
+  def testPythonMacro(self):
+    self.assertEqual(Expand("CHAR_CODE('0');"), "48;")
+
+
+class ConstantTest(unittest.TestCase):
+  def testWholeWords(self):
+    self.assertEqual(Expand("FOO + FOO_BAR + MY_FOO + FOO2;"),
+                     "1 + 1 + 1 + MY_FOO + FOO2;")
+
+  def testSelfReference(self):
+    self.assertEqual(Expand("LOOP;"), "LOOP + 1;")
+
+
+class NativeEncodingTest(unittest.TestCase):
+  def Encoding(self, text):
+    return tint_js2c.NativeEncoding('test.js', text.encode('utf-8'))
+
+  def testAscii(self):
+    self.assertEqual(self.Encoding(u"var s = 'caf\\u00e9';\n"),
+                     'NATIVE_ENCODING_ONE_BYTE')
+
+  def testLatin1(self):
+    # V8 would take Latin-1 as one byte, but the source is stored as UTF-8.
+    self.assertEqual(self.Encoding(u"var s = 'caf\xe9';\n"),
+                     'NATIVE_ENCODING_UTF8')
+
+  def testAstral(self):
+    self.assertEqual(self.Encoding(u"var s = '\U0001f600';\n"),
+                     'NATIVE_ENCODING_UTF8')
+
+  def testNotUtf8(self):
+    self.assertRaises(Exception, tint_js2c.NativeEncoding, 'test.js',
+                      "var s = '\xe9';\n")
+
+
+class MinifyTest(unittest.TestCase):
+  LINES = "var a  =  1; // x\n\n/* y */ if (a) {\n  b(a);\n}\n"
+
+  def testWhitespace(self):
+    (lines, segments) = tint_js2c.MinifyScript(self.LINES, 'whitespace')
+    self.assertEqual(lines, "var a = 1;\n\nif (a) {\nb(a);\n}\n")
+    self.assertTrue((2, 0, 2, 8) in segments)
+
+  def testFull(self):
+    (lines, segments) = tint_js2c.MinifyScript(self.LINES, 'full')
+    self.assertEqual(lines, "var a=1;\nif(a){\nb(a);\n}\n")
+    self.assertTrue((1, 0, 2, 8) in segments)
+
+  def testLiterals(self):
+    lines = "var s = '  // x  ', r = /  \\/ /g, t = `a\n  b`;\n"
+    self.assertEqual(tint_js2c.MinifyScript(lines, 'full')[0],
+                     "var s='  // x  ',r=/  \\/ /g,t=`a\n  b`;\n")
+
+
+MODULES_MACROS = """\
+const LIMIT = 10;
+macro TWICE(x) = (x + x);
+"""
+
+# Common is an entry point; it requires Foo, which requires Bar. Qux is only
+# required dynamically and Baz not at all.
+MODULES = {
+  'Common': "var Foo = require('Foo');\nvar n = TWICE(2);\n",
+  'Foo': "var Bar = require('./Bar.js');\nexports.s = 'caf\xc3\xa9';\n",
+  'Bar': "// Bar\n" + "exports.x = LIMIT;\n" * 200,
+  'Baz': "exports.unused = true;\n",
+  'Qux': "module.exports = require(name);\n",
+}
+
+EXPANDED = {
+  'Common': "var Foo = require('Foo');\nvar n = (2 + 2);\n",
+  'Foo': MODULES['Foo'],
+  'Bar': "// Bar\n" + "exports.x = 10;\n" * 200,
+  'Baz': MODULES['Baz'],
+  'Qux': MODULES['Qux'],
+}
+
+ORDER = ['Common', 'Foo', 'Bar', 'Baz', 'Qux']
+
+# Prints every native in the order of natives[] as its name, its index as
+# GetNativeIndex() finds it, its encoding and length, and its source.
+DRIVER = """\
+#include <stdio.h>
+#include <string.h>
+#include "natives.h"
+
+int main(int argc, char** argv) {
+  using namespace node;
+#if defined(TINT_NATIVES_BLOB)
+  if (argc < 2 || !MapNativesBlob(argv[1])) return 1;
+#endif
+  for (size_t i = 0; i < sizeof(natives) / sizeof(natives[0]); i++) {
+    const unsigned char* source = GetNativeSource(i);
+    size_t length = GetNativeSourceLength(i);
+    printf("%s %i %i %lu\\n", natives[i].name, GetNativeIndex(natives[i].name),
+           natives[i].encoding, static_cast<unsigned long>(length));
+    fwrite(source, 1, length, stdout);
+    printf("\\n");
+  }
+  return GetNativeIndex("missing") == -1 ? 0 : 2;
+}
+"""
+
+CXX = os.environ.get('CXX', 'g++')
+
+
+class NativesTestCase(unittest.TestCase):
+  """Generates natives from the MODULES in a directory of their own."""
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.directory, 'modules'))
+    self.macros = self.Path('macros.py')
+    self.Write(self.macros, MODULES_MACROS)
+    for id in ORDER:
+      self.Write(self.Module(id), MODULES[id])
+    self.header = self.Path('natives.h')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def Path(self, *names):
+    return os.path.join(self.directory, *names)
+
+  def Module(self, id):
+    return self.Path('modules', id + '.js')
+
+  def Write(self, path, contents):
+    file = open(path, 'wb')
+    try:
+      file.write(contents)
+    finally:
+      file.close()
+
+  def Read(self, path):
+    file = open(path, 'rb')
+    try:
+      return file.read()
+    finally:
+      file.close()
+
+  def Generate(self, ids=ORDER, **options):
+    sources = [self.Module(id) for id in ids] + [self.macros]
+    return tint_js2c.JS2C(sources, [self.header], **options)
+
+  def Stats(self, **options):
+    stats = self.Path('stats.json')
+    self.Generate(stats=stats, **options)
+    return dict((module['id'], module)
+                for module in json.loads(self.Read(stats))['modules'])
+
+  def Natives(self):
+    natives = self.Read(self.header).split('natives[] = {', 1)[1]
+    return re.findall(r'\{ "([^"]*)", ', natives.split('};', 1)[0])
+
+  def Compile(self, shards=0, libraries=[], blob=None):
+    """Compile the generated header and run it.
+
+    Returns:
+      A list of the (id, index, encoding, source) of every native.
+    """
+    if not find_executable(CXX):
+      self.skipTest('%s is needed to compile the natives.' % CXX)
+    driver = self.Path('driver.cc')
+    self.Write(driver, DRIVER)
+    program = self.Path('driver')
+    subprocess.check_call([CXX, '-w', '-o', program, driver] +
+                          tint_js2c.ShardFiles(self.header, shards) +
+                          libraries)
+    output = subprocess.check_output([program] + ([blob] if blob else []))
+    natives = []
+    position = 0
+    while position < len(output):
+      end = output.index('\n', position)
+      (id, index, encoding, length) = output[position:end].split(' ')
+      source = output[end + 1:end + 1 + int(length)]
+      natives.append((id, int(index), int(encoding), source))
+      position = end + 2 + int(length)
+    return natives
+
+  def assertNatives(self, natives, ids=ORDER):
+    self.assertEqual([native[0] for native in natives], ids)
+    for (i, (id, index, encoding, source)) in enumerate(natives):
+      self.assertEqual(index, i)
+      self.assertEqual(source, EXPANDED[id])
+      self.assertEqual(encoding, int(id == 'Foo'))
+
+
+class OutputTest(NativesTestCase):
+  def Check(self, format, shards=0, compression='off', blob=None):
+    self.Generate(format=format, shards=shards, compression=compression,
+                  blob=blob)
+    libraries = ['-lz'] if compression != 'off' else []
+    self.assertNatives(self.Compile(shards, libraries, blob))
+
+  def testFormats(self):
+    for format in ['array', 'string', 'incbin']:
+      for compression in ['off', 'deflate']:
+        self.Check(format, compression=compression)
+
+  def testShards(self):
+    for format in ['array', 'string']:
+      for compression in ['off', 'deflate']:
+        self.Check(format, 2, compression)
+    self.Check('array', 7)
+
+  def testBlob(self):
+    for compression in ['off', 'deflate']:
+      self.Check('array', compression=compression,
+                 blob=self.Path('natives.bin'))
+
+  def testCompressedCodecs(self):
+    self.Generate(format='array', compression='deflate')
+    header = self.Read(self.header)
+    # Only Bar gets smaller deflated.
+    self.assertEqual(header.count(', NATIVE_CODEC_DEFLATE }'), 1)
+    self.assertEqual(header.count(', NATIVE_CODEC_NONE }'), len(ORDER) - 1)
+
+  def testLookups(self):
+    self.Generate(format='array')
+    self.assertTrue('native_hash_slots' in self.Read(self.header))
+    self.assertNatives(self.Compile())
+    # Where no perfect hash is found the ids are searched.
+    perfect_hash = js2c_common.PerfectHash
+    js2c_common.PerfectHash = lambda names: None
+    try:
+      self.Generate(format='array')
+    finally:
+      js2c_common.PerfectHash = perfect_hash
+    self.assertTrue('native_sorted_indices' in self.Read(self.header))
+    self.assertNatives(self.Compile())
+
+  def testJobs(self):
+    self.Generate(format='string', compression='deflate')
+    serial = self.Read(self.header)
+    self.Generate(format='string', compression='deflate', jobs=3)
+    self.assertEqual(self.Read(self.header), serial)
+
+  def testLoadOrder(self):
+    load_order = self.Path('load_order.txt')
+    self.Write(load_order, "# Loaded first\nBar\nCommon\n")
+    for format in ['array', 'string', 'incbin']:
+      self.Generate(format=format, load_order=load_order)
+      self.assertTrue('TINT_NATIVES_PAGE' in self.Read(self.header))
+      self.assertNatives(self.Compile(),
+                         ['Bar', 'Common', 'Foo', 'Baz', 'Qux'])
+
+  def testSourceMaps(self):
+    source_map = self.Path('natives.map')
+    self.Generate(format='array', source_map=source_map)
+    maps = json.loads(self.Read(source_map))
+    self.assertEqual(sorted(maps), sorted(ORDER))
+    self.assertEqual(maps['Common']['file'], 'native Common.js')
+    self.assertEqual(maps['Common']['sources'], [self.Module('Common')])
+    self.assertEqual(maps['Common']['mappings'], 'AAAA;AACA;AACA')
+    self.Generate(format='array', minify='full', source_map=source_map)
+    natives = self.Compile()
+    self.assertEqual(natives[0][3], "var Foo=require('Foo');\nvar n=(2+2);\n")
+    # A segment wherever a token moved relative to the one before it.
+    mappings = json.loads(self.Read(source_map))['Common']['mappings']
+    self.assertEqual(mappings, 'AAAA,OAAQ,CAAE;AACV,KAAM,CAAE,EAAG,CAAE')
+
+  def testDev(self):
+    self.Generate(format='array', dev=True)
+    header = self.Read(self.header)
+    # Only the modules without macros are read from the checkout.
+    for id in ['Foo', 'Baz', 'Qux']:
+      self.assertTrue('"%s"' % self.Module(id) in header)
+    self.assertFalse('"%s"' % self.Module('Common') in header)
+    self.assertNatives(self.Compile())
+    self.Write(self.Module('Baz'), "exports.unused = false;\n")
+    self.assertEqual(self.Compile()[3][3], "exports.unused = false;\n")
+
+
+class PruneTest(NativesTestCase):
+  def setUp(self):
+    NativesTestCase.setUp(self)
+    self.keep = self.Path('keep.txt')
+    self.Write(self.keep, "Q*\n")
+
+  def testGraph(self):
+    graph = tint_js2c.RequireGraph([self.Module(id) for id in ORDER],
+                                   tint_js2c.DEFAULT_ENTRY_POINTS, [])
+    self.assertEqual(graph['entries'], ['Common'])
+    self.assertEqual(graph['reachable'], ['Bar', 'Common', 'Foo'])
+    self.assertEqual(graph['unreachable'], ['Baz', 'Qux'])
+    self.assertEqual(graph['edges']['Foo'], ['Bar'])
+    self.assertEqual(graph['dynamic'], { 'Qux': 1 })
+
+  def testPrune(self):
+    self.Generate(format='array', prune=True, keep=[self.keep])
+    self.assertEqual(self.Natives(), ['Common', 'Foo', 'Bar', 'Qux'])
+    self.assertNatives(self.Compile(), ['Common', 'Foo', 'Bar', 'Qux'])
+
+  def testEntries(self):
+    self.Generate(format='array', prune=True, entries=['Foo'])
+    self.assertEqual(self.Natives(), ['Foo', 'Bar'])
+
+  def testReport(self):
+    report = self.Path('report.json')
+    dependencies = self.Generate(format='array', keep=[self.keep],
+                                 require_report=report)
+    self.assertTrue(self.keep in dependencies)
+    self.assertEqual(self.Natives(), ORDER)
+    self.assertEqual(json.loads(self.Read(report))['unreachable'], ['Baz'])
+
+
+class CacheTest(NativesTestCase):
+  def Cached(self, **options):
+    modules = self.Stats(format='array', **options)
+    return sorted(id for id in modules if modules[id]['cached'])
+
+  def testHits(self):
+    cache_dir = self.Path('cache')
+    self.assertEqual(self.Cached(cache_dir=cache_dir), [])
+    header = self.Read(self.header)
+    os.remove(self.header)
+    self.assertEqual(self.Cached(cache_dir=cache_dir), sorted(ORDER))
+    self.assertEqual(self.Read(self.header), header)
+
+  def testInvalidation(self):
+    cache_dir = self.Path('cache')
+    self.Cached(cache_dir=cache_dir)
+    self.Write(self.Module('Baz'), "exports.unused = 1;\n")
+    self.assertEqual(self.Cached(cache_dir=cache_dir),
+                     ['Bar', 'Common', 'Foo', 'Qux'])
+    # Other macros, or other options, make for other expansions.
+    self.Write(self.macros, MODULES_MACROS + "const OTHER = 1;\n")
+    self.assertEqual(self.Cached(cache_dir=cache_dir), [])
+    self.assertEqual(self.Cached(cache_dir=cache_dir, minify='full'), [])
+
+  def testPrune(self):
+    cache_dir = self.Path('cache')
+    self.Cached(cache_dir=cache_dir)
+    self.Write(self.Module('Baz'), "exports.unused = 1;\n")
+    self.Cached(cache_dir=cache_dir)
+    (directory,) = os.listdir(cache_dir)
+    self.assertEqual(len(os.listdir(os.path.join(cache_dir, directory))),
+                     len(ORDER))
+
+  def testMemory(self):
+    memory = {}
+    self.assertEqual(self.Cached(memory=memory), [])
+    self.assertEqual(len(memory), len(ORDER))
+    self.assertEqual(self.Cached(memory=memory), sorted(ORDER))
+
+
+class WatchTest(NativesTestCase):
+  def testChanged(self):
+    watcher = tint_js2c.FileWatcher(0.01)
+    watcher.Watch([self.Module(id) for id in ORDER])
+    self.assertEqual(watcher.Changed(), [])
+    self.Write(self.Module('Baz'), "exports.unused = 1;\n")
+    self.assertEqual(watcher.Wait(), [self.Module('Baz')])
+
+  def testRegenerate(self):
+    runs = []
+    def Run(memory, first):
+      runs.append(first)
+      if len(runs) > 1:
+        raise KeyboardInterrupt()
+      dependencies = self.Generate(format='array', memory=memory)
+      # Edit a module once the watcher has looked at them.
+      threading.Timer(0.1, self.Write,
+                      (self.Module('Baz'), "exports.unused = 1;\n")).start()
+      return dependencies
+    stdout = tempfile.TemporaryFile()
+    try:
+      self.assertRaises(KeyboardInterrupt, Redirect, stdout,
+                        tint_js2c.Watch, Run, 0.01)
+    finally:
+      stdout.close()
+    self.assertEqual(runs, [True, False])
+
+
+def Redirect(file, function, *args):
+  """Call function with sys.stdout going to file."""
+  stdout = sys.stdout
+  sys.stdout = file
+  try:
+    return function(*args)
+  finally:
+    sys.stdout = stdout
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+#
+# Reports how much every module adds to the natives embedded in tint, and
+# checks the sizes against a budget:
+#
+#   tint_natives_size.py [--platform=linux|mac|win|all] [--budget=file.json]
+#
+# The modules are read from the library_files and <platform>_library_files
+# lists of tint.gyp. For every module the report gives its raw size, its
+# size after macro expansion, after full minification and after deflating
+# that, and the size it is embedded with in the build (with the given
+# --minify and --compression, as passed to tint_js2c.py) along with its share
+# of the natives of the platform.
+#
+# A budget file limits the embedded size of single modules and the total per
+# platform, in bytes:
+#
+#   {
+#     "total": { "linux": 1500000, "mac": 2000000, "win": 2000000 },
+#     "module": 40960,
+#     "modules": { "modules/Bridge/ref.js": 49152 }
+#   }
+#
+# "total" may also be a single number for all platforms, "module" is the
+# allowance of every module not listed in "modules". With --budget the
+# script exits with 1 when anything is over its allowance; the build runs it
+# when GYP_DEFINES sets tint_natives_budget to a budget file.
+
+import ast
+import json
+import optparse
+import os
+import sys
+import zlib
+
+import tint_js2c
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PLATFORMS = ['linux', 'mac', 'win']
+
+HOST_PLATFORMS = { 'darwin': 'mac', 'win32': 'win', 'cygwin': 'win' }
+
+
+def ReadGyp(filename):
+  """Read the variables of a .gyp file, which is a Python literal."""
+  input = open(filename)
+  try:
+    return ast.literal_eval(input.read())
+  finally:
+    input.close()
+
+
+def FindMacroFiles(value):
+  """List the *macros.py files anywhere in a parsed .gyp value."""
+  if isinstance(value, dict):
+    value = value.values()
+  if isinstance(value, list):
+    result = []
+    for item in value:
+      for name in FindMacroFiles(item):
+        if name not in result:
+          result.append(name)
+    return result
+  if isinstance(value, str) and value.endswith('macros.py'):
+    return [value]
+  return []
+
+
+def ReadModuleLists(gyp):
+  """Read the module lists of tint.gyp.
+
+  Returns:
+    A tuple of a dict from list name to the modules in it, without
+    duplicates, and the macro files the tint_js2c action reads.
+  """
+  variables = gyp['variables']
+  lists = {}
+  for name in ['library_files'] + [p + '_library_files' for p in PLATFORMS]:
+    modules = []
+    for module in variables[name]:
+      if module not in modules:
+        modules.append(module)
+    lists[name] = modules
+  macro_files = []
+  for target in gyp['targets']:
+    if target['target_name'] == 'tint_js2c':
+      macro_files = FindMacroFiles(target['actions'])
+  return (lists, macro_files)
+
+
+def MeasureModule(filename, constants, macros, minify, compression):
+  """Measure the sizes of one module along the tint_js2c.py pipeline."""
+  lines = tint_js2c.ReadFile(filename)
+  expanded = macros.Expand(constants.Expand(lines))
+  minified = tint_js2c.MinifyScript(expanded, 'full')[0]
+  (embedded, segments) = tint_js2c.ProcessSource(lines, constants, macros,
+                                                 minify)
+  (codec, payload) = tint_js2c.CompressSource(embedded, compression)
+  return {
+    'raw': len(lines),
+    'expanded': len(expanded),
+    'minified': len(minified),
+    'deflated': len(zlib.compress(minified, 9)),
+    'embedded': len(payload),
+  }
+
+
+def Measure(root, lists, macro_files, platforms, minify, compression):
+  """Measure the modules of every platform.
+
+  Returns:
+    A dict from platform to a dict with a 'modules' list of the sizes of
+    every module, its 'file' and the 'list' it is in, the 'total' embedded
+    size and the 'missing' modules.
+  """
+  macro_lines = []
+  for name in macro_files:
+    path = os.path.join(root, name)
+    if os.path.exists(path):
+      macro_lines.extend(tint_js2c.ReadLines(path))
+  (constants, macros) = tint_js2c.ReadMacros(macro_lines)
+  constants = tint_js2c.ConstantExpander(constants)
+  macros = tint_js2c.MacroExpander(macros)
+
+  sizes = {}
+  report = {}
+  for platform in platforms:
+    modules = []
+    missing = []
+    for list_name in ('library_files', platform + '_library_files'):
+      for module in lists[list_name]:
+        path = os.path.join(root, module)
+        if not os.path.exists(path):
+          missing.append(module)
+          continue
+        if module not in sizes:
+          sizes[module] = MeasureModule(path, constants, macros, minify,
+                                        compression)
+        entry = dict(sizes[module])
+        entry['file'] = module
+        entry['list'] = list_name
+        modules.append(entry)
+    total = sum(module['embedded'] for module in modules)
+    for module in modules:
+      module['share'] = float(module['embedded']) / total if total else 0
+    report[platform] = {
+      'modules': modules,
+      'total': total,
+      'missing': missing,
+    }
+  return report
+
+
+def CheckBudget(report, budget):
+  """List everything in report that is over its allowance in budget."""
+  failures = []
+  for platform in sorted(report):
+    total = budget.get('total')
+    if isinstance(total, dict):
+      total = total.get(platform)
+    if total is not None and report[platform]['total'] > total:
+      failures.append('%s: natives are %i bytes, over the budget of %i' % (
+          platform, report[platform]['total'], total))
+    for module in report[platform]['modules']:
+      allowance = budget.get('modules', {}).get(module['file'],
+                                                budget.get('module'))
+      failure = '%s: %i bytes, over the budget of %i' % (
+          module['file'], module['embedded'], allowance or 0)
+      if (allowance is not None and module['embedded'] > allowance and
+          failure not in failures):
+        failures.append(failure)
+  return failures
+
+
+def PrintReport(report):
+  for platform in sorted(report):
+    print '%s natives: %i bytes' % (platform, report[platform]['total'])
+    list_name = None
+    for module in sorted(report[platform]['modules'],
+                         key=lambda module: (module['list'],
+                                             -module['embedded'])):
+      if module['list'] != list_name:
+        list_name = module['list']
+        print '  %s:' % list_name
+        print '    %8s %8s %8s %8s %8s %6s  %s' % (
+            'raw', 'expanded', 'minified', 'deflated', 'embedded', 'share',
+            'module')
+      print '    %8i %8i %8i %8i %8i %5.1f%%  %s' % (
+          module['raw'], module['expanded'], module['minified'],
+          module['deflated'], module['embedded'], module['share'] * 100,
+          module['file'])
+    if report[platform]['missing']:
+      print '  %i modules not found, left out:' % len(
+          report[platform]['missing'])
+      for module in report[platform]['missing']:
+        print '    ' + module
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.set_usage('tint_natives_size.py [options]')
+  parser.add_option('--gyp', action='store',
+                    default=os.path.join(os.path.dirname(TOOLS_DIR),
+                                         'tint.gyp'),
+                    help='the .gyp file to read the module lists from.')
+  parser.add_option('--platform', action='store',
+                    default=HOST_PLATFORMS.get(sys.platform, 'linux'),
+                    choices=PLATFORMS + ['all'],
+                    help='platform to report on: linux, mac, win or all.')
+  parser.add_option('--minify', action='store', default='none',
+                    choices=['none', 'whitespace', 'full'],
+                    help='minify level the natives are built with.')
+  parser.add_option('--compression', action='store', default='off',
+                    choices=['off', 'deflate'],
+                    help='compression the natives are built with.')
+  parser.add_option('--budget', action='store',
+                    help='budget file to check the embedded sizes against.')
+  parser.add_option('--json', action='store',
+                    help='file to write the report to, as JSON.')
+  parser.add_option('--quiet', action='store_true',
+                    help="don't print the report.")
+  (options, args) = parser.parse_args()
+
+  platforms = PLATFORMS if options.platform == 'all' else [options.platform]
+  (lists, macro_files) = ReadModuleLists(ReadGyp(options.gyp))
+  report = Measure(os.path.dirname(os.path.abspath(options.gyp)), lists,
+                   macro_files, platforms, options.minify,
+                   options.compression)
+  if not options.quiet:
+    PrintReport(report)
+  if options.json:
+    output = open(options.json, 'w')
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.close()
+
+  if options.budget:
+    input = open(options.budget)
+    failures = CheckBudget(report, json.load(input))
+    input.close()
+    if failures:
+      print >> sys.stderr, 'Natives over budget (%s):' % options.budget
+      for failure in failures:
+        print >> sys.stderr, '  ' + failure
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -33,9 +33,20 @@
 
 import os, re, sys, string
 import optparse
+import multiprocessing
 import jsmin
+# The build copies this script alone over deps/v8/tools/js2c.py of the node
+# checkout in libraries/node; js2c_common.py stays in the tools directory
+# of the checkout of tint.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', '..', '..', '..', 'tools'))
+import js2c_common
 import bz2
+import struct
 import textwrap
+import time
+import unicodedata
+import zlib
 
 
 class Error(Exception):
@@ -51,13 +62,6 @@ def ToCArray(byte_sequence):
   return textwrap.fill(joined, 80)
 
 
-def RemoveCommentsAndTrailingWhitespace(lines):
-  lines = re.sub(r'//.*\n', '\n', lines) # end-of-line comments
-  lines = re.sub(re.compile(r'/\*.*?\*/', re.DOTALL), '', lines) # comments.
-  lines = re.sub(r'\s+\n+', '\n', lines) # trailing whitespace
-  return lines
-
-
 def ReadFile(filename):
   file = open(filename, "rt")
   try:
@@ -67,79 +71,154 @@ def ReadFile(filename):
   return lines
 
 
-EVAL_PATTERN = re.compile(r'\beval\s*\(')
-WITH_PATTERN = re.compile(r'\bwith\s*\(')
+def CompileWordPattern(names):
+  """Compile a pattern matching any of names as a whole word."""
+  if not names:
+    return None
+  names = sorted(set(names), key=lambda name: (-len(name), name))
+  return re.compile(r'\b(?:%s)\b' % '|'.join(map(re.escape, names)))
 
-def Validate(lines):
-  # Because of simplified context setup, eval and with is not
-  # allowed in the natives files.
-  if EVAL_PATTERN.search(lines):
-    raise Error("Eval disallowed in natives.")
-  if WITH_PATTERN.search(lines):
-    raise Error("With statements disallowed in natives.")
 
-  # Pass lines through unchanged.
-  return lines
+class ConstantExpander:
+  """Substitutes a list of constants in a single pass over a file.
+
+  All constant names are matched as whole words by one regular expression.
+  Constants used to be substituted one after the other in declaration order,
+  so the value of a constant is expanded up front with the constants
+  declared after it; the first declaration of a name wins.
+  """
+  def __init__(self, constants):
+    self.pattern = CompileWordPattern([name for (name, value) in constants])
+    self.expansions = 0
+    self.index = {}
+    for i in xrange(len(constants)):
+      self.index.setdefault(constants[i][0], i)
+    self.values = {}
+    for name in self.index:
+      self.Resolve(constants, name)
+
+  def Resolve(self, constants, name):
+    if name not in self.values:
+      i = self.index[name]
+      def substitute(match):
+        other = match.group()
+        if self.index[other] > i:
+          return self.Resolve(constants, other)
+        return other
+      self.values[name] = self.pattern.sub(substitute, str(constants[i][1]))
+    return self.values[name]
+
+  def Expand(self, lines):
+    if self.pattern is None:
+      return lines
+    (lines, count) = self.pattern.subn(
+        lambda match: self.values[match.group()], lines)
+    self.expansions = self.expansions + count
+    return lines
 
 
 def ExpandConstants(lines, constants):
-  for key, value in constants:
-    lines = key.sub(str(value), lines)
-  return lines
+  return ConstantExpander(constants).Expand(lines)
 
 
-def ExpandMacroDefinition(lines, pos, name_pattern, macro, expander):
-  pattern_match = name_pattern.search(lines, pos)
-  while pattern_match is not None:
-    # Scan over the arguments
-    height = 1
-    start = pattern_match.start()
-    end = pattern_match.end()
-    assert lines[end - 1] == '('
-    last_match = end
-    arg_index = [0]  # Wrap state into array, to work around Python "scoping"
-    mapping = { }
-    def add_arg(str):
-      # Remember to expand recursively in the arguments
-      replacement = expander(str.strip())
-      mapping[macro.args[arg_index[0]]] = replacement
-      arg_index[0] += 1
-    while end < len(lines) and height > 0:
-      # We don't count commas at higher nesting levels.
-      if lines[end] == ',' and height == 1:
-        add_arg(lines[last_match:end])
-        last_match = end + 1
-      elif lines[end] in ['(', '{', '[']:
-        height = height + 1
-      elif lines[end] in [')', '}', ']']:
-        height = height - 1
-      end = end + 1
-    # Remember to add the last match.
-    add_arg(lines[last_match:end-1])
-    result = macro.expand(mapping)
-    # Replace the occurrence of the macro with the expansion
-    lines = lines[:start] + result + lines[end:]
-    pattern_match = name_pattern.search(lines, start + len(result))
-  return lines
+# Characters that matter when scanning the arguments of a macro call.
+MACRO_ARGUMENT_PATTERN = re.compile(r'[,(){}\[\]]')
+
+def ParseMacroArguments(lines, start):
+  """Split the arguments of the macro call whose '(' ends at start.
+
+  Commas only separate arguments at the outermost nesting level.
+
+  Returns:
+    A tuple of the list of (unstripped) arguments and the position just past
+    the closing parenthesis.
+  """
+  height = 1
+  args = []
+  last = start
+  for match in MACRO_ARGUMENT_PATTERN.finditer(lines, start):
+    c = match.group()
+    if c == ',':
+      if height == 1:
+        args.append(lines[last:match.start()])
+        last = match.end()
+    elif c in '({[':
+      height = height + 1
+    else:
+      height = height - 1
+      if height == 0:
+        args.append(lines[last:match.start()])
+        return (args, match.end())
+  # An unterminated call swallows the rest of the file.
+  args.append(lines[last:len(lines) - 1])
+  return (args, len(lines))
+
+
+class MacroExpander:
+  """Expands the calls to a list of macros in a single scan over a file.
+
+  All macro names are matched by one regular expression. We allow macros to
+  depend on the previously declared macros, so the arguments of a call are
+  expanded with all macros and its expansion is expanded again with the
+  macros declared before it.
+  """
+  def __init__(self, macros):
+    self.macros = dict(macros)
+    self.expansions = 0
+    self.previous = {}
+    for i in xrange(len(macros)):
+      self.previous[macros[i][0]] = frozenset(name for (name, macro)
+                                              in macros[:i])
+    self.pattern = None
+    if macros:
+      names = '|'.join(re.escape(name) for name in sorted(self.macros))
+      self.pattern = re.compile(r'\b(%s)\(' % names)
+
+  def Expand(self, lines, allowed=None):
+    if self.pattern is None:
+      return lines
+    result = []
+    last = 0
+    match = self.pattern.search(lines)
+    while match is not None:
+      name = match.group(1)
+      if allowed is not None and name not in allowed:
+        match = self.pattern.search(lines, match.end())
+        continue
+      macro = self.macros[name]
+      (args, end) = ParseMacroArguments(lines, match.end())
+      args = [self.Expand(arg.strip()) for arg in args]
+      expansion = macro.expand(dict(zip(macro.args, args)))
+      self.expansions = self.expansions + 1
+      expansion = self.Expand(expansion, self.previous[name])
+      result.append(lines[last:match.start()])
+      result.append(expansion)
+      last = end
+      match = self.pattern.search(lines, end)
+    result.append(lines[last:])
+    return ''.join(result)
+
 
 def ExpandMacros(lines, macros):
-  # We allow macros to depend on the previously declared macros, but
-  # we don't allow self-dependecies or recursion.
-  for name_pattern, macro in reversed(macros):
-    def expander(s):
-      return ExpandMacros(s, macros)
-    lines = ExpandMacroDefinition(lines, 0, name_pattern, macro, expander)
-  return lines
+  return MacroExpander(macros).Expand(lines)
 
 class TextMacro:
   def __init__(self, args, body):
     self.args = args
     self.body = body
+    # Split the body at every argument name up front; odd entries of the
+    # template are the argument slots.
+    names = sorted(set(arg for arg in args if arg), key=len, reverse=True)
+    if names:
+      pattern = re.compile('(%s)' % '|'.join(map(re.escape, names)))
+      self.template = pattern.split(body)
+    else:
+      self.template = [body]
   def expand(self, mapping):
-    result = self.body
-    for key, value in mapping.items():
-        result = result.replace(key, value)
-    return result
+    result = list(self.template)
+    for i in xrange(1, len(result), 2):
+      result[i] = mapping.get(result[i], result[i])
+    return ''.join(result)
 
 class PythonMacro:
   def __init__(self, args, fun):
@@ -168,14 +247,14 @@ def ReadMacros(lines):
     if const_match:
       name = const_match.group(1)
       value = const_match.group(2).strip()
-      constants.append((re.compile("\\b%s\\b" % name), value))
+      constants.append((name, value))
     else:
       macro_match = MACRO_PATTERN.match(line)
       if macro_match:
         name = macro_match.group(1)
         args = [match.strip() for match in macro_match.group(2).split(',')]
         body = macro_match.group(3).strip()
-        macros.append((re.compile("\\b%s\\(" % name), TextMacro(args, body)))
+        macros.append((name, TextMacro(args, body)))
       else:
         python_match = PYTHON_MACRO_PATTERN.match(line)
         if python_match:
@@ -183,60 +262,429 @@ def ReadMacros(lines):
           args = [match.strip() for match in python_match.group(2).split(',')]
           body = python_match.group(3).strip()
           fun = eval("lambda " + ",".join(args) + ': ' + body)
-          macros.append((re.compile("\\b%s\\(" % name), PythonMacro(args, fun)))
+          macros.append((name, PythonMacro(args, fun)))
         else:
           raise Error("Illegal line: " + line)
   return (constants, macros)
 
-INLINE_MACRO_PATTERN = re.compile(r'macro\s+([a-zA-Z0-9_]+)\s*\(([^)]*)\)\s*\n')
-INLINE_MACRO_END_PATTERN = re.compile(r'endmacro\s*\n')
-
-def ExpandInlineMacros(lines):
-  pos = 0
-  while True:
-    macro_match = INLINE_MACRO_PATTERN.search(lines, pos)
-    if macro_match is None:
-      # no more macros
-      return lines
-    name = macro_match.group(1)
-    args = [match.strip() for match in macro_match.group(2).split(',')]
-    end_macro_match = INLINE_MACRO_END_PATTERN.search(lines, macro_match.end());
-    if end_macro_match is None:
-      raise Error("Macro %s unclosed" % name)
-    body = lines[macro_match.end():end_macro_match.start()]
-
-    # remove macro definition
-    lines = lines[:macro_match.start()] + lines[end_macro_match.end():]
-    name_pattern = re.compile("\\b%s\\(" % name)
-    macro = TextMacro(args, body)
+# Names of inline macros and constants.
+INLINE_NAME_PATTERN = re.compile(r'[a-zA-Z0-9_]+$')
+WORD_PATTERN = re.compile(r'[a-zA-Z0-9_]+')
+
+# The script filters only stop where there is something for them to do; the
+# rest of a script, strings included, goes by in the 'skip' group of their
+# patterns. They also stop at every '/' and '`', for a look back at whether
+# a regular expression or a template starts there.
+SCRIPT_WORD_CHARS = r'A-Za-z0-9_$\\\x80-\xff'
+SCRIPT_LITERAL = (r'''"[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"|'''
+                  r"""'[^'\\\n]*(?:\\[\s\S][^'\\\n]*)*'""")
+SCRIPT_STRING = SCRIPT_LITERAL + r"""|["']"""
+SCRIPT_SPACE = ' \t\f\v\r\n'
+
+# StripScript() goes by the strings that stay on their line and stops at the
+# other literals, which may span lines.
+STRIP_PATTERN = re.compile(r"""
+    (?P<skip>(?:
+        [^"'/`]+
+      | "[^"\\\n]*(?:\\.[^"\\\n]*)*"
+      | '[^'\\\n]*(?:\\.[^'\\\n]*)*'
+      | (?!%(literal)s)["']
+    )*)
+    (?: (?P<comment>//[^\n]*|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/)
+      | (?P<slash>/)
+      | (?P<literal>%(literal)s|`)
+      | \Z)
+""" % { 'literal': SCRIPT_LITERAL }, re.VERBOSE)
+
+# Words that ScriptFilter has to walk a script for, with patterns that start
+# with the word for the sake of the speed of the search.
+FILTER_WORDS = [
+  (word, re.compile('%s(?<![%s]%s)(?![%s])' % (word, SCRIPT_WORD_CHARS, word,
+                                              SCRIPT_WORD_CHARS)))
+  for word in ('eval', 'with', 'macro', 'const')
+]
+
+SCAN_PATTERN = r"""
+    (?P<skip>(?:[^"'/`%(plain)s]+|%(string)s%(words)s)*)
+    (?:(?P<slash>/)|(?P<template>`)|(?P<word>%(stop)s)|\Z)
+"""
 
-    # advance position to where the macro defintion was
-    pos = macro_match.start()
+def ScanPattern(stop, plain, words=''):
+  """Compile a pattern for ScanTo().
 
-    def non_expander(s):
-      return s
-    lines = ExpandMacroDefinition(lines, pos, name_pattern, macro, non_expander)
+  Args:
+    stop: Pattern of what to stop at.
+    plain: Characters of a character class that can't start stop.
+    words: Further alternatives of what to skip, each starting with '|'.
+  """
+  return re.compile(SCAN_PATTERN % {
+    'plain': plain,
+    'string': SCRIPT_STRING,
+    'words': words,
+    'stop': stop,
+  }, re.VERBOSE)
+
+
+def NamesPattern(names):
+  # Stops at the names as whole words. Only the letters they start with stop
+  # the plain characters, and then the rest of a word goes by unless it is
+  # one of them.
+  first = ''.join(sorted(set(name[0] for name in names)))
+  names = '(?:%s)(?![%s])' % ('|'.join(sorted(names, key=len, reverse=True))
+                              or '(?!)', SCRIPT_WORD_CHARS)
+  return ScanPattern(names, first,
+                     '|(?<=[%s])[%s]+|(?!%s)[%s]+' % (
+                         SCRIPT_WORD_CHARS, SCRIPT_WORD_CHARS, names,
+                         SCRIPT_WORD_CHARS))
+
+
+ARGUMENT_PATTERN = ScanPattern(r'[,()\[\]{}]', r',()\[\]{}')
+CLOSE_PATTERN = ScanPattern(r'\)', r')')
+ENDMACRO_PATTERN = NamesPattern(['endmacro'])
+CONSTANT_END_PATTERN = ScanPattern(r'[\n;]', r'\n;')
+INLINE_MACRO_PATTERN = re.compile(r'\s+([%s]+)\s*\(' % SCRIPT_WORD_CHARS)
+INLINE_CONSTANT_PATTERN = re.compile(r'\s+([%s]+)\s*=\s*' % SCRIPT_WORD_CHARS)
+LINE_END_PATTERN = re.compile(r'[ \t\f\v\r]*\n')
+CALL_PATTERN = re.compile(r'\s*\(')
+
+
+def LastToken(code, previous=None):
+  """Return the last token of some code, as far as
+  js2c_common.RegExpAllowed() cares, or previous if there is none."""
+  code = code.rstrip(SCRIPT_SPACE)
+  if not code:
+    return previous
+  c = code[-1]
+  if c == '+' or c == '-':
+    # A run of them scans as pairs first.
+    if (len(code) - len(code.rstrip(c))) % 2 == 0:
+      return c + c
+    return c
+  if not js2c_common.IsWordChar(c):
+    return c
+  start = len(code) - 1
+  while start > 0 and js2c_common.IsWordChar(code[start - 1]):
+    start = start - 1
+  return code[start:]
+
+
+def LiteralEnd(lines, pos, previous):
+  """Return the end of the template or regular expression at pos, or the
+  position just past the '/' there if it is a division."""
+  if lines[pos] == '`':
+    return js2c_common.ScanTemplate(lines, pos)
+  if js2c_common.RegExpAllowed(previous) and not lines.startswith('/*', pos):
+    match = js2c_common.REGEXP_PATTERN.match(lines, pos)
+    if match:
+      return match.end()
+  return pos + 1
+
+
+def ScanTo(lines, pattern, pos, previous):
+  """Find the next stop of a ScanPattern() pattern in a script, outside of
+  literals.
 
+  Args:
+    lines: The script.
+    pattern: The pattern.
+    pos: Where to start.
+    previous: The token before pos.
 
-INLINE_CONSTANT_PATTERN = re.compile(r'const\s+([a-zA-Z0-9_]+)\s*=\s*([^;\n]+)[;\n]')
+  Returns:
+    A tuple of the match of the stop, or None at the end of the script, and
+    the token before it.
+  """
+  while True:
+    match = pattern.match(lines, pos)
+    start = match.end('skip')
+    previous = LastToken(lines[pos:start], previous)
+    kind = match.lastgroup
+    if kind == 'word':
+      return (match, previous)
+    if kind == 'skip':
+      return (None, previous)
+    pos = LiteralEnd(lines, start, previous)
+    previous = lines[start:pos]
+
+
+def StripLines(code):
+  # Drop the whitespace before the line breaks of some code, and its empty
+  # lines but for the first line break of a run.
+  lines = code.split('\n')
+  if len(lines) == 1:
+    return code
+  last = lines.pop()
+  # str.rstrip() strips just the whitespace of scripts.
+  lines = map(str.rstrip, lines)
+  return '\n'.join([lines[0]] + filter(None, lines[1:]) + [last])
+
+
+def StripScript(lines):
+  """Drop the comments, the whitespace before line breaks and the empty
+  lines of a script. Of a run of line breaks only the first is kept.
 
-def ExpandInlineConstants(lines):
+  Returns:
+    A tuple of the stripped script and whether it has any of the words
+    ScriptFilter has to look at: eval, with, macro and const.
+  """
+  output = []
+  # The code since the last literal that may span lines, and the last part
+  # of it that isn't just whitespace.
+  code = []
+  tail = None
+  previous = None
   pos = 0
   while True:
-    const_match = INLINE_CONSTANT_PATTERN.search(lines, pos)
-    if const_match is None:
-      # no more constants
-      return lines
-    name = const_match.group(1)
-    replacement = const_match.group(2)
-    name_pattern = re.compile("\\b%s\\b" % name)
+    match = STRIP_PATTERN.match(lines, pos)
+    start = match.end('skip')
+    if start != pos:
+      text = lines[pos:start]
+      code.append(text)
+      if not text.isspace():
+        tail = text
+    kind = match.lastgroup
+    if kind == 'skip':
+      break
+    if kind == 'comment':
+      pos = match.end()
+      continue
+    if tail is not None:
+      previous = LastToken(tail, previous)
+      tail = None
+    if kind == 'slash':
+      pos = LiteralEnd(lines, start, previous)
+      previous = lines[start:pos]
+      code.append(previous)
+      continue
+    if lines[start] == '`':
+      pos = js2c_common.ScanTemplate(lines, start)
+    else:
+      pos = match.end()
+    output.append(StripLines(''.join(code)))
+    code = []
+    previous = lines[start:pos]
+    output.append(previous)
+  output.append(StripLines(''.join(code)))
+  lines = ''.join(output)
+  for (word, pattern) in FILTER_WORDS:
+    if word in lines and pattern.search(lines):
+      return (lines, True)
+  return (lines, False)
+
 
-    # remove constant definition and replace
-    lines = (lines[:const_match.start()] +
-             re.sub(name_pattern, replacement, lines[const_match.end():]))
+def MacroArguments(lines, pos):
+  """Split the arguments of the macro call whose '(' is just before pos.
 
-    # advance position to where the constant defintion was
-    pos = const_match.start()
+  Commas only separate arguments at the outermost nesting level.
+
+  Returns:
+    A tuple of the list of the text of every argument and the position just
+    past the closing parenthesis.
+  """
+  height = 1
+  args = []
+  start = pos
+  previous = '('
+  while True:
+    (match, previous) = ScanTo(lines, ARGUMENT_PATTERN, pos, previous)
+    if match is None:
+      break
+    pos = match.end()
+    previous = match.group('word')
+    if previous == ',':
+      if height == 1:
+        args.append(lines[start:pos - 1])
+        start = pos
+    elif previous in '([{':
+      height = height + 1
+    else:
+      height = height - 1
+      if height == 0:
+        args.append(lines[start:pos - 1])
+        return (args, pos)
+  # An unterminated call swallows the rest of the script.
+  args.append(lines[start:])
+  return (args, len(lines))
+
+
+class ScriptFilter:
+  """Runs the script filters that go before minification in one pass over
+  a script: comments, trailing whitespace and empty lines are dropped,
+  inline macros and constants are expanded, and eval and with are refused.
+
+  Inline definitions apply from where they are on. They used to be expanded
+  by a pass over the text per definition, in order, and the walk gives the
+  same results: an expansion is walked again with the macros defined after
+  its macro, and constants are substituted into the final text. Literals
+  are copied as they are.
+  """
+  def __init__(self):
+    self.macros = {}
+    self.count = 0
+    self.constants = {}
+    self.users = {}
+
+  def Filter(self, lines):
+    (lines, words) = StripScript(lines)
+    if not words:
+      return lines
+    return self.Walk(lines, definitions=True)
+
+  def Pattern(self, low, high, final, definitions):
+    # The names a walk has to stop at.
+    names = [name for (name, (order, macro)) in self.macros.items()
+             if order >= low and (high is None or order < high)]
+    if final:
+      names.extend(self.constants)
+      names.extend(('eval', 'with'))
+    if definitions:
+      names.extend(('macro', 'const'))
+    return NamesPattern(names)
+
+  def Walk(self, lines, low=0, high=None, final=True, definitions=False,
+           previous=None):
+    """Walk a script.
+
+    Args:
+      lines: The script, as StripScript() returns it.
+      low, high: Bounds of the definition order of the macros to expand.
+      final: Whether the text is final, so constants are substituted and
+          eval and with refused.
+      definitions: Whether to take inline definitions from the script.
+      previous: The token before the script.
+
+    Returns:
+      The walked text.
+    """
+    output = []
+    pos = 0
+    pattern = self.Pattern(low, high, final, definitions)
+    while True:
+      (match, previous) = ScanTo(lines, pattern, pos, previous)
+      if match is None:
+        output.append(lines[pos:])
+        return ''.join(output)
+      start = match.start('word')
+      end = match.end()
+      output.append(lines[pos:start])
+      name = lines[start:end]
+      pos = end
+      previous = name
+      if definitions and name in ('macro', 'const'):
+        if name == 'macro':
+          defined = self.DefineMacro(lines, end)
+        else:
+          defined = self.DefineConstant(lines, end)
+        if defined is not None:
+          (pos, previous) = defined
+          pattern = self.Pattern(low, high, final, definitions)
+          continue
+      entry = self.macros.get(name)
+      if (entry is not None and entry[0] >= low and
+          (high is None or entry[0] < high) and
+          lines.startswith('(', end)):
+        (order, macro) = entry
+        (args, pos) = MacroArguments(lines, end + 1)
+        args = [self.Walk(arg, low, order, False).strip() for arg in args]
+        expansion = macro.expand(dict(zip(macro.args, args)))
+        output.append(self.Walk(StripScript(expansion)[0], order + 1, high,
+                                final))
+        previous = ')'
+        continue
+      if final:
+        if name in self.constants:
+          output.append(self.constants[name])
+          continue
+        if name in ('eval', 'with') and CALL_PATTERN.match(lines, end):
+          # Because of simplified context setup, eval and with is not
+          # allowed in the natives files.
+          if name == 'eval':
+            raise Error("Eval disallowed in natives.")
+          raise Error("With statements disallowed in natives.")
+      output.append(name)
+
+  def DefineMacro(self, lines, pos):
+    """Take the definition of an inline macro, up to its endmacro line, that
+    starts with the 'macro' just before pos.
+
+    Returns:
+      A tuple of the position just past the definition and the token before
+      it, or None if there is no definition.
+    """
+    match = INLINE_MACRO_PATTERN.match(lines, pos)
+    if not match or not INLINE_NAME_PATTERN.match(match.group(1)):
+      return None
+    name = match.group(1)
+    close = ScanTo(lines, CLOSE_PATTERN, match.end(), '(')[0]
+    if close is None:
+      return None
+    args = lines[match.end():close.start('word')]
+    args = [arg.strip() for arg in args.split(',')]
+    body = LINE_END_PATTERN.match(lines, close.end())
+    if not body:
+      return None
+    body = body.end()
+    pos = body
+    previous = ')'
+    while True:
+      (end, previous) = ScanTo(lines, ENDMACRO_PATTERN, pos, previous)
+      if end is None:
+        raise Error("Macro %s unclosed" % name)
+      after = LINE_END_PATTERN.match(lines, end.end())
+      if after:
+        break
+      pos = end.end()
+      previous = 'endmacro'
+    # The macros defined so far are expanded in the body right away.
+    body = self.Walk(lines[body:end.start('word')], 0, self.count, False,
+                     ')')
+    self.macros[name] = (self.count, TextMacro(args, body))
+    self.count = self.count + 1
+    return (after.end(), 'endmacro')
+
+  def DefineConstant(self, lines, pos):
+    """Take the definition of an inline constant, up to a ';' or the end of
+    its line, that starts with the 'const' just before pos.
+
+    Returns:
+      A tuple of the position just past the definition and the token before
+      it, or None if there is no definition.
+    """
+    match = INLINE_CONSTANT_PATTERN.match(lines, pos)
+    if not match or not INLINE_NAME_PATTERN.match(match.group(1)):
+      return None
+    value = match.end()
+    (end, previous) = ScanTo(lines, CONSTANT_END_PATTERN, value, '=')
+    if end is None or end.start('word') == value:
+      return None
+    self.Define(match.group(1), self.Walk(lines[value:end.start('word')]))
+    if end.group('word') == ';':
+      previous = ';'
+    return (end.end(), previous)
+
+  def Define(self, name, value):
+    # Values substituted earlier are subject to the new constant too.
+    users = self.users.pop(name, ())
+    if users:
+      pattern = re.compile(r'\b%s\b' % name)
+      for other in users:
+        self.constants[other] = pattern.sub(lambda match: value,
+                                            self.constants[other])
+        self.AddUsers(other, value)
+    self.constants[name] = value
+    self.AddUsers(name, value)
+
+  def AddUsers(self, name, value):
+    # Remember which constants have a value that mentions a word, for when
+    # that word is defined as a constant later on.
+    for word in WORD_PATTERN.findall(value):
+      self.users.setdefault(word, set()).add(name)
+
+
+def FilterScript(lines):
+  """Run the script filters that go before minification over a source, as
+  one ScriptFilter walk."""
+  return ScriptFilter().Filter(lines)
 
 
 HEADER_TEMPLATE = """\
@@ -257,6 +705,8 @@ namespace internal {
 
 %(raw_sources_declaration)s\
 
+%(index_lookup_declaration)s\
+
   template <>
   int NativesCollection<%(type)s>::GetBuiltinsCount() {
     return %(builtin_count)i;
@@ -269,8 +719,7 @@ namespace internal {
 
   template <>
   int NativesCollection<%(type)s>::GetIndex(const char* name) {
-%(get_index_cases)s\
-    return -1;
+%(get_index_body)s\
   }
 
   template <>
@@ -320,8 +769,9 @@ RAW_SOURCES_DECLARATION = """\
 """
 
 
-GET_INDEX_CASE = """\
-    if (strcmp(name, "%(id)s") == 0) return %(i)i;
+NATIVE_IDS_DECLARATION = """\
+  static const char* const native_ids[] = { %(ids)s };
+
 """
 
 
@@ -335,29 +785,61 @@ GET_SCRIPT_NAME_CASE = """\
 """
 
 
-def BuildFilterChain(macro_filename):
-  """Build the chain of filter functions to be applied to the sources.
+def BuildIndexLookup(ids):
+  """Build GetIndex() for the natives with the given ids.
+
+  Returns:
+    A tuple of the tables to declare and the body of GetIndex().
+  """
+  lookup = js2c_common.IndexLookup(ids, 'native_ids', 'native_ids[index]')
+  if not lookup:
+    return ("", "    return -1;\n")
+  (tables, body) = lookup
+  ids = ", ".join('"%s"' % id for id in ids)
+  return (NATIVE_IDS_DECLARATION % { "ids": ids } +
+          js2c_common.Indent(tables, "  "),
+          js2c_common.Indent(body, "    "))
+
+
+def BuildFilters(macro_filename):
+  """Build the list of filters to be applied to the sources after reading.
 
   Args:
     macro_filename: Name of the macro file, if any.
 
   Returns:
-    A function (string -> string) that reads a source file and processes it.
+    A list of (name, function, expander) tuples, where function is a
+    string -> string filter and expander is the ConstantExpander or
+    MacroExpander it belongs to, if any.
   """
-  filter_chain = [ReadFile]
+  filters = []
 
   if macro_filename:
     (consts, macros) = ReadMacros(ReadFile(macro_filename))
-    filter_chain.append(lambda l: ExpandConstants(l, consts))
-    filter_chain.append(lambda l: ExpandMacros(l, macros))
-
-  filter_chain.extend([
-    RemoveCommentsAndTrailingWhitespace,
-    ExpandInlineMacros,
-    ExpandInlineConstants,
-    Validate,
-    jsmin.JavaScriptMinifier().JSMinify
+    constants = ConstantExpander(consts)
+    macros = MacroExpander(macros)
+    filters.append(('constants', constants.Expand, constants))
+    filters.append(('macros', macros.Expand, macros))
+
+  filters.extend([
+    ('script', FilterScript, None),
+    ('jsmin', jsmin.JavaScriptMinifier().JSMinify, None)
   ])
+  return filters
+
+
+def BuildFilterChain(macro_filename):
+  """Build the chain of filter functions to be applied to the sources.
+
+  Args:
+    macro_filename: Name of the macro file, if any.
+
+  Returns:
+    A function (string -> string) that reads a source file and processes it.
+  """
+  filter_chain = [ReadFile]
+  filter_chain.extend(function for (name, function, expander)
+                      in BuildFilters(macro_filename))
 
   def chain(f1, f2):
     return lambda x: f2(f1(x))
@@ -365,11 +847,138 @@ def BuildFilterChain(macro_filename):
   return reduce(chain, filter_chain)
 
 
+def WriteStats(filename, start, run, sources):
+  """Write the --stats report of a run.
+
+  Args:
+    filename: File to write the report to, as JSON.
+    start: Time the run started at.
+    run: List of StageStats stages of the run as a whole.
+    sources: A Sources instance with the prepared sources.
+  """
+  modules = []
+  for (i, (name, stages)) in enumerate(zip(sources.names, sources.stages)):
+    module = { 'id': name, 'stages': stages }
+    if sources.encodings:
+      module['encoding'] = sources.encodings[i]
+    modules.append(module)
+  js2c_common.WriteStats(filename, start, run, modules)
+
+
 class Sources:
   def __init__(self):
     self.names = []
     self.modules = []
     self.is_debugger_id = []
+    self.stages = []
+    self.encodings = []
+
+
+NON_ASCII_PATTERN = re.compile(r'[\x80-\xff]')
+
+def SourceEncoding(lines):
+  """Classify a source as 'one-byte' if it is ASCII, and 'utf-8' if not."""
+  if NON_ASCII_PATTERN.search(lines):
+    return 'utf-8'
+  return 'one-byte'
+
+
+# A character other than ASCII in UTF-8, with the backslashes before it.
+ESCAPED_CHAR_PATTERN = re.compile(r'(\\*)([\xc0-\xff][\x80-\xbf]*)')
+
+# Characters other than ASCII that end lines, and that separate tokens.
+LINE_TERMINATORS = (0x2028, 0x2029)
+
+def IsSpace(code):
+  return code == 0xfeff or (code <= 0xffff and
+                            unicodedata.category(unichr(code)) == 'Zs')
+
+
+def CodePoint(char):
+  text = char.decode('utf-8')
+  if len(text) == 2:
+    # A narrow Python decodes characters beyond 0xffff to surrogate pairs.
+    return 0x10000 + ((ord(text[0]) - 0xd800) << 10) + ord(text[1]) - 0xdc00
+  return ord(text)
+
+
+def EscapeInLiteral(match):
+  (backslashes, char) = match.groups()
+  code = CodePoint(char)
+  if len(backslashes) % 2:
+    # An escaped character is the character itself, and an escaped line
+    # terminator continues the line; either way the backslash goes.
+    backslashes = backslashes[:-1]
+    if code in LINE_TERMINATORS:
+      return backslashes
+  if code > 0xffff:
+    code = code - 0x10000
+    return backslashes + '\\u%04x\\u%04x' % (0xd800 + (code >> 10),
+                                             0xdc00 + (code & 0x3ff))
+  return backslashes + '\\u%04x' % code
+
+
+def EscapeOutsideLiteral(match):
+  (backslashes, char) = match.groups()
+  code = CodePoint(char)
+  if code in LINE_TERMINATORS:
+    return backslashes + '\n'
+  if IsSpace(code):
+    return backslashes + ' '
+  if code > 0xffff:
+    return backslashes + '\\u{%x}' % code
+  return backslashes + '\\u%04x' % code
+
+
+def EscapeNonAscii(filename, lines):
+  """Turn a UTF-8 source into ASCII.
+
+  In strings, templates and regular expressions the other characters become
+  \\u escapes, in surrogate pairs beyond 0xffff, and a backslash escaping
+  one of them goes. In identifiers they become \\u or \\u{} escapes, which
+  take no surrogates. White space and line terminators between tokens become
+  spaces and newlines. Only the raw strings of templates tell the difference.
+  """
+  try:
+    lines.decode('utf-8')
+  except UnicodeDecodeError, e:
+    raise Error("%s is neither ASCII nor UTF-8: %s" % (filename, e))
+  return ''.join(EscapeTokens(js2c_common.ScanScript(lines)[0]))
+
+
+def EscapeTokens(tokens):
+  result = []
+  for (kind, text) in tokens:
+    if not NON_ASCII_PATTERN.search(text):
+      result.append(text)
+    elif kind == 'literal' and text.startswith('`'):
+      result.extend(EscapeTemplate(text))
+    elif kind == 'literal':
+      result.append(ESCAPED_CHAR_PATTERN.sub(EscapeInLiteral, text))
+    else:
+      result.append(ESCAPED_CHAR_PATTERN.sub(EscapeOutsideLiteral, text))
+  return result
+
+
+def EscapeTemplate(template):
+  # The substitutions of a template are scripts of their own.
+  result = []
+  literal = 0
+  pos = 1
+  end = len(template)
+  while pos < end:
+    if template[pos] == '\\':
+      pos = pos + 2
+    elif template.startswith('${', pos):
+      result.append(ESCAPED_CHAR_PATTERN.sub(EscapeInLiteral,
+                                             template[literal:pos + 2]))
+      tokens = js2c_common.ScanScript(template, pos + 2, True)[0]
+      result.extend(EscapeTokens(tokens))
+      pos = literal = pos + 2 + sum(len(text) for (kind, text) in tokens)
+    else:
+      pos = pos + 1
+  result.append(ESCAPED_CHAR_PATTERN.sub(EscapeInLiteral, template[literal:]))
+  return result
 
 
 def IsDebuggerFile(filename):
@@ -379,12 +988,67 @@ def IsMacroFile(filename):
   return filename.endswith("macros.py")
 
 
-def PrepareSources(source_files):
+# Filters of the current process, set up by InitWorker. The filters are
+# closures, so every worker builds its own.
+worker_filters = None
+
+def InitWorker(macro_file):
+  global worker_filters
+  worker_filters = BuildFilters(macro_file)
+
+
+def FilterSource(source):
+  stats = js2c_common.StageStats()
+  start = time.time()
+  lines = ReadFile(source)
+  stats.Add('read', start, len(lines), len(lines))
+  try:
+    for (name, function, expander) in worker_filters:
+      start = time.time()
+      count = expander and expander.expansions
+      output = function(lines)
+      if expander:
+        stats.Add(name, start, len(lines), len(output),
+                  expansions=expander.expansions - count)
+      else:
+        stats.Add(name, start, len(lines), len(output))
+      lines = output
+  except Error as e:
+    raise Error("In file %s:\n%s" % (source, str(e)))
+  return (lines, stats.stages)
+
+
+def FilterSources(source_files, macro_file, jobs):
+  """Run the filter chain over the source files.
+
+  Args:
+    source_files: List of Javascript-ish source files.
+    macro_file: Name of the macro file, if any.
+    jobs: Number of worker processes to use; 1 processes serially.
+
+  Returns:
+    A list with the processed sources and the StageStats stages of each,
+    in the order of source_files.
+  """
+  if jobs > 1 and len(source_files) > 1:
+    pool = multiprocessing.Pool(min(jobs, len(source_files)), InitWorker,
+                                (macro_file,))
+    try:
+      return pool.map(FilterSource, source_files, 1)
+    finally:
+      pool.close()
+      pool.join()
+  InitWorker(macro_file)
+  return map(FilterSource, source_files)
+
+
+def PrepareSources(source_files, jobs=1):
   """Read, prepare and assemble the list of source files.
 
   Args:
     sources: List of Javascript-ish source files. A file named macros.py
         will be treated as a list of macros.
+    jobs: Number of worker processes to filter the sources with.
 
   Returns:
     An instance of Sources.
@@ -396,20 +1060,20 @@ def PrepareSources(source_files):
     source_files.remove(macro_files[0])
     macro_file = macro_files[0]
 
-  filters = BuildFilterChain(macro_file)
-
   # Sort 'debugger' sources first.
   source_files = sorted(source_files,
                         lambda l,r: IsDebuggerFile(r) - IsDebuggerFile(l))
 
   result = Sources()
-  for source in source_files:
-    try:
-      lines = filters(source)
-    except Error as e:
-      raise Error("In file %s:\n%s" % (source, str(e)))
-
+  filtered = FilterSources(source_files, macro_file, jobs)
+  for (source, (lines, stages)) in zip(source_files, filtered):
+    # V8 takes the natives for one-byte strings.
+    encoding = SourceEncoding(lines)
+    if encoding != 'one-byte':
+      lines = EscapeNonAscii(source, lines)
+    result.encodings.append(encoding)
     result.modules.append(lines);
+    result.stages.append(stages)
 
     is_debugger = IsDebuggerFile(source)
     result.is_debugger_id.append(is_debugger);
@@ -419,7 +1083,7 @@ def PrepareSources(source_files):
   return result
 
 
-def BuildMetadata(sources, source_bytes, native_type):
+def BuildMetadata(sources, source_bytes, native_type, stats=None):
   """Build the meta data required to generate a libaries file.
 
   Args:
@@ -427,6 +1091,7 @@ def BuildMetadata(sources, source_bytes, native_type):
     source_bytes: A list of source bytes.
         (The concatenation of all sources; might be compressed.)
     native_type: The parameter for the NativesCollection template.
+    stats: StageStats to record the time ToCArray takes in, if any.
 
   Returns:
     A dictionary for use with HEADER_TEMPLATE.
@@ -434,11 +1099,11 @@ def BuildMetadata(sources, source_bytes, native_type):
   total_length = len(source_bytes)
   raw_sources = "".join(sources.modules)
 
-  # The sources are expected to be ASCII-only.
-  assert not filter(lambda value: ord(value) >= 128, raw_sources)
+  # The sources are expected to be ASCII-only; PrepareSources escapes the
+  # others.
+  assert not NON_ASCII_PATTERN.search(raw_sources)
 
   # Loop over modules and build up indices into the source blob:
-  get_index_cases = []
   get_script_name_cases = []
   get_raw_script_source_cases = []
   offset = 0
@@ -452,25 +1117,32 @@ def BuildMetadata(sources, source_bytes, native_type):
         "offset": offset,
         "raw_length": len(sources.modules[i]),
     }
-    get_index_cases.append(GET_INDEX_CASE % d)
     get_script_name_cases.append(GET_SCRIPT_NAME_CASE % d)
     get_raw_script_source_cases.append(GET_RAW_SCRIPT_SOURCE_CASE % d)
     offset += len(sources.modules[i])
   assert offset == len(raw_sources)
 
+  (index_lookup_declaration, get_index_body) = BuildIndexLookup(sources.names)
+
   # If we have the raw sources we can declare them accordingly.
   have_raw_sources = source_bytes == raw_sources
   raw_sources_declaration = (RAW_SOURCES_DECLARATION
       if have_raw_sources else RAW_SOURCES_COMPRESSION_DECLARATION)
 
+  start = time.time()
+  sources_array = ToCArray(source_bytes)
+  if stats:
+    stats.Add('ToCArray', start, len(source_bytes), len(sources_array))
+
   metadata = {
     "builtin_count": len(sources.modules),
     "debugger_count": sum(sources.is_debugger_id),
-    "sources_declaration": SOURCES_DECLARATION % ToCArray(source_bytes),
+    "sources_declaration": SOURCES_DECLARATION % sources_array,
     "raw_sources_declaration": raw_sources_declaration,
     "raw_total_length": sum(map(len, sources.modules)),
     "total_length": total_length,
-    "get_index_cases": "".join(get_index_cases),
+    "index_lookup_declaration": index_lookup_declaration,
+    "get_index_body": get_index_body,
     "get_raw_script_source_cases": "".join(get_raw_script_source_cases),
     "get_script_name_cases": "".join(get_script_name_cases),
     "type": native_type,
@@ -498,7 +1170,10 @@ def CompressMaybe(sources, compression_type):
 
 
 def PutInt(blob_file, value):
-  assert(value >= 0 and value < (1 << 20))
+  if value >= (1 << 20):
+    raise Error("%i is too large for startup blob version 1, use "
+                "--startup_blob_version=2." % value)
+  assert(value >= 0)
   size = 1 if (value < 1 << 6) else (2 if (value < 1 << 14) else 3)
   value_with_length = (value << 2) | size
 
@@ -514,14 +1189,24 @@ def PutStr(blob_file, value):
   blob_file.write(value);
 
 
-def WriteStartupBlob(sources, startup_blob):
+def WriteStartupBlob(sources, startup_blob, version=1):
   """Write a startup blob, as expected by V8 Initialize ...
     TODO(vogelheim): Add proper method name.
 
   Args:
     sources: A Sources instance with the prepared sources.
     startup_blob_file: Name of file to write the blob to.
+    version: 1 for the stream V8 reads, 2 for the indexed layout of
+        IndexedStartupBlob.
   """
+  if version == 2:
+    output = open(startup_blob, "wb")
+    output.write(IndexedStartupBlob(sources))
+    output.close()
+    return
+  if version != 1:
+    raise Error("Unknown startup blob version %s." % version)
+
   output = open(startup_blob, "wb")
 
   debug_sources = sum(sources.is_debugger_id);
@@ -538,10 +1223,158 @@ def WriteStartupBlob(sources, startup_blob):
   output.close()
 
 
-def JS2C(source, target, native_type, compression_type, raw_file, startup_blob):
-  sources = PrepareSources(source)
+# Version 2 of the startup blob has fixed size, little-endian records that
+# a reader can use straight from a mapping of the file:
+#
+#   header  magic[8] version:u32 count:u32 index_offset:u64 data_offset:u64
+#           size:u64
+#   index   count entries, sorted by name for binary search:
+#           name_offset:u64 offset:u64 length:u64 name_length:u32 flags:u32
+#           checksum:u32 order:u32
+#   names   NUL terminated
+#   data    the sources, each 8-byte aligned
+#
+# checksum is the CRC-32 of the source, order its position in the blob
+# version 1 (debugger sources first) and flags has STARTUP_BLOB_DEBUGGER
+# set for debugger sources.
+STARTUP_BLOB_MAGIC = 'V8NATIVE'
+STARTUP_BLOB_HEADER = struct.Struct('<8sIIQQQ')
+STARTUP_BLOB_ENTRY = struct.Struct('<QQQIIII')
+STARTUP_BLOB_ALIGNMENT = 8
+STARTUP_BLOB_DEBUGGER = 1
+
+
+def Align(offset, alignment):
+  return (offset + alignment - 1) // alignment * alignment
+
+
+def IndexedStartupBlob(sources):
+  """Lay out version 2 of the startup blob for the prepared sources."""
+  order = sorted(xrange(len(sources.names)), key=lambda i: sources.names[i])
+  index_offset = STARTUP_BLOB_HEADER.size
+  name_offset = index_offset + STARTUP_BLOB_ENTRY.size * len(order)
+  names = []
+  entries = []
+  for i in order:
+    names.append(sources.names[i] + '\0')
+    entries.append([name_offset, 0, len(sources.modules[i]),
+                    len(sources.names[i]),
+                    STARTUP_BLOB_DEBUGGER if sources.is_debugger_id[i] else 0,
+                    zlib.crc32(sources.modules[i]) & 0xffffffff, i])
+    name_offset = name_offset + len(sources.names[i]) + 1
+  data_offset = Align(name_offset, STARTUP_BLOB_ALIGNMENT)
+  offset = data_offset
+  for entry in entries:
+    entry[1] = offset
+    offset = Align(offset + entry[2], STARTUP_BLOB_ALIGNMENT)
+
+  pieces = [STARTUP_BLOB_HEADER.pack(STARTUP_BLOB_MAGIC, 2, len(entries),
+                                     index_offset, data_offset, offset)]
+  pieces.extend(STARTUP_BLOB_ENTRY.pack(*entry) for entry in entries)
+  pieces.extend(names)
+  position = name_offset
+  for (entry, i) in zip(entries, order):
+    pieces.append('\0' * (entry[1] - position))
+    pieces.append(sources.modules[i])
+    position = entry[1] + entry[2]
+  pieces.append('\0' * (offset - position))
+  return ''.join(pieces)
+
+
+def GetInt(blob, offset):
+  if offset >= len(blob):
+    raise Error("Startup blob is truncated at %i." % offset)
+  size = (ord(blob[offset]) & 3)
+  if size == 0 or offset + size > len(blob):
+    raise Error("Bad integer at %i of the startup blob." % offset)
+  value = 0
+  for i in xrange(size):
+    value |= ord(blob[offset + i]) << (8 * i)
+  return (value >> 2, offset + size)
+
+
+def GetStr(blob, offset):
+  (length, offset) = GetInt(blob, offset)
+  if offset + length > len(blob):
+    raise Error("String at %i runs past the end of the startup blob." %
+                offset)
+  return (blob[offset:offset + length], offset + length)
+
+
+def ReadStartupBlob(blob):
+  """Read and verify a startup blob of either version.
+
+  Args:
+    blob: The contents of the blob, as a string or mmap.
+
+  Returns:
+    A list of (name, source, is_debugger) tuples, in the order of the
+    blob version 1.
+  """
+  if blob[:len(STARTUP_BLOB_MAGIC)] != STARTUP_BLOB_MAGIC:
+    result = []
+    offset = 0
+    for is_debugger in (True, False):
+      (count, offset) = GetInt(blob, offset)
+      for i in xrange(count):
+        (name, offset) = GetStr(blob, offset)
+        (source, offset) = GetStr(blob, offset)
+        result.append((name, source, is_debugger))
+    if offset != len(blob):
+      raise Error("Trailing data at %i of the startup blob." % offset)
+    return result
+
+  if len(blob) < STARTUP_BLOB_HEADER.size:
+    raise Error("Startup blob header is truncated.")
+  (magic, version, count, index_offset, data_offset,
+   size) = STARTUP_BLOB_HEADER.unpack_from(blob, 0)
+  if version != 2:
+    raise Error("Unknown startup blob version %i." % version)
+  if size != len(blob):
+    raise Error("Startup blob is %i bytes, the header says %i." %
+                (len(blob), size))
+  if index_offset + STARTUP_BLOB_ENTRY.size * count > data_offset:
+    raise Error("Startup blob index runs into the data.")
+  result = [None] * count
+  previous = None
+  for i in xrange(count):
+    (name_offset, offset, length, name_length, flags, checksum,
+     order) = STARTUP_BLOB_ENTRY.unpack_from(
+         blob, index_offset + STARTUP_BLOB_ENTRY.size * i)
+    if (name_offset + name_length >= data_offset or
+        blob[name_offset + name_length] != '\0'):
+      raise Error("Bad name for entry %i of the startup blob." % i)
+    name = blob[name_offset:name_offset + name_length]
+    if previous is not None and name <= previous:
+      raise Error("Startup blob index is not sorted at %s." % name)
+    previous = name
+    if (offset < data_offset or offset % STARTUP_BLOB_ALIGNMENT or
+        offset + length > size):
+      raise Error("Bad source for %s in the startup blob." % name)
+    source = blob[offset:offset + length]
+    if zlib.crc32(source) & 0xffffffff != checksum:
+      raise Error("Checksum mismatch for %s in the startup blob." % name)
+    if order >= count or result[order] is not None:
+      raise Error("Bad order for %s in the startup blob." % name)
+    result[order] = (name, source, bool(flags & STARTUP_BLOB_DEBUGGER))
+  return result
+
+
+def JS2C(source, target, native_type, compression_type, raw_file, startup_blob,
+         jobs=1, stats=None, startup_blob_version=1):
+  start = time.time()
+  run_stats = js2c_common.StageStats()
+  sources = PrepareSources(source, jobs)
+  run_stats.Add('filter', start, sum(stage['input_bytes']
+                                     for stages in sources.stages
+                                     for stage in stages
+                                     if stage['stage'] == 'read'),
+                sum(map(len, sources.modules)), jobs=jobs)
+  compress_start = time.time()
   sources_bytes = CompressMaybe(sources, compression_type)
-  metadata = BuildMetadata(sources, sources_bytes, native_type)
+  run_stats.Add('compress', compress_start, sum(map(len, sources.modules)),
+                len(sources_bytes))
+  metadata = BuildMetadata(sources, sources_bytes, native_type, run_stats)
 
   # Optionally emit raw file.
   if raw_file:
@@ -550,12 +1383,18 @@ def JS2C(source, target, native_type, compression_type, raw_file, startup_blob):
     output.close()
 
   if startup_blob:
-    WriteStartupBlob(sources, startup_blob);
+    WriteStartupBlob(sources, startup_blob, startup_blob_version);
 
   # Emit resulting source file.
+  write_start = time.time()
+  header = HEADER_TEMPLATE % metadata
   output = open(target, "w")
-  output.write(HEADER_TEMPLATE % metadata)
+  output.write(header)
   output.close()
+  run_stats.Add('write', write_start, len(sources_bytes), len(header))
+
+  if stats:
+    WriteStats(stats, start, run_stats.stages, sources)
 
 
 def main():
@@ -564,6 +1403,15 @@ def main():
                     help="file to write the processed sources array to.")
   parser.add_option("--startup_blob", action="store",
                     help="file to write the startup blob to.")
+  parser.add_option("--startup_blob_version", action="store", type="int",
+                    default=1,
+                    help="1 for the stream V8 reads, 2 for an indexed blob "
+                         "that can be mapped and searched.")
+  parser.add_option("-j", "--jobs", action="store", type="int", default=1,
+                    help="number of processes to filter the sources with.")
+  parser.add_option("--stats", action="store",
+                    help="file to write the time, sizes and expansion counts "
+                         "of every stage of every source to, as JSON.")
   parser.set_usage("""js2c out.cc type compression sources.js ...
       out.cc: C code to be generated.
       type: type parameter for NativesCollection template.
@@ -574,7 +1422,8 @@ def main():
   args[1] = args[1].replace('../','').replace('..\\','').replace('libraries\\','').replace('node\\','').replace('deps\\','').replace('v8\\','').replace('tools\\','').replace('gyp\\','')
   args[2] = args[2].replace('../','').replace('..\\','').replace('libraries\\','').replace('node\\','').replace('deps\\','').replace('v8\\','').replace('tools\\','').replace('gyp\\','')
   
-  JS2C(args[3:], args[0], args[1], args[2], options.raw, options.startup_blob)
+  JS2C(args[3:], args[0], args[1], args[2], options.raw, options.startup_blob,
+       options.jobs, options.stats, options.startup_blob_version)
 
 
 if __name__ == "__main__":
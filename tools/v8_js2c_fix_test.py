@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#
+# Tests of v8_js2c_fix.py. Like the generator they need V8's jsmin.
+#
+#   python tools/v8_js2c_fix_test.py
+
+import bz2
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import v8_js2c_fix
+
+MACROS = """\
+const FOO_BAR = FOO + 1;
+const FOO = 1;
+macro TWICE(x) = (x + x);
+macro ADD(a, b) = (a + b);
+macro QUAD(x) = TWICE(TWICE(x));
+macro EARLY(x) = LATE(x);
+macro LATE(x) = -x;
+"""
+
+
+def Expand(lines):
+  (constants, macros) = v8_js2c_fix.ReadMacros(MACROS)
+  lines = v8_js2c_fix.ConstantExpander(constants).Expand(lines)
+  return v8_js2c_fix.MacroExpander(macros).Expand(lines)
+
+
+def Filter(lines):
+  return re.sub(r'\s+', '', v8_js2c_fix.FilterScript(lines))
+
+
+class MacroTest(unittest.TestCase):
+  def testNestedCalls(self):
+    self.assertEqual(Expand("ADD(TWICE(f(1, 2)), [3, 4]);"),
+                     "((f(1, 2) + f(1, 2)) + [3, 4]);")
+
+  def testMacroInBody(self):
+    self.assertEqual(Expand("QUAD(y);"), "((y + y) + (y + y));")
+
+  def testOnlyEarlierMacrosInBody(self):
+    self.assertEqual(Expand("EARLY(y);"), "LATE(y);")
+
+  def testWholeNames(self):
+    self.assertEqual(Expand("XADD(1, 2);"), "XADD(1, 2);")
+
+  def testInlineMacrosExpandOnce(self):
+    lines = ("macro TWICE(x)\n(x + x)\nendmacro\n"
+             "macro QUAD(x)\nTWICE(TWICE(x))\nendmacro\n"
+             "QUAD(y);\n")
+    self.assertEqual(Filter(lines), "(TWICE(y)+TWICE(y));")
+
+
+class ConstantTest(unittest.TestCase):
+  def testWholeWords(self):
+    self.assertEqual(Expand("FOO + FOO_BAR + MY_FOO + FOO2;"),
+                     "1 + 1 + 1 + MY_FOO + FOO2;")
+
+  def testInlineConstants(self):
+    lines = "const LIMIT = 10;\nx < LIMIT && y < LIMITS;\n"
+    self.assertEqual(Filter(lines), "x<10&&y<LIMITS;")
+
+
+class FilterTest(unittest.TestCase):
+  def testComments(self):
+    self.assertEqual(v8_js2c_fix.FilterScript("a; // x\n/* y */ b;\n"),
+                     "a;\n b;\n")
+
+  def testSlashesInLiterals(self):
+    lines = "var s = '// x', t = \"/* y */\", r = /\\/\\/z/g;\n"
+    self.assertEqual(v8_js2c_fix.FilterScript(lines), lines)
+
+  def testTemplates(self):
+    lines = "var t = `a // b\n\n  ${c /* d */}`;\n"
+    self.assertEqual(v8_js2c_fix.FilterScript(lines), lines)
+
+  def testDivision(self):
+    self.assertEqual(Filter("x = a / b / c; // d\n"), "x=a/b/c;")
+
+  def testWordsInStrings(self):
+    lines = "var s = 'eval(x)', t = \"with (y)\";\n"
+    self.assertEqual(v8_js2c_fix.FilterScript(lines), lines)
+
+  def testEval(self):
+    self.assertRaises(v8_js2c_fix.Error, v8_js2c_fix.FilterScript,
+                      "eval ('x');\n")
+    self.assertRaises(v8_js2c_fix.Error, v8_js2c_fix.FilterScript,
+                      "with (o) {}\n")
+
+
+def Escape(text):
+  return v8_js2c_fix.EscapeNonAscii('test.js', text.encode('utf-8'))
+
+
+class EscapeNonAsciiTest(unittest.TestCase):
+  def testAscii(self):
+    lines = "var s = 'caf\\u00e9', t = `${s}`;\n"
+    self.assertEqual(Escape(lines), lines)
+    self.assertEqual(v8_js2c_fix.SourceEncoding(lines), 'one-byte')
+
+  def testLatin1(self):
+    lines = u"var s = 'caf\xe9', r = /\xe9+/, \xe9 = 1;\xa0x;\n"
+    self.assertEqual(v8_js2c_fix.SourceEncoding(lines.encode('utf-8')),
+                     'utf-8')
+    self.assertEqual(Escape(lines),
+                     "var s = 'caf\\u00e9', r = /\\u00e9+/, \\u00e9 = 1; x;\n")
+
+  def testAstral(self):
+    self.assertEqual(Escape(u"var s = '\U0001f600';\n"),
+                     "var s = '\\ud83d\\ude00';\n")
+    self.assertEqual(Escape(u"var \U0001d49c = `\U0001f600${\U0001d49c}`;\n"),
+                     "var \\u{1d49c} = `\\ud83d\\ude00${\\u{1d49c}}`;\n")
+
+  def testEscapedCharacters(self):
+    self.assertEqual(Escape(u"var s = '\\\xe9', t = 'a\\\u2028b';\n"),
+                     "var s = '\\u00e9', t = 'ab';\n")
+    self.assertEqual(Escape(u"a;\u2028b;\n"), "a;\nb;\n")
+
+  def testNotUtf8(self):
+    self.assertRaises(v8_js2c_fix.Error, v8_js2c_fix.EscapeNonAscii,
+                      'test.js', "var s = '\xe9';\n")
+
+
+class CompressionTest(unittest.TestCase):
+  def setUp(self):
+    self.sources = v8_js2c_fix.Sources()
+    self.sources.modules = ['var m;\n', 'var r = 1;', '', 'x' * 20000]
+
+  def testOff(self):
+    self.assertEqual(v8_js2c_fix.CompressMaybe(self.sources, 'off'),
+                     ''.join(self.sources.modules))
+
+  def testBz2RoundTrip(self):
+    compressed = v8_js2c_fix.CompressMaybe(self.sources, 'bz2')
+    self.assertTrue(len(compressed) < len(''.join(self.sources.modules)))
+    self.assertEqual(bz2.decompress(compressed),
+                     ''.join(self.sources.modules))
+
+  def testUnknown(self):
+    # V8 only has a decompressor for bz2.
+    for compression_type in ['zlib', 'lzma', 'auto']:
+      self.assertRaises(v8_js2c_fix.Error, v8_js2c_fix.CompressMaybe,
+                        self.sources, compression_type)
+
+
+class StartupBlobTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.sources = v8_js2c_fix.Sources()
+    for (name, module, is_debugger) in [('mirror', 'var m;\n', True),
+                                        ('runtime', 'var r = 1;', False),
+                                        ('array', '', False),
+                                        ('apinatives', 'x' * 20000, False)]:
+      self.sources.names.append(name)
+      self.sources.modules.append(module)
+      self.sources.is_debugger_id.append(is_debugger)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def Write(self, version):
+    path = os.path.join(self.directory, 'blob%i.bin' % version)
+    v8_js2c_fix.WriteStartupBlob(self.sources, path, version)
+    file = open(path, 'rb')
+    try:
+      return file.read()
+    finally:
+      file.close()
+
+  def testRoundTrip(self):
+    expected = zip(self.sources.names, self.sources.modules,
+                   self.sources.is_debugger_id)
+    self.assertEqual(v8_js2c_fix.ReadStartupBlob(self.Write(1)), expected)
+    self.assertEqual(v8_js2c_fix.ReadStartupBlob(self.Write(2)), expected)
+
+  def testMapping(self):
+    self.Write(2)
+    file = open(os.path.join(self.directory, 'blob2.bin'), 'rb')
+    try:
+      blob = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        self.assertEqual(v8_js2c_fix.ReadStartupBlob(blob),
+                         v8_js2c_fix.ReadStartupBlob(self.Write(1)))
+      finally:
+        blob.close()
+    finally:
+      file.close()
+
+  def testAlignment(self):
+    blob = self.Write(2)
+    for i in xrange(len(self.sources.names)):
+      offset = v8_js2c_fix.STARTUP_BLOB_HEADER.size + \
+          v8_js2c_fix.STARTUP_BLOB_ENTRY.size * i
+      entry = v8_js2c_fix.STARTUP_BLOB_ENTRY.unpack_from(blob, offset)
+      self.assertEqual(entry[1] % v8_js2c_fix.STARTUP_BLOB_ALIGNMENT, 0)
+
+  def testCorruption(self):
+    blob = self.Write(2)
+    offset = blob.index('var r')
+    corrupt = blob[:offset] + 'let' + blob[offset + 3:]
+    self.assertRaises(v8_js2c_fix.Error, v8_js2c_fix.ReadStartupBlob,
+                      corrupt)
+    self.assertRaises(v8_js2c_fix.Error, v8_js2c_fix.ReadStartupBlob,
+                      blob[:-8])
+
+  def testVersion1Limit(self):
+    self.sources.modules[1] = 'x' * (1 << 20)
+    self.assertRaises(v8_js2c_fix.Error, self.Write, 1)
+    self.assertEqual(v8_js2c_fix.ReadStartupBlob(self.Write(2))[1][1],
+                     self.sources.modules[1])
+
+
+class JS2CTest(unittest.TestCase):
+  MODULES = {
+    'runtime.js': "// Runtime\nvar r = TWICE(FOO);\n",
+    'array.js': "var a = [FOO_BAR];  /* x */\n" * 100,
+    'mirror-debugger.js': "var m;\n",
+  }
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.files = [self.Path(name) for name in sorted(self.MODULES)]
+    for name in self.MODULES:
+      self.Write(self.Path(name), self.MODULES[name])
+    self.files.append(self.Path('macros.py'))
+    self.Write(self.Path('macros.py'), MACROS)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def Path(self, name):
+    return os.path.join(self.directory, name)
+
+  def Write(self, path, contents):
+    file = open(path, 'wb')
+    try:
+      file.write(contents)
+    finally:
+      file.close()
+
+  def Read(self, path):
+    file = open(path, 'rb')
+    try:
+      return file.read()
+    finally:
+      file.close()
+
+  def Generate(self, compression_type='off', jobs=1):
+    v8_js2c_fix.JS2C(list(self.files), self.Path('libraries.cc'), 'CORE',
+                     compression_type, self.Path('raw.bin'),
+                     self.Path('blob.bin'), jobs, None, 2)
+    return self.Read(self.Path('libraries.cc'))
+
+  def testSources(self):
+    self.Generate()
+    sources = v8_js2c_fix.PrepareSources(list(self.files))
+    self.assertEqual(sources.names, ['mirror', 'array', 'runtime'])
+    self.assertEqual(sources.modules[2], "\nvar r = (1 + 1);\n")
+    self.assertEqual(self.Read(self.Path('raw.bin')),
+                     ''.join(sources.modules))
+    self.assertEqual(
+        v8_js2c_fix.ReadStartupBlob(self.Read(self.Path('blob.bin'))),
+        zip(sources.names, sources.modules, sources.is_debugger_id))
+
+  def testBz2(self):
+    self.Generate()
+    raw = self.Read(self.Path('raw.bin'))
+    self.Generate('bz2')
+    self.assertEqual(bz2.decompress(self.Read(self.Path('raw.bin'))), raw)
+
+  def testJobs(self):
+    for compression_type in ['off', 'bz2']:
+      self.assertEqual(self.Generate(compression_type, 3),
+                       self.Generate(compression_type))
+
+
+if __name__ == '__main__':
+  unittest.main()